@@ -1,23 +1,30 @@
-from flask import Flask, request, jsonify, send_from_directory, make_response
+import time
+_AVVIO_T0 = time.perf_counter()
+
+from flask import Flask, request, jsonify, make_response, abort, Response, stream_with_context
 from flask_cors import CORS
 import os
+import threading
 from datetime import datetime
-from docx import Document
-from docx.shared import Inches, Pt
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.enum.table import WD_TABLE_ALIGNMENT
 from io import BytesIO
 
 # Import moduli locali
-from database_universal import init_db, create_default_user, exec_sql
-from models import User, Condominio, Persona, Spesa, Millesemo, PreventivoAnnuale, SpesaPreventivata, RipartizionePreventivo, UnitaImmobiliare
+from database_universal import init_db, create_default_user, exec_sql, get_read_db, nello_shard_corrente
+from models import User, Condominio, Persona, Spesa, Millesemo, PreventivoAnnuale, SpesaPreventivata, RipartizionePreventivo, UnitaImmobiliare, RicercaSpese
 from utils import (
     token_required, hash_password, verify_password, generate_jwt_token, verify_jwt_token,
     validate_login_data, validate_condominio_data, validate_persona_data,
     validate_spesa_data, validate_millesimi_data, calculate_ripartizione_completa,
-    calculate_ripartizione_preventivo, export_condominio_json, generate_preventivo_anno,
-    calcolo_analisi_anno_successivo, log_error
+    calculate_ripartizione_preventivo, genera_export_condominio_json, generate_preventivo_anno,
+    calcolo_analisi_anno_successivo, log_error, revoca_token, get_profilo_ruoli, ripartisci_spesa,
+    get_dati_ripartizione, validate_simulazione_data, simula_ripartizione_preventivo,
+    calcolo_analytics_spese, parole_ricerca, validate_ricerca_params, calcolo_portfolio
 )
+from money import from_cents, to_cents, somma
+from compression import StaticAssets, comprimi_risposta, scegli_encoding, CACHE_IMMUTABILE
+from importazione import formato_file, leggi_righe, importa_spese
+from json_provider import ProviderJSON
+from manutenzione import manutenzione_sqlite
 
 # Inizializza Flask
 app = Flask(__name__, static_folder='../frontend', static_url_path='')
@@ -29,11 +36,8 @@ if cors_origins:
 else:
     CORS(app)
 
-# Assicura UTF-8 nei JSON e nelle risposte testuali
-try:
-    app.config['JSON_AS_ASCII'] = False
-except Exception:
-    pass
+# Serializzazione JSON (orjson se disponibile), UTF-8 senza escape
+app.json = ProviderJSON(app)
 
 @app.after_request
 def ensure_charset(response):
@@ -45,15 +49,205 @@ def ensure_charset(response):
         pass
     return response
 
-# Inizializza database all'avvio
-with app.app_context():
-    init_db()
-    create_default_user()
+@app.after_request
+def comprimi_json(response):
+    """Compressione gzip/brotli delle risposte JSON sopra soglia"""
+    try:
+        return comprimi_risposta(response, request.accept_encodings)
+    except Exception as e:
+        log_error(f"Errore compressione risposta: {str(e)}")
+        return response
+
+# ======================
+# HTTP CACHING (ETag)
+# ======================
+
+def etag_condominio(condominio, *parti):
+    """Tag ETag (debole) derivato dalla versione dati del condominio.
+
+    `parti` aggiunge eventuali dipendenze della risposta non legate ai dati
+    (es. anno corrente usato come default).
+    """
+    tag = f"c{condominio.id}-v{condominio.data_version or 0}"
+    if parti:
+        tag += '-' + '-'.join(str(p) for p in parti)
+    return tag
+
+def etag_portfolio(user_id, condominii, *parti):
+    """Tag ETag (debole) per risposte che dipendono da tutti i condominii dell'utente"""
+    import hashlib
+    versioni = ','.join(f"{c.id}:{c.data_version or 0}" for c in sorted(condominii, key=lambda c: c.id))
+    tag = f"u{user_id}-{hashlib.sha256(versioni.encode()).hexdigest()[:16]}"
+    if parti:
+        tag += '-' + '-'.join(str(p) for p in parti)
+    return tag
+
+def non_modificato(etag):
+    """Ritorna una risposta 304 se il client ha già questa versione, altrimenti None"""
+    if request.if_none_match.contains_weak(etag):
+        response = make_response('', 304)
+        return con_etag(response, etag)
+    return None
+
+def con_etag(response, etag):
+    """Aggiunge ETag e Cache-Control (rivalidazione obbligatoria) alla risposta"""
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers['Vary'] = 'Authorization'
+    return response
+
+# ======================
+# SERIALIZZAZIONE
+# ======================
+# Formati JSON condivisi tra gli endpoint singoli e lo snapshot
+
+def serializza_condominio(condominio):
+    return {
+        'id': condominio.id,
+        'nome': condominio.nome,
+        'indirizzo': condominio.indirizzo,
+        'num_unita': condominio.num_unita,
+        'created_at': condominio.created_at
+    }
+
+def serializza_unita(unita):
+    return [{'id': u.id, 'numero_unita': u.numero_unita} for u in unita]
+
+def serializza_persone(persone):
+    return [{
+        'id': persona.id,
+        'nome': persona.nome,
+        'cognome': persona.cognome,
+        'email': persona.email,
+        'tipo_persona': persona.tipo_persona,
+        'unita_id': persona.unita_id
+    } for persona in persone]
+
+def serializza_millesimi(millesimi_per_tabella):
+    """Millesimi raggruppati per tabella (tutte le tabelle A-L, anche vuote)"""
+    result = {}
+    for tabella in ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'L']:
+        result[tabella] = [{
+            'id': millesimo.id,
+            'unita_id': millesimo.unita_id,
+            'valore': millesimo.valore
+        } for millesimo in millesimi_per_tabella.get(tabella, [])]
+    return result
+
+def serializza_validazione(totali_validi):
+    return {tabella: totali_validi.get(tabella, False)
+            for tabella in ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'L']}
+
+def serializza_spese(spese):
+    return [{
+        'id': spesa.id,
+        'descrizione': spesa.descrizione,
+        'importo': spesa.importo,
+        'data_spesa': spesa.data_spesa,
+        'tabella_millesimi': spesa.tabella_millesimi,
+        'logica_pi': spesa.logica_pi,
+        'percentuale_proprietario': spesa.percentuale_proprietario,
+        'percentuale_inquilino': spesa.percentuale_inquilino,
+        'created_at': spesa.created_at
+    } for spesa in spese]
+
+def serializza_preventivi(preventivi):
+    return [{
+        'id': preventivo.id,
+        'anno': preventivo.anno,
+        'importo_totale_preventivato': preventivo.importo_totale_preventivato,
+        'importo_totale_speso': preventivo.importo_totale_speso,
+        'differenza': preventivo.differenza,
+        'note': preventivo.note,
+        'created_at': preventivo.created_at,
+        'updated_at': preventivo.updated_at
+    } for preventivo in preventivi]
+
+# Tempi di avvio del worker (ms), riportati nel log e su /api/health
+startup_timings = {'import_app': round((time.perf_counter() - _AVVIO_T0) * 1000, 1)}
+
+_db_pronto = False
+_db_lock = threading.Lock()
+
+def ensure_db_ready():
+    """Inizializza il database una sola volta per processo, alla prima richiesta.
+
+    Lo schema viene verificato tramite la versione registrata nel database:
+    se è già aggiornato non viene eseguito alcun DDL.
+    """
+    global _db_pronto
+    if _db_pronto:
+        return
+    with _db_lock:
+        if _db_pronto:
+            return
+        t0 = time.perf_counter()
+        init_db()
+        create_default_user()
+        startup_timings['init_db'] = round((time.perf_counter() - t0) * 1000, 1)
+        # Checkpoint WAL, PRAGMA optimize e ANALYZE periodici (solo SQLite)
+        manutenzione_sqlite.avvia()
+        _db_pronto = True
+        print("[Avvio] " + " | ".join(f"{fase}: {ms} ms" for fase, ms in startup_timings.items()))
+
+@app.before_request
+def inizializza_database():
+    ensure_db_ready()
+
+# ======================
+# FILE STATICI (frontend)
+# ======================
+
+# Hash di contenuto e copie .gz/.br calcolati in background all'avvio
+static_assets = StaticAssets(app.static_folder)
+static_assets.avvia_precompressione()
+
+def servi_asset(asset):
+    """Risposta per un file statico con codifica negoziata e cache.
+
+    Con `?v=<hash>` corretto il file è immutabile (cache di un anno),
+    altrimenti il client deve rivalidare tramite ETag.
+    """
+    versionato = request.args.get('v') == asset.hash
+    encoding = scegli_encoding(request.accept_encodings) if asset.varianti else None
+    if encoding not in asset.varianti:
+        encoding = None
+    # ETag distinto per codifica (rappresentazioni diverse dello stesso file)
+    etag = f"{asset.hash}-{encoding}" if encoding else asset.hash
+
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(asset.varianti[encoding] if encoding else asset.data)
+        response.mimetype = asset.mimetype
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    if asset.varianti:
+        response.vary.add('Accept-Encoding')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = CACHE_IMMUTABILE if versionato else 'public, no-cache'
+    return response
 
-# Servi file statici (frontend)
 @app.route('/')
 def index():
-    return send_from_directory(app.static_folder, 'index.html')
+    asset = static_assets.rendi_html('index.html')
+    if not asset:
+        abort(404)
+    return servi_asset(asset)
+
+def servi_statico(filename):
+    asset = static_assets.get(filename)
+    if not asset:
+        abort(404)
+    return servi_asset(asset)
+
+# Sostituisce la vista statica di Flask (stesso URL) con quella precompressa
+app.view_functions['static'] = servi_statico
+
+@app.route('/api/health', methods=['GET'])
+def health():
+    """Stato del servizio e tempi di avvio del worker"""
+    return jsonify({'status': 'ok', 'startup_ms': startup_timings}), 200
 
 # ======================
 # AUTHENTICATION ENDPOINTS
@@ -100,8 +294,13 @@ def login():
 @app.route('/api/logout', methods=['POST'])
 @token_required
 def logout():
-    """Logout utente"""
-    return jsonify({'message': 'Logout successful'}), 200
+    """Logout utente: revoca il token corrente"""
+    try:
+        revoca_token(request.token_payload)
+        return jsonify({'message': 'Logout successful'}), 200
+    except Exception as e:
+        log_error(str(e), 'logout')
+        return jsonify({'message': 'Errore del server'}), 500
 
 @app.route('/api/register', methods=['POST'])
 def register():
@@ -171,6 +370,33 @@ def get_condominii():
         log_error(str(e), 'get_condominii')
         return jsonify({'message': 'Errore del server'}), 500
 
+@app.route('/api/portfolio', methods=['GET'])
+@token_required
+def get_portfolio():
+    """Riepilogo di tutti i condominii dell'utente (spese, preventivi, millesimi, persone)"""
+    try:
+        user_id = request.current_user_id
+        condominii = Condominio.get_by_user_id(user_id)
+
+        # Default: anno corrente e i due precedenti
+        anno_a = request.args.get('anno_a', type=int) or datetime.now().year
+        anno_da = request.args.get('anno_da', type=int) or anno_a - 2
+        if anno_da > anno_a or anno_a - anno_da >= 50:
+            return jsonify({'message': 'Intervallo di anni non valido (massimo 50 anni)'}), 400
+
+        etag = etag_portfolio(user_id, condominii, anno_da, anno_a)
+        cached = non_modificato(etag)
+        if cached:
+            return cached
+
+        portfolio = calcolo_portfolio(user_id, condominii, anno_da, anno_a)
+
+        return con_etag(jsonify(portfolio), etag), 200
+
+    except Exception as e:
+        log_error(str(e), 'get_portfolio')
+        return jsonify({'message': 'Errore del server'}), 500
+
 @app.route('/api/condominii', methods=['POST'])
 @token_required
 def create_condominio():
@@ -220,13 +446,12 @@ def get_condominio(condo_id):
         if condominio.user_id != request.current_user_id:
             return jsonify({'message': 'Non autorizzato'}), 403
 
-        return jsonify({
-            'id': condominio.id,
-            'nome': condominio.nome,
-            'indirizzo': condominio.indirizzo,
-            'num_unita': condominio.num_unita,
-            'created_at': condominio.created_at
-        }), 200
+        etag = etag_condominio(condominio)
+        cached = non_modificato(etag)
+        if cached:
+            return cached
+
+        return con_etag(jsonify(serializza_condominio(condominio)), etag), 200
 
     except Exception as e:
         log_error(str(e), f'get_condominio {condo_id}')
@@ -298,6 +523,70 @@ def delete_condominio(condo_id):
 # UNITA IMMOBILIARI ENDPOINTS
 # ======================
 
+# Sezioni disponibili nello snapshot e relativo caricamento (tutte sulla stessa connessione)
+SEZIONI_SNAPSHOT = {
+    'condominio': lambda condominio, conn: serializza_condominio(condominio),
+    'unita': lambda condominio, conn: serializza_unita(UnitaImmobiliare.get_by_condominio(condominio.id, conn=conn)),
+    'persone': lambda condominio, conn: serializza_persone(Persona.get_by_condominio(condominio.id, conn=conn)),
+    'millesimi': lambda condominio, conn: serializza_millesimi(Millesemo.get_by_condominio(condominio.id, conn=conn)),
+    'validazione': lambda condominio, conn: serializza_validazione(Millesemo.validate_totals(condominio.id, conn=conn)),
+    'spese': lambda condominio, conn: serializza_spese(Spesa.get_by_condominio(condominio.id, conn=conn)),
+    'preventivi': lambda condominio, conn: serializza_preventivi(PreventivoAnnuale.get_by_condominio(condominio.id, conn=conn)),
+}
+
+@app.route('/api/condominii/<int:condo_id>/snapshot', methods=['GET'])
+@token_required
+def get_snapshot_condominio(condo_id):
+    """Dati del condominio in una sola richiesta.
+
+    `?sections=persone,spese` limita le sezioni restituite (default: tutte).
+    Ogni sezione ha lo stesso formato dell'endpoint dedicato; le query usano
+    una sola connessione con vista consistente dei dati.
+    """
+    try:
+        sections = request.args.get('sections')
+        if sections:
+            sezioni = [s.strip() for s in sections.split(',') if s.strip()]
+            non_valide = [s for s in sezioni if s not in SEZIONI_SNAPSHOT]
+            if non_valide:
+                return jsonify({'message': f"Sezioni non valide: {', '.join(non_valide)}"}), 400
+        else:
+            sezioni = list(SEZIONI_SNAPSHOT)
+
+        # Proprietà e versione dal primario: la replica serve solo se ha già raggiunto questa versione
+        condominio = Condominio.find_by_id(condo_id)
+        if not condominio:
+            return jsonify({'message': 'Condominio non trovato'}), 404
+        if condominio.user_id != request.current_user_id:
+            return jsonify({'message': 'Non autorizzato'}), 403
+
+        etag = etag_condominio(condominio, *sorted(set(sezioni)))
+        cached = non_modificato(etag)
+        if cached:
+            return cached
+
+        # Versione e dati letti dalla stessa vista (anche sulla replica)
+        from database_universal import get_read_db, begin_read_snapshot
+        conn = get_read_db(condominio)
+        try:
+            begin_read_snapshot(conn)
+            condominio = Condominio.find_by_id(condo_id, conn=conn)
+            if not condominio:
+                return jsonify({'message': 'Condominio non trovato'}), 404
+            etag = etag_condominio(condominio, *sorted(set(sezioni)))
+
+            result = {'data_version': condominio.data_version or 0}
+            for sezione in sezioni:
+                result[sezione] = SEZIONI_SNAPSHOT[sezione](condominio, conn)
+        finally:
+            conn.close()
+
+        return con_etag(jsonify(result), etag), 200
+
+    except Exception as e:
+        log_error(str(e), f'get_snapshot_condominio {condo_id}')
+        return jsonify({'message': 'Errore del server'}), 500
+
 @app.route('/api/condominii/<int:condo_id>/unita', methods=['GET'])
 @token_required
 def get_unita_condominio(condo_id):
@@ -309,16 +598,17 @@ def get_unita_condominio(condo_id):
         if condominio.user_id != request.current_user_id:
             return jsonify({'message': 'Non autorizzato'}), 403
 
-        unita = UnitaImmobiliare.get_by_condominio(condo_id)
-
-        result = []
-        for u in unita:
-            result.append({
-                'id': u.id,
-                'numero_unita': u.numero_unita
-            })
+        etag = etag_condominio(condominio)
+        cached = non_modificato(etag)
+        if cached:
+            return cached
 
-        return jsonify(result), 200
+        conn = get_read_db(condominio)
+        try:
+            unita = UnitaImmobiliare.get_by_condominio(condo_id, conn=conn)
+        finally:
+            conn.close()
+        return con_etag(jsonify(serializza_unita(unita)), etag), 200
 
     except Exception as e:
         log_error(str(e), f'get_unita_condominio {condo_id}')
@@ -340,20 +630,17 @@ def get_persone(condo_id):
         if condominio.user_id != request.current_user_id:
             return jsonify({'message': 'Non autorizzato'}), 403
 
-        persone = Persona.get_by_condominio(condo_id)
+        etag = etag_condominio(condominio)
+        cached = non_modificato(etag)
+        if cached:
+            return cached
 
-        result = []
-        for persona in persone:
-            result.append({
-                'id': persona.id,
-                'nome': persona.nome,
-                'cognome': persona.cognome,
-                'email': persona.email,
-                'tipo_persona': persona.tipo_persona,
-                'unita_id': persona.unita_id
-            })
-
-        return jsonify(result), 200
+        conn = get_read_db(condominio)
+        try:
+            persone = Persona.get_by_condominio(condo_id, conn=conn)
+        finally:
+            conn.close()
+        return con_etag(jsonify(serializza_persone(persone)), etag), 200
 
     except Exception as e:
         log_error(str(e), f'get_persone {condo_id}')
@@ -493,23 +780,18 @@ def get_millesimi(condo_id):
         if condominio.user_id != request.current_user_id:
             return jsonify({'message': 'Non autorizzato'}), 403
 
-        # Ottieni millesimi per tutte le tabelle
-        millesimi_completi = {}
-        for tabella in ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'L']:
-            millesimi_completi[tabella] = Millesemo.get_by_condominio_tabella(condo_id, tabella)
-
-        # Formatta risultato
-        result = {}
-        for tabella, millesimi_list in millesimi_completi.items():
-            result[tabella] = []
-            for millesimo in millesimi_list:
-                result[tabella].append({
-                    'id': millesimo.id,
-                    'unita_id': millesimo.unita_id,
-                    'valore': millesimo.valore
-                })
+        etag = etag_condominio(condominio)
+        cached = non_modificato(etag)
+        if cached:
+            return cached
 
-        return jsonify(result), 200
+        # Millesimi di tutte le tabelle con una sola query
+        conn = get_read_db(condominio)
+        try:
+            millesimi = Millesemo.get_by_condominio(condo_id, conn=conn)
+        finally:
+            conn.close()
+        return con_etag(jsonify(serializza_millesimi(millesimi)), etag), 200
 
     except Exception as e:
         log_error(str(e), f'get_millesimi {condo_id}')
@@ -530,6 +812,11 @@ def get_millesimi_tabella(condo_id, tabella):
         if condominio.user_id != request.current_user_id:
             return jsonify({'message': 'Non autorizzato'}), 403
 
+        etag = etag_condominio(condominio)
+        cached = non_modificato(etag)
+        if cached:
+            return cached
+
         millesimi = Millesemo.get_by_condominio_tabella(condo_id, tabella)
 
         result = []
@@ -540,7 +827,7 @@ def get_millesimi_tabella(condo_id, tabella):
                 'valore': millesimo.valore
             })
 
-        return jsonify(result), 200
+        return con_etag(jsonify(result), etag), 200
 
     except Exception as e:
         log_error(str(e), f'get_millesimi_tabella {condo_id} {tabella}')
@@ -668,11 +955,13 @@ def validate_millesimi_totali(condo_id):
         if condominio.user_id != request.current_user_id:
             return jsonify({'message': 'Non autorizzato'}), 403
 
-        result = {}
-        for tabella in ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'L']:
-            result[tabella] = Millesemo.validate_total(condo_id, tabella)
+        etag = etag_condominio(condominio)
+        cached = non_modificato(etag)
+        if cached:
+            return cached
 
-        return jsonify({'validazione': result}), 200
+        result = serializza_validazione(Millesemo.validate_totals(condo_id))
+        return con_etag(jsonify({'validazione': result}), etag), 200
 
     except Exception as e:
         log_error(str(e), f'validate_millesimi_totali {condo_id}')
@@ -694,28 +983,22 @@ def get_spese(condo_id):
         if condominio.user_id != request.current_user_id:
             return jsonify({'message': 'Non autorizzato'}), 403
 
+        etag = etag_condominio(condominio)
+        cached = non_modificato(etag)
+        if cached:
+            return cached
+
         # Filtro opzionale per tabella
         tabella_filter = request.args.get('tabella')
         if tabella_filter and tabella_filter not in ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'L']:
             return jsonify({'message': 'Tabella non valida'}), 400
 
-        spese = Spesa.get_by_condominio(condo_id, tabella_filter)
-
-        result = []
-        for spesa in spese:
-            result.append({
-                'id': spesa.id,
-                'descrizione': spesa.descrizione,
-                'importo': spesa.importo,
-                'data_spesa': spesa.data_spesa,
-                'tabella_millesimi': spesa.tabella_millesimi,
-                'logica_pi': spesa.logica_pi,
-                'percentuale_proprietario': spesa.percentuale_proprietario,
-                'percentuale_inquilino': spesa.percentuale_inquilino,
-                'created_at': spesa.created_at
-            })
-
-        return jsonify(result), 200
+        conn = get_read_db(condominio)
+        try:
+            spese = Spesa.get_by_condominio(condo_id, tabella_filter, conn=conn)
+        finally:
+            conn.close()
+        return con_etag(jsonify(serializza_spese(spese)), etag), 200
 
     except Exception as e:
         log_error(str(e), f'get_spese {condo_id}')
@@ -773,6 +1056,44 @@ def create_spesa(condo_id):
         log_error(str(e), f'create_spesa {condo_id}')
         return jsonify({'message': 'Errore del server'}), 500
 
+@app.route('/api/condominii/<int:condo_id>/spese/import', methods=['POST'])
+@token_required
+def import_spese(condo_id):
+    """Import massivo di spese da file CSV/XLSX (campo multipart 'file')"""
+    try:
+        # Verifica proprietà condominio
+        condominio = Condominio.find_by_id(condo_id)
+        if not condominio:
+            return jsonify({'message': 'Condominio non trovato'}), 404
+        if condominio.user_id != request.current_user_id:
+            return jsonify({'message': 'Non autorizzato'}), 403
+
+        file = request.files.get('file')
+        if not file or not file.filename:
+            return jsonify({'message': 'File mancante'}), 400
+
+        formato = formato_file(file.filename)
+        if not formato:
+            return jsonify({'message': 'Formato non supportato (usa .csv o .xlsx)'}), 400
+
+        dry_run = request.args.get('dry_run') in ('1', 'true')
+
+        try:
+            report = importa_spese(condo_id, leggi_righe(file.stream, formato), dry_run=dry_run)
+        except ValueError as e:
+            # Intestazione non valida, file vuoto o non leggibile
+            return jsonify({'message': 'File non valido', 'errors': [str(e)]}), 400
+
+        return jsonify({
+            'message': 'Validazione completata' if dry_run else 'Import completato',
+            'dry_run': dry_run,
+            **report
+        }), 200
+
+    except Exception as e:
+        log_error(str(e), f'import_spese {condo_id}')
+        return jsonify({'message': 'Errore del server'}), 500
+
 @app.route('/api/spese/<int:spesa_id>', methods=['PUT'])
 @token_required
 def update_spesa(spesa_id):
@@ -850,6 +1171,69 @@ def delete_spesa(spesa_id):
 # RIPARTIZIONE ENDPOINTS
 # ======================
 
+def risposta_ripartizione(condo_id, tabella_filter=None):
+    """Ripartizione totale o di una tabella (ricalcola ripartizione_spese).
+
+    Condiviso dall'endpoint Flask e dall'handler asincrono di asgi.py.
+    """
+    # Calcola ripartizione completa o per tabella specifica
+    if tabella_filter:
+        # Calcola solo per la tabella specifica
+        from database_universal import get_db
+        conn = get_db()
+        cursor = conn.cursor()
+
+        # Assicura che la tabella ripartizione sia aggiornata
+        try:
+            calculate_ripartizione_completa(condo_id)
+        except Exception as _:
+            pass
+
+        # Calcola ripartizione solo per quella tabella
+        persone = Persona.get_by_condominio(condo_id)
+        ripartizione = {}
+
+        for persona in persone:
+            # Filtra spese solo per quella tabella
+            exec_sql(cursor, """
+                SELECT s.*, rs.importo_dovuto
+                FROM spese s
+                LEFT JOIN ripartizione_spese rs ON s.id = rs.spesa_id
+                WHERE s.condominio_id = ? AND s.tabella_millesimi = ? AND rs.persona_id = ?
+                ORDER BY s.created_at
+            """, (condo_id, tabella_filter, persona.id))
+
+            totale_persona = somma(row['importo_dovuto'] for row in cursor.fetchall() if row['importo_dovuto'])
+
+            if totale_persona > 0:
+                ripartizione[persona.id] = totale_persona
+
+        conn.close()
+    else:
+        # Calcola ripartizione completa per tutte le tabelle
+        ripartizione = calculate_ripartizione_completa(condo_id)
+
+    # Formatta risultato con dettagli persone
+    persone = Persona.get_by_condominio(condo_id)
+    result = []
+
+    for persona in persone:
+        importo_dovuto = ripartizione.get(persona.id, 0)
+        if importo_dovuto > 0:
+            result.append({
+                'persona_id': persona.id,
+                'nome': persona.nome,
+                'cognome': persona.cognome,
+                'tipo_persona': persona.tipo_persona,
+                'importo_dovuto': importo_dovuto
+            })
+
+    return {
+        'ripartizione': result,
+        'totale': somma(ripartizione.values()),
+        'tabella_filter': tabella_filter
+    }
+
 @app.route('/api/condominii/<int:condo_id>/ripartizione', methods=['GET'])
 @token_required
 def get_ripartizione(condo_id):
@@ -862,71 +1246,18 @@ def get_ripartizione(condo_id):
         if condominio.user_id != request.current_user_id:
             return jsonify({'message': 'Non autorizzato'}), 403
 
+        etag = etag_condominio(condominio)
+        cached = non_modificato(etag)
+        if cached:
+            return cached
+
         # Filtro opzionale per tabella
         tabella_filter = request.args.get('tabella')
         if tabella_filter and tabella_filter not in ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'L']:
             return jsonify({'message': 'Tabella non valida'}), 400
 
-        # Calcola ripartizione completa o per tabella specifica
-        if tabella_filter:
-            # Calcola solo per la tabella specifica
-            from database_universal import get_db
-            conn = get_db()
-            cursor = conn.cursor()
-
-            # Assicura che la tabella ripartizione sia aggiornata
-            try:
-                calculate_ripartizione_completa(condo_id)
-            except Exception as _:
-                pass
-
-            # Calcola ripartizione solo per quella tabella
-            persone = Persona.get_by_condominio(condo_id)
-            ripartizione = {}
-
-            for persona in persone:
-                # Filtra spese solo per quella tabella
-                exec_sql(cursor, """
-                    SELECT s.*, rs.importo_dovuto
-                    FROM spese s
-                    LEFT JOIN ripartizione_spese rs ON s.id = rs.spesa_id
-                    WHERE s.condominio_id = ? AND s.tabella_millesimi = ? AND rs.persona_id = ?
-                    ORDER BY s.created_at
-                """, (condo_id, tabella_filter, persona.id))
-
-                totale_persona = 0
-                for row in cursor.fetchall():
-                    if row['importo_dovuto']:
-                        totale_persona += row['importo_dovuto']
-
-                if totale_persona > 0:
-                    ripartizione[persona.id] = totale_persona
-
-            conn.close()
-        else:
-            # Calcola ripartizione completa per tutte le tabelle
-            ripartizione = calculate_ripartizione_completa(condo_id)
-
-        # Formatta risultato con dettagli persone
-        persone = Persona.get_by_condominio(condo_id)
-        result = []
-
-        for persona in persone:
-            importo_dovuto = ripartizione.get(persona.id, 0)
-            if importo_dovuto > 0:
-                result.append({
-                    'persona_id': persona.id,
-                    'nome': persona.nome,
-                    'cognome': persona.cognome,
-                    'tipo_persona': persona.tipo_persona,
-                    'importo_dovuto': importo_dovuto
-                })
-
-        return jsonify({
-            'ripartizione': result,
-            'totale': sum(ripartizione.values()),
-            'tabella_filter': tabella_filter
-        }), 200
+        ripartizione = risposta_ripartizione(condo_id, tabella_filter)
+        return con_etag(jsonify(ripartizione), etag), 200
 
     except Exception as e:
         log_error(str(e), f'get_ripartizione {condo_id}')
@@ -944,6 +1275,11 @@ def get_ripartizione_dettagliata(condo_id):
         if condominio.user_id != request.current_user_id:
             return jsonify({'message': 'Non autorizzato'}), 403
 
+        etag = etag_condominio(condominio)
+        cached = non_modificato(etag)
+        if cached:
+            return cached
+
         # Filtro opzionale per tabella
         tabella_filter = request.args.get('tabella')
         if tabella_filter and tabella_filter not in ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'L']:
@@ -965,17 +1301,6 @@ def get_ripartizione_dettagliata(condo_id):
 
         persone_list = cursor.fetchall()
 
-        # Mappa di ruoli presenti per unità per gestire il caso 50/50
-        unita_ruoli = {}
-        for p in persone_list:
-            uid = p['unita_id']
-            if uid not in unita_ruoli:
-                unita_ruoli[uid] = set()
-            if p['tipo_persona'] == 'proprietario_inquilino':
-                unita_ruoli[uid].update({'proprietario', 'inquilino'})
-            else:
-                unita_ruoli[uid].add(p['tipo_persona'])
-
         # 2. Ottieni le spese del condominio (con eventuale filtro tabella)
         if tabella_filter:
             exec_sql(cursor, '''
@@ -994,8 +1319,33 @@ def get_ripartizione_dettagliata(condo_id):
 
         spese_list = cursor.fetchall()
 
+        # 3. Millesimi di tutte le unità in una sola query: (tabella, unita_id) -> valore
+        exec_sql(cursor, '''
+            SELECT tabella, unita_id, valore FROM millesimi
+            WHERE condominio_id = ?
+        ''', (condo_id,))
+        millesimi_map = {(row['tabella'], row['unita_id']): row['valore'] for row in cursor.fetchall()}
+
+        # 4. Quote in centesimi di ogni spesa (stesse regole e arrotondamento della ripartizione completa)
+        profilo = get_profilo_ruoli(cursor, condo_id)
+        persone_per_tabella = {}
+        quote_spese = {}
+        for spesa in spese_list:
+            tabella = spesa['tabella_millesimi']
+            if tabella not in persone_per_tabella:
+                persone_tabella = [{
+                    'persona_id': p['id'],
+                    'unita_id': p['unita_id'],
+                    'tipo_persona': p['tipo_persona'],
+                    'millesimi': millesimi_map.get((tabella, p['unita_id']))
+                } for p in persone_list]
+                persone_per_tabella[tabella] = persone_tabella
+            quote_spese[spesa['id']] = ripartisci_spesa(
+                spesa['importo'], spesa['logica_pi'], spesa['percentuale_proprietario'],
+                spesa['percentuale_inquilino'], persone_per_tabella[tabella], profilo)
+
         result = []
-        totale_generale = 0.0
+        totale_generale_cent = 0
 
         for persona in persone_list:
             persona_data = {
@@ -1007,57 +1357,33 @@ def get_ripartizione_dettagliata(condo_id):
                 'totale_dovuto': 0.0,
                 'spese_per_tabella': {}
             }
+            totale_persona_cent = 0
+            totali_tabella_cent = {}
 
             for spesa in spese_list:
-                # Ottieni millesimi dell'unità per questa tabella
-                exec_sql(cursor, '''
-                    SELECT valore FROM millesimi
-                    WHERE unita_id = ? AND tabella = ? AND condominio_id = ?
-                ''', (persona['unita_id'], spesa['tabella_millesimi'], condo_id))
-
-                millesimo_result = cursor.fetchone()
-                if not millesimo_result:
+                # Millesimi dell'unità per questa tabella
+                tabella = spesa['tabella_millesimi']
+                if (tabella, persona['unita_id']) not in millesimi_map:
                     continue
 
-                millesimi = millesimo_result['valore']
-
-                # Calcola percentuale in base alla logica P/I
-                if spesa['logica_pi'] == 'proprietario':
-                    percentuale = 100 if persona['tipo_persona'] in ['proprietario', 'proprietario_inquilino'] else 0
-                elif spesa['logica_pi'] == 'inquilino':
-                    percentuale = 100 if persona['tipo_persona'] in ['inquilino', 'proprietario_inquilino'] else 0
-                elif spesa['logica_pi'] == '50/50':
-                    # Se persona ricopre entrambi i ruoli, copre il 100%
-                    if persona['tipo_persona'] == 'proprietario_inquilino':
-                        percentuale = 100
-                    else:
-                        ruoli_presenti = unita_ruoli.get(persona['unita_id'], set())
-                        if 'proprietario' in ruoli_presenti and 'inquilino' in ruoli_presenti:
-                            percentuale = 50
-                        else:
-                            percentuale = 100
-                else:  # personalizzato
-                    percentuale = spesa['percentuale_proprietario'] if persona['tipo_persona'] in ['proprietario', 'proprietario_inquilino'] else spesa['percentuale_inquilino']
-
-                # Calcola importo dovuto per questa spesa
-                importo_dovuto = (spesa['importo'] * millesimi * percentuale / 100) / 1000
-                importo_dovuto = round(importo_dovuto, 2)
+                millesimi = millesimi_map[(tabella, persona['unita_id'])]
+                centesimi = quote_spese[spesa['id']].get(persona['id'], 0)
 
                 # Aggiungi alle spese per tabella
-                tabella = spesa['tabella_millesimi']
                 if tabella not in persona_data['spese_per_tabella']:
                     persona_data['spese_per_tabella'][tabella] = {
                         'tabella': tabella,
                         'totale_tabella': 0.0,
                         'spese': []
                     }
+                    totali_tabella_cent[tabella] = 0
 
-                persona_data['spese_per_tabella'][tabella]['totale_tabella'] += importo_dovuto
+                totali_tabella_cent[tabella] += centesimi
                 persona_data['spese_per_tabella'][tabella]['spese'].append({
                     'spesa_id': spesa['id'],
                     'data_spesa': spesa['data_formatted'],
                     'importo_totale': spesa['importo'],
-                    'importo_dovuto': importo_dovuto,
+                    'importo_dovuto': from_cents(centesimi),
                     'logica_pi': spesa['logica_pi'],
                     'percentuale_proprietario': spesa['percentuale_proprietario'],
                     'percentuale_inquilino': spesa['percentuale_inquilino'],
@@ -1065,30 +1391,26 @@ def get_ripartizione_dettagliata(condo_id):
                     'descrizione': spesa['descrizione']
                 })
 
-                persona_data['totale_dovuto'] += importo_dovuto
+                totale_persona_cent += centesimi
 
-            # Converti le spese per tabella da dizionario a lista
+            # Totali calcolati in centesimi: nessun arrotondamento successivo necessario
+            for tabella, tabella_data in persona_data['spese_per_tabella'].items():
+                tabella_data['totale_tabella'] = from_cents(totali_tabella_cent[tabella])
             persona_data['spese_per_tabella'] = list(persona_data['spese_per_tabella'].values())
-
-            # Arrotonda il totale
-            persona_data['totale_dovuto'] = round(persona_data['totale_dovuto'], 2)
-
-            # Arrotonda i totali per tabella e gli importi delle singole spese
-            for tabella_data in persona_data['spese_per_tabella']:
-                tabella_data['totale_tabella'] = round(tabella_data.get('totale_tabella', 0) or 0, 2)
-                for sd in tabella_data['spese']:
-                    sd['importo_dovuto'] = round(float(sd.get('importo_dovuto', 0) or 0), 2)
+            persona_data['totale_dovuto'] = from_cents(totale_persona_cent)
 
             result.append(persona_data)
-            totale_generale += persona_data['totale_dovuto']
+            totale_generale_cent += totale_persona_cent
+
+        totale_generale = from_cents(totale_generale_cent)
 
         conn.close()
 
-        return jsonify({
+        return con_etag(jsonify({
             'ripartizione_dettagliata': result,
             'totale_generale': totale_generale,
             'tabella_filter': tabella_filter
-        }), 200
+        }), etag), 200
 
     except Exception as e:
         log_error(str(e), f'get_ripartizione_dettagliata {condo_id}')
@@ -1131,8 +1453,6 @@ def get_ripartizione_persona(condo_id, persona_id):
         conn.close()
 
         result = []
-        totale_dovuto = 0
-
         for dettaglio in dettagli:
             result.append({
                 'spesa_id': dettaglio['spesa_id'],
@@ -1142,7 +1462,6 @@ def get_ripartizione_persona(condo_id, persona_id):
                 'importo_dovuto': dettaglio['importo_dovuto'],
                 'anno': dettaglio['anno']
             })
-            totale_dovuto += dettaglio['importo_dovuto']
 
         return jsonify({
             'persona': {
@@ -1152,7 +1471,7 @@ def get_ripartizione_persona(condo_id, persona_id):
                 'tipo_persona': persona.tipo_persona
             },
             'dettagli': result,
-            'totale_dovuto': totale_dovuto
+            'totale_dovuto': somma(d['importo_dovuto'] for d in result)
         }), 200
 
     except Exception as e:
@@ -1176,7 +1495,7 @@ def recalcola_ripartizione(condo_id):
 
         return jsonify({
             'message': 'Ripartizione ricalcolata con successo',
-            'totale': sum(ripartizione.values())
+            'totale': somma(ripartizione.values())
         }), 200
 
     except Exception as e:
@@ -1199,22 +1518,13 @@ def get_preventivi(condo_id):
         if condominio.user_id != request.current_user_id:
             return jsonify({'message': 'Non autorizzato'}), 403
 
-        preventivi = PreventivoAnnuale.get_by_condominio(condo_id)
-
-        result = []
-        for preventivo in preventivi:
-            result.append({
-                'id': preventivo.id,
-                'anno': preventivo.anno,
-                'importo_totale_preventivato': preventivo.importo_totale_preventivato,
-                'importo_totale_speso': preventivo.importo_totale_speso,
-                'differenza': preventivo.differenza,
-                'note': preventivo.note,
-                'created_at': preventivo.created_at,
-                'updated_at': preventivo.updated_at
-            })
+        etag = etag_condominio(condominio)
+        cached = non_modificato(etag)
+        if cached:
+            return cached
 
-        return jsonify(result), 200
+        preventivi = PreventivoAnnuale.get_by_condominio(condo_id)
+        return con_etag(jsonify(serializza_preventivi(preventivi)), etag), 200
 
     except Exception as e:
         log_error(str(e), f'get_preventivi {condo_id}')
@@ -1267,6 +1577,11 @@ def get_spese_preventivate(condo_id, anno):
         if condominio.user_id != request.current_user_id:
             return jsonify({'message': 'Non autorizzato'}), 403
 
+        etag = etag_condominio(condominio)
+        cached = non_modificato(etag)
+        if cached:
+            return cached
+
         spese = SpesaPreventivata.get_by_condominio_anno(condo_id, anno)
 
         result = []
@@ -1286,7 +1601,7 @@ def get_spese_preventivate(condo_id, anno):
                 'created_at': spesa.created_at
             })
 
-        return jsonify(result), 200
+        return con_etag(jsonify(result), etag), 200
 
     except Exception as e:
         log_error(str(e), f'get_spese_preventivate {condo_id} {anno}')
@@ -1315,13 +1630,7 @@ def create_spesa_preventivata(condo_id):
 
         # Trova o crea preventivo per l'anno
         anno = data.get('anno', datetime.now().year + 1)
-        preventivi = PreventivoAnnuale.get_by_condominio(condo_id)
-        preventivo = None
-
-        for p in preventivi:
-            if p.anno == anno:
-                preventivo = p
-                break
+        preventivo = PreventivoAnnuale.find_by_condominio_anno(condo_id, anno, condominio.data_version)
 
         if not preventivo:
             preventivo = PreventivoAnnuale(
@@ -1486,6 +1795,11 @@ def get_calcolo_preventivo(condo_id, anno):
         if condominio.user_id != request.current_user_id:
             return jsonify({'message': 'Non autorizzato'}), 403
 
+        etag = etag_condominio(condominio)
+        cached = non_modificato(etag)
+        if cached:
+            return cached
+
         # Calcola ripartizione preventivo
         calc = calculate_ripartizione_preventivo(condo_id, anno)
 
@@ -1515,17 +1829,52 @@ def get_calcolo_preventivo(condo_id, anno):
                 'importo_dovuto': round(float(item.get('importo_previsto_dovuto', 0) or 0), 2)
             })
 
-        return jsonify({
+        return con_etag(jsonify({
             'message': 'Calcolo preventivo completato',
             'ripartizione': rip_ui,
             # rinomina chiave per il frontend
             'totale': round(float(calc.get('totale_previsto', 0) or 0), 2)
-        }), 200
+        }), etag), 200
 
     except Exception as e:
         log_error(str(e), f'get_calcolo_preventivo {condo_id} {anno}')
         return jsonify({'message': 'Errore del server'}), 500
 
+@app.route('/api/condominii/<int:condo_id>/simulazione-preventivo', methods=['POST'])
+@token_required
+def simula_preventivo(condo_id):
+    """Simula la ripartizione di una bozza di preventivo (nessuna scrittura)"""
+    try:
+        # Verifica proprietà condominio
+        condominio = Condominio.find_by_id(condo_id)
+        if not condominio:
+            return jsonify({'message': 'Condominio non trovato'}), 404
+        if condominio.user_id != request.current_user_id:
+            return jsonify({'message': 'Non autorizzato'}), 403
+
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'message': 'Dati mancanti'}), 400
+
+        # Persone e millesimi dalla cache, validi per la versione dati corrente
+        dati = get_dati_ripartizione(condo_id, condominio.data_version)
+
+        errors = validate_simulazione_data(data, dati['unita_ids'])
+        if errors:
+            return jsonify({'message': 'Dati non validi', 'errors': errors}), 400
+
+        risultato = simula_ripartizione_preventivo(dati, data['spese'], data.get('millesimi'))
+
+        return jsonify({
+            'message': 'Simulazione completata',
+            'data_version': condominio.data_version,
+            **risultato
+        }), 200
+
+    except Exception as e:
+        log_error(str(e), f'simula_preventivo {condo_id}')
+        return jsonify({'message': 'Errore del server'}), 500
+
 @app.route('/api/condominii/<int:condo_id>/analisi-anno-successivo', methods=['GET'])
 @token_required
 def get_analisi_anno_successivo(condo_id):
@@ -1538,21 +1887,110 @@ def get_analisi_anno_successivo(condo_id):
         if condominio.user_id != request.current_user_id:
             return jsonify({'message': 'Non autorizzato'}), 403
 
+        etag = etag_condominio(condominio, datetime.now().year)
+        cached = non_modificato(etag)
+        if cached:
+            return cached
+
         # Parametro opzionale anno di riferimento
         anno_riferimento = request.args.get('anno_riferimento', type=int)
 
         # Calcola analisi per l'anno successivo
         analisi = calcolo_analisi_anno_successivo(condo_id, anno_riferimento)
 
-        return jsonify({
+        return con_etag(jsonify({
             'message': 'Analisi anno successivo completata',
             'data': analisi
-        }), 200
+        }), etag), 200
 
     except Exception as e:
         log_error(str(e), f'get_analisi_anno_successivo {condo_id}')
         return jsonify({'message': 'Errore del server'}), 500
 
+@app.route('/api/condominii/<int:condo_id>/analytics', methods=['GET'])
+@token_required
+def get_analytics(condo_id):
+    """Andamento pluriennale delle spese per anno, mese, tabella e logica P/I"""
+    try:
+        # Verifica proprietà condominio
+        condominio = Condominio.find_by_id(condo_id)
+        if not condominio:
+            return jsonify({'message': 'Condominio non trovato'}), 404
+        if condominio.user_id != request.current_user_id:
+            return jsonify({'message': 'Non autorizzato'}), 403
+
+        # Default: ultimi 5 anni fino all'anno corrente
+        anno_a = request.args.get('anno_a', type=int) or datetime.now().year
+        anno_da = request.args.get('anno_da', type=int) or anno_a - 4
+        if anno_da > anno_a or anno_a - anno_da >= 50:
+            return jsonify({'message': 'Intervallo di anni non valido (massimo 50 anni)'}), 400
+
+        etag = etag_condominio(condominio, 'analytics', anno_da, anno_a)
+        cached = non_modificato(etag)
+        if cached:
+            return cached
+
+        analytics = calcolo_analytics_spese(condo_id, anno_da, anno_a, condominio.data_version)
+
+        return con_etag(jsonify({
+            'message': 'Analytics completate',
+            'data': analytics
+        }), etag), 200
+
+    except Exception as e:
+        log_error(str(e), f'get_analytics {condo_id}')
+        return jsonify({'message': 'Errore del server'}), 500
+
+# Dimensione massima di una pagina di risultati della ricerca
+RICERCA_MAX_PER_PAGE = 100
+
+@app.route('/api/condominii/<int:condo_id>/ricerca', methods=['GET'])
+@token_required
+def cerca_spese(condo_id):
+    """Ricerca full-text su spese e spese preventivate (prefissi, filtri, paginazione)"""
+    try:
+        # Verifica proprietà condominio
+        condominio = Condominio.find_by_id(condo_id)
+        if not condominio:
+            return jsonify({'message': 'Condominio non trovato'}), 404
+        if condominio.user_id != request.current_user_id:
+            return jsonify({'message': 'Non autorizzato'}), 403
+
+        errors = validate_ricerca_params(request.args)
+        if errors:
+            return jsonify({'message': 'Parametri non validi', 'errors': errors}), 400
+
+        tipo = request.args.get('tipo', 'tutte')
+        tipi = {'spese': ('spesa',), 'preventivate': ('preventivata',)}.get(tipo, ('spesa', 'preventivata'))
+        page = int(request.args.get('page', 1))
+        per_page = min(int(request.args.get('per_page', 20)), RICERCA_MAX_PER_PAGE)
+
+        conn = get_read_db(condominio)
+        try:
+            risultati, totale = RicercaSpese.cerca(
+                condo_id, parole_ricerca(request.args.get('q')), tipi,
+                tabella=request.args.get('tabella'),
+                data_da=request.args.get('data_da'),
+                data_a=request.args.get('data_a'),
+                limit=per_page,
+                offset=(page - 1) * per_page,
+                conn=conn
+            )
+        finally:
+            conn.close()
+
+        return jsonify({
+            'risultati': risultati,
+            'totale': totale,
+            'page': page,
+            'per_page': per_page,
+            'pages': (totale + per_page - 1) // per_page
+        }), 200
+
+    except Exception as e:
+        log_error(str(e), f'cerca_spese {condo_id}')
+        return jsonify({'message': 'Errore del server'}), 500
+
 # ======================
 # IMPORT/EXPORT ENDPOINTS
 # ======================
@@ -1569,15 +2007,15 @@ def export_condominio(condo_id):
         if condominio.user_id != request.current_user_id:
             return jsonify({'message': 'Non autorizzato'}), 403
 
-        # Esporta dati
-        export_json = export_condominio_json(condo_id)
-        if not export_json:
-            return jsonify({'message': 'Errore esportazione'}), 500
-
-        return jsonify({
-            'message': 'Export completato con successo',
-            'data': export_json
-        }), 200
+        # Il documento è già JSON: viene inviato così com'è, in streaming
+        filename = f"export_{condominio.nome.replace(' ', '_')}_{datetime.now().strftime('%d%m%Y')}.json"
+        response = Response(
+            stream_with_context(nello_shard_corrente(
+                pezzo.encode('utf-8') for pezzo in genera_export_condominio_json(condo_id))),
+            mimetype='application/json'
+        )
+        response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
 
     except Exception as e:
         log_error(str(e), f'export_condominio {condo_id}')
@@ -1592,6 +2030,10 @@ def export_condominio(condo_id):
 def stampa_spese(condo_id):
     """Genera documento Word con elenco spese"""
     try:
+        from docx import Document
+        from docx.enum.text import WD_ALIGN_PARAGRAPH
+        from docx.enum.table import WD_TABLE_ALIGNMENT
+
         # Verifica proprietà condominio
         condominio = Condominio.find_by_id(condo_id)
         if not condominio:
@@ -1635,185 +2077,179 @@ def stampa_spese(condo_id):
 
         doc.add_paragraph()  # Spazio
 
-        # Ottieni spese con raggruppamento per tabella millesimi
-        from database_universal import get_db
-        conn = get_db()
-        cursor = conn.cursor()
+        # Riepilogo per tabella con una query aggregata, poi le spese in streaming
+        from database_universal import get_read_db, begin_read_snapshot, iter_rows
+        filtro_sql = " AND s.tabella_millesimi = ?" if tabella_filter else ""
+        params = (condo_id, tabella_filter) if tabella_filter else (condo_id,)
 
-        if tabella_filter:
-            exec_sql(cursor, """
-                SELECT s.*
-                FROM spese s
-                WHERE s.condominio_id = ? AND s.tabella_millesimi = ?
-                ORDER BY s.data_spesa DESC, s.created_at DESC
-            """, (condo_id, tabella_filter))
-        else:
-            exec_sql(cursor, """
-                SELECT s.*
+        conn = get_read_db(condominio)
+        try:
+            begin_read_snapshot(conn)
+            cursor = conn.cursor()
+            exec_sql(cursor, f"""
+                SELECT s.tabella_millesimi, COUNT(*) AS numero_spese, SUM(s.importo) AS totale_tabella
                 FROM spese s
-                WHERE s.condominio_id = ?
-                ORDER BY s.tabella_millesimi, s.data_spesa DESC, s.created_at DESC
-            """, (condo_id,))
-
-        spese_data = cursor.fetchall()
-        conn.close()
-
-        if not spese_data:
-            doc.add_paragraph('Nessuna spesa trovata per i criteri selezionati.')
-        else:
-            # Raggruppa spese per tabella millesimi
-            spese_per_tabella = {}
-            totale_generale = 0
-
-            for spesa_row in spese_data:
-                tabella = spesa_row['tabella_millesimi']
-                if tabella not in spese_per_tabella:
-                    spese_per_tabella[tabella] = {
-                        'tabella': tabella,
-                        'totale_tabella': 0,
-                        'spese': []
-                    }
-
-                # Gestione del formato data
-                if hasattr(spesa_row['data_spesa'], 'strftime'):
-                    data_formattata = spesa_row['data_spesa'].strftime('%d/%m/%Y')
-                elif isinstance(spesa_row['data_spesa'], str):
-                    data_formattata = spesa_row['data_spesa']
-                else:
-                    data_formattata = 'N/D'
-
-                spesa_dettaglio = {
-                    'id': spesa_row['id'],
-                    'descrizione': spesa_row['descrizione'],
-                    'importo': spesa_row['importo'],
-                    'data_spesa': data_formattata,
-                    'logica_pi': spesa_row['logica_pi'],
-                    'percentuale_proprietario': spesa_row['percentuale_proprietario'],
-                    'percentuale_inquilino': spesa_row['percentuale_inquilino'],
-                    'created_at': spesa_row['created_at']
-                }
-
-                spese_per_tabella[tabella]['spese'].append(spesa_dettaglio)
-                spese_per_tabella[tabella]['totale_tabella'] += spesa_row['importo']
-                totale_generale += spesa_row['importo']
-
-            # Riepilogo generale
-            doc.add_paragraph()
-            summary_heading = doc.add_heading('RIEPILOGO SPESE PER TABELLA MILLESIMI', level=1)
-            summary_heading.alignment = WD_ALIGN_PARAGRAPH.CENTER
-
-            # Tabella riassuntiva per tabella
-            summary_table = doc.add_table(rows=1, cols=3)
-            summary_table.style = 'Table Grid'
-            summary_table.alignment = WD_TABLE_ALIGNMENT.CENTER
-
-            # Intestazioni tabella riassuntiva
-            hdr_cells = summary_table.rows[0].cells
-            hdr_cells[0].text = 'Tabella Millesimi'
-            hdr_cells[1].text = 'Numero Spese'
-            hdr_cells[2].text = 'Totale Tabella'
-
-            # Formatta intestazioni
-            for cell in hdr_cells:
-                for paragraph in cell.paragraphs:
-                    paragraph.runs[0].bold = True
-
-            for tabella, data in spese_per_tabella.items():
-                row_cells = summary_table.add_row().cells
-                row_cells[0].text = tabella
-                row_cells[1].text = str(len(data['spese']))
-                row_cells[2].text = f'€ {data["totale_tabella"]:.2f}'
-
-            # Totale generale
-            doc.add_paragraph()
-            total_para = doc.add_paragraph()
-            total_para.add_run('TOTALE GENERALE SPESE: ').bold = True
-            total_para.add_run(f'€ {totale_generale:.2f}')
-            total_para.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+                WHERE s.condominio_id = ?{filtro_sql}
+                GROUP BY s.tabella_millesimi
+                ORDER BY s.tabella_millesimi
+            """, params)
+            spese_per_tabella = {
+                row['tabella_millesimi']: {
+                    'numero_spese': row['numero_spese'],
+                    'totale_tabella': somma([row['totale_tabella']])
+                } for row in cursor.fetchall()
+            }
+            totale_generale = somma(data['totale_tabella'] for data in spese_per_tabella.values())
+            numero_spese = sum(data['numero_spese'] for data in spese_per_tabella.values())
 
-            # Dettaglio spese per tabella
-            for tabella, data in spese_per_tabella.items():
-                doc.add_paragraph()
-                doc.add_paragraph().add_run("=" * 80).bold = True
+            if not spese_per_tabella:
+                doc.add_paragraph('Nessuna spesa trovata per i criteri selezionati.')
+            else:
+                # Riepilogo generale
                 doc.add_paragraph()
+                summary_heading = doc.add_heading('RIEPILOGO SPESE PER TABELLA MILLESIMI', level=1)
+                summary_heading.alignment = WD_ALIGN_PARAGRAPH.CENTER
+
+                # Tabella riassuntiva per tabella
+                summary_table = doc.add_table(rows=1, cols=3)
+                summary_table.style = 'Table Grid'
+                summary_table.alignment = WD_TABLE_ALIGNMENT.CENTER
 
-                tabella_heading = doc.add_heading(f'TABELLA MILLESIMI: {tabella}', level=1)
-                tabella_heading.alignment = WD_ALIGN_PARAGRAPH.CENTER
+                # Intestazioni tabella riassuntiva
+                hdr_cells = summary_table.rows[0].cells
+                hdr_cells[0].text = 'Tabella Millesimi'
+                hdr_cells[1].text = 'Numero Spese'
+                hdr_cells[2].text = 'Totale Tabella'
 
-                # Informazioni tabella
-                tabella_info = doc.add_paragraph()
-                tabella_info.add_run('Numero spese: ').bold = True
-                tabella_info.add_run(f'{len(data["spese"])}')
+                # Formatta intestazioni
+                for cell in hdr_cells:
+                    for paragraph in cell.paragraphs:
+                        paragraph.runs[0].bold = True
 
-                tabella_info2 = doc.add_paragraph()
-                tabella_info2.add_run('Totale tabella: ').bold = True
-                tabella_info2.add_run(f'€ {data["totale_tabella"]:.2f}')
+                for tabella, data in spese_per_tabella.items():
+                    row_cells = summary_table.add_row().cells
+                    row_cells[0].text = tabella
+                    row_cells[1].text = str(data['numero_spese'])
+                    row_cells[2].text = f'€ {data["totale_tabella"]:.2f}'
 
+                # Totale generale
                 doc.add_paragraph()
+                total_para = doc.add_paragraph()
+                total_para.add_run('TOTALE GENERALE SPESE: ').bold = True
+                total_para.add_run(f'€ {totale_generale:.2f}')
+                total_para.alignment = WD_ALIGN_PARAGRAPH.RIGHT
 
-                # Tabella dettaglio spese
-                detail_table = doc.add_table(rows=1, cols=6)
-                detail_table.style = 'Table Grid'
-
-                # Intestazioni tabella dettaglio
-                detail_hdr_cells = detail_table.rows[0].cells
-                detail_hdr_cells[0].text = 'Data'
-                detail_hdr_cells[1].text = 'Descrizione'
-                detail_hdr_cells[2].text = 'Importo'
-                detail_hdr_cells[3].text = 'Logica P/I'
-                detail_hdr_cells[4].text = '% Proprietario'
-                detail_hdr_cells[5].text = '% Inquilino'
+                def chiudi_tabella(tabella):
+                    # Subtotale tabella
+                    doc.add_paragraph()
+                    subtotal_para = doc.add_paragraph()
+                    subtotal_para.add_run(f'Subtotale Tabella {tabella}: ').bold = True
+                    subtotal_para.add_run(f'€ {spese_per_tabella[tabella]["totale_tabella"]:.2f}')
+                    subtotal_para.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+                    doc.add_paragraph()
 
-                # Formatta intestazioni
-                for cell in detail_hdr_cells:
-                    for paragraph in cell.paragraphs:
-                        paragraph.runs[0].bold = True
+                # Dettaglio spese per tabella: le righe arrivano ordinate per tabella
+                tabella_corrente = None
+                detail_table = None
+                for spesa_row in iter_rows(conn, f"""
+                    SELECT s.tabella_millesimi, s.descrizione, s.importo, s.data_spesa, s.logica_pi,
+                           s.percentuale_proprietario, s.percentuale_inquilino
+                    FROM spese s
+                    WHERE s.condominio_id = ?{filtro_sql}
+                    ORDER BY s.tabella_millesimi, s.data_spesa DESC, s.created_at DESC
+                """, params):
+                    tabella = spesa_row['tabella_millesimi']
+                    if tabella != tabella_corrente:
+                        if tabella_corrente is not None:
+                            chiudi_tabella(tabella_corrente)
+                        tabella_corrente = tabella
+                        data = spese_per_tabella[tabella]
+
+                        doc.add_paragraph()
+                        doc.add_paragraph().add_run("=" * 80).bold = True
+                        doc.add_paragraph()
+
+                        tabella_heading = doc.add_heading(f'TABELLA MILLESIMI: {tabella}', level=1)
+                        tabella_heading.alignment = WD_ALIGN_PARAGRAPH.CENTER
+
+                        # Informazioni tabella
+                        tabella_info = doc.add_paragraph()
+                        tabella_info.add_run('Numero spese: ').bold = True
+                        tabella_info.add_run(f'{data["numero_spese"]}')
+
+                        tabella_info2 = doc.add_paragraph()
+                        tabella_info2.add_run('Totale tabella: ').bold = True
+                        tabella_info2.add_run(f'€ {data["totale_tabella"]:.2f}')
+
+                        doc.add_paragraph()
+
+                        # Tabella dettaglio spese
+                        detail_table = doc.add_table(rows=1, cols=6)
+                        detail_table.style = 'Table Grid'
+
+                        # Intestazioni tabella dettaglio
+                        detail_hdr_cells = detail_table.rows[0].cells
+                        detail_hdr_cells[0].text = 'Data'
+                        detail_hdr_cells[1].text = 'Descrizione'
+                        detail_hdr_cells[2].text = 'Importo'
+                        detail_hdr_cells[3].text = 'Logica P/I'
+                        detail_hdr_cells[4].text = '% Proprietario'
+                        detail_hdr_cells[5].text = '% Inquilino'
+
+                        # Formatta intestazioni
+                        for cell in detail_hdr_cells:
+                            for paragraph in cell.paragraphs:
+                                paragraph.runs[0].bold = True
+
+                    # Gestione del formato data
+                    if hasattr(spesa_row['data_spesa'], 'strftime'):
+                        data_formattata = spesa_row['data_spesa'].strftime('%d/%m/%Y')
+                    elif isinstance(spesa_row['data_spesa'], str):
+                        data_formattata = spesa_row['data_spesa']
+                    else:
+                        data_formattata = 'N/D'
 
-                for spesa in data['spese']:
                     detail_row_cells = detail_table.add_row().cells
-                    detail_row_cells[0].text = spesa['data_spesa']
-                    detail_row_cells[1].text = spesa['descrizione']
-                    detail_row_cells[2].text = f'€ {spesa["importo"]:.2f}'
-                    detail_row_cells[3].text = spesa['logica_pi'].replace('_', ' ').title()
-                    detail_row_cells[4].text = f'{spesa["percentuale_proprietario"]}%'
-                    detail_row_cells[5].text = f'{spesa["percentuale_inquilino"]}%'
-
-                # Subtotale tabella
+                    detail_row_cells[0].text = data_formattata
+                    detail_row_cells[1].text = spesa_row['descrizione']
+                    detail_row_cells[2].text = f'€ {spesa_row["importo"]:.2f}'
+                    detail_row_cells[3].text = spesa_row['logica_pi'].replace('_', ' ').title()
+                    detail_row_cells[4].text = f'{spesa_row["percentuale_proprietario"]}%'
+                    detail_row_cells[5].text = f'{spesa_row["percentuale_inquilino"]}%'
+
+                if tabella_corrente is not None:
+                    chiudi_tabella(tabella_corrente)
+
+                # Statistiche finali
                 doc.add_paragraph()
-                subtotal_para = doc.add_paragraph()
-                subtotal_para.add_run(f'Subtotale Tabella {tabella}: ').bold = True
-                subtotal_para.add_run(f'€ {data["totale_tabella"]:.2f}')
-                subtotal_para.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+                doc.add_paragraph().add_run("=" * 80).bold = True
                 doc.add_paragraph()
 
-            # Statistiche finali
-            doc.add_paragraph()
-            doc.add_paragraph().add_run("=" * 80).bold = True
-            doc.add_paragraph()
-
-            stats_heading = doc.add_heading('STATISTICHE FINALI', level=1)
-            stats_heading.alignment = WD_ALIGN_PARAGRAPH.CENTER
+                stats_heading = doc.add_heading('STATISTICHE FINALI', level=1)
+                stats_heading.alignment = WD_ALIGN_PARAGRAPH.CENTER
 
-            stats_para = doc.add_paragraph()
-            stats_para.add_run('Numero totale tabelle: ').bold = True
-            stats_para.add_run(f'{len(spese_per_tabella)}')
+                stats_para = doc.add_paragraph()
+                stats_para.add_run('Numero totale tabelle: ').bold = True
+                stats_para.add_run(f'{len(spese_per_tabella)}')
 
-            stats_para2 = doc.add_paragraph()
-            stats_para2.add_run('Numero totale spese: ').bold = True
-            stats_para2.add_run(f'{len(spese_data)}')
+                stats_para2 = doc.add_paragraph()
+                stats_para2.add_run('Numero totale spese: ').bold = True
+                stats_para2.add_run(f'{numero_spese}')
 
-            stats_para3 = doc.add_paragraph()
-            stats_para3.add_run('Importo medio spesa: ').bold = True
-            stats_para3.add_run(f'€ {totale_generale/len(spese_data):.2f}' if len(spese_data) > 0 else '€ 0.00')
+                stats_para3 = doc.add_paragraph()
+                stats_para3.add_run('Importo medio spesa: ').bold = True
+                stats_para3.add_run(f'€ {totale_generale/numero_spese:.2f}' if numero_spese > 0 else '€ 0.00')
 
-            # Note finali
-            doc.add_paragraph()
-            note_para = doc.add_paragraph()
-            note_para.add_run('Note: ').bold = True
-            if tabella_filter:
-                note_para.add_run(f'Questo elenco include solo le spese assegnate alla tabella millesimi {tabella_filter}.')
-            else:
-                note_para.add_run('Questo elenco include tutte le spese del condominio suddivise per tabelle millesimi.')
+                # Note finali
+                doc.add_paragraph()
+                note_para = doc.add_paragraph()
+                note_para.add_run('Note: ').bold = True
+                if tabella_filter:
+                    note_para.add_run(f'Questo elenco include solo le spese assegnate alla tabella millesimi {tabella_filter}.')
+                else:
+                    note_para.add_run('Questo elenco include tutte le spese del condominio suddivise per tabelle millesimi.')
+        finally:
+            conn.close()
 
         # Prepara response
         buffer = BytesIO()
@@ -1840,6 +2276,10 @@ def stampa_spese(condo_id):
 def stampa_ripartizione(condo_id):
     """Genera documento Word con calcolo ripartizione"""
     try:
+        from docx import Document
+        from docx.enum.text import WD_ALIGN_PARAGRAPH
+        from docx.enum.table import WD_TABLE_ALIGNMENT
+
         # Verifica proprietà condominio
         condominio = Condominio.find_by_id(condo_id)
         if not condominio:
@@ -1883,183 +2323,165 @@ def stampa_ripartizione(condo_id):
 
         doc.add_paragraph()  # Spazio
 
-        # Ottieni dati dettagliati come nell'interfaccia web
-        from database_universal import get_db
-        conn = get_db()
-        cursor = conn.cursor()
+        # Totali per persona con una query aggregata, poi il dettaglio in streaming
+        from database_universal import get_read_db, begin_read_snapshot, iter_rows
+        filtro_sql = " AND s.tabella_millesimi = ?" if tabella_filter else ""
+        params = (condo_id, tabella_filter) if tabella_filter else (condo_id,)
 
-        exec_sql(cursor, """
-            SELECT p.*, ui.numero_unita
-            FROM persone p
-            JOIN unita_immobiliari ui ON p.unita_id = ui.id
-            WHERE p.condominio_id = ?
-            ORDER BY ui.numero_unita, p.cognome, p.nome
-        """, (condo_id,))
-
-        persone_data = cursor.fetchall()
-        conn.close()
-
-        risultati = []
-        totale_generale = 0
-
-        for persona_row in persone_data:
-            # Crea oggetto Persona con numero_unita
-            persona = Persona(
-                id=persona_row['id'],
-                nome=persona_row['nome'],
-                cognome=persona_row['cognome'],
-                email=persona_row['email'],
-                tipo_persona=persona_row['tipo_persona'],
-                unita_id=persona_row['unita_id']
-            )
-            # Aggiungi numero_unita come attributo
-            persona.numero_unita = persona_row['numero_unita']
-
-            from database_universal import get_db
-            conn = get_db()
+        conn = get_read_db(condominio)
+        try:
+            begin_read_snapshot(conn)
             cursor = conn.cursor()
 
-            # Ottieni spese per persona con filtro tabella
-            if tabella_filter:
-                exec_sql(cursor, """
-                    SELECT s.*, rs.importo_dovuto
-                    FROM spese s
-                    LEFT JOIN ripartizione_spese rs ON s.id = rs.spesa_id AND rs.persona_id = ?
-                    WHERE s.condominio_id = ? AND s.tabella_millesimi = ?
-                    ORDER BY s.created_at DESC
-                """, (persona.id, condo_id, tabella_filter))
+            exec_sql(cursor, """
+                SELECT p.*, ui.numero_unita
+                FROM persone p
+                JOIN unita_immobiliari ui ON p.unita_id = ui.id
+                WHERE p.condominio_id = ?
+                ORDER BY ui.numero_unita, p.cognome, p.nome, p.id
+            """, (condo_id,))
+            persone_data = cursor.fetchall()
+
+            # Le persone sono elencate solo se esistono spese per i criteri selezionati
+            exec_sql(cursor, f"SELECT 1 FROM spese s WHERE s.condominio_id = ?{filtro_sql} LIMIT 1", params)
+            if not cursor.fetchone():
+                persone_data = []
+
+            exec_sql(cursor, f"""
+                SELECT rs.persona_id, SUM(rs.importo_dovuto) AS totale_dovuto
+                FROM ripartizione_spese rs
+                JOIN spese s ON s.id = rs.spesa_id
+                WHERE s.condominio_id = ? AND rs.importo_dovuto > 0{filtro_sql}
+                GROUP BY rs.persona_id
+            """, params)
+            totali_persona = {row['persona_id']: somma([row['totale_dovuto']]) for row in cursor.fetchall()}
+
+            risultati = []
+            for persona_row in persone_data:
+                # Crea oggetto Persona con numero_unita
+                persona = Persona(
+                    id=persona_row['id'],
+                    nome=persona_row['nome'],
+                    cognome=persona_row['cognome'],
+                    email=persona_row['email'],
+                    tipo_persona=persona_row['tipo_persona'],
+                    unita_id=persona_row['unita_id']
+                )
+                # Aggiungi numero_unita come attributo
+                persona.numero_unita = persona_row['numero_unita']
+                risultati.append({'persona': persona, 'totale_dovuto': totali_persona.get(persona.id, 0)})
+            totale_generale = somma(r['totale_dovuto'] for r in risultati)
+
+            if not risultati:
+                doc.add_paragraph('Nessuna ripartizione trovata per i criteri selezionati.')
             else:
-                exec_sql(cursor, """
-                    SELECT s.*, rs.importo_dovuto
-                    FROM spese s
-                    LEFT JOIN ripartizione_spese rs ON s.id = rs.spesa_id AND rs.persona_id = ?
-                    WHERE s.condominio_id = ?
-                    ORDER BY s.tabella_millesimi, s.created_at DESC
-                """, (persona.id, condo_id))
+                # Riepilogo generale
+                doc.add_paragraph()
+                summary_heading = doc.add_heading('RIEPILOGO GENERALE', level=1)
+                summary_heading.alignment = WD_ALIGN_PARAGRAPH.CENTER
 
-            spese_persona = cursor.fetchall()
-            conn.close()
+                # Tabella riassuntiva
+                summary_table = doc.add_table(rows=1, cols=4)
+                summary_table.style = 'Table Grid'
+                summary_table.alignment = WD_TABLE_ALIGNMENT.CENTER
 
-            if spese_persona:
-                # Raggruppa spese per tabella
-                spese_per_tabella = {}
-                totale_persona = 0
-
-                for spesa in spese_persona:
-                    # Includi solo le spese con importo_dovuto valido
-                    if spesa['importo_dovuto'] is not None and spesa['importo_dovuto'] > 0:
-                        tabella = spesa['tabella_millesimi']
-                        if tabella not in spese_per_tabella:
-                            spese_per_tabella[tabella] = {
-                                'tabella': tabella,
-                                'totale_tabella': 0,
-                                'spese': []
-                            }
-
-                        spesa_dettaglio = {
-                            'spesa_id': spesa['id'],
-                            'descrizione': spesa['descrizione'],
-                            'importo_totale': spesa['importo'],
-                            'importo_dovuto': spesa['importo_dovuto'],
-                            'data_spesa': spesa['data_spesa'],
-                            'logica_pi': spesa['logica_pi']
-                        }
-
-                        spese_per_tabella[tabella]['spese'].append(spesa_dettaglio)
-                        spese_per_tabella[tabella]['totale_tabella'] += spesa['importo_dovuto']
-                        totale_persona += spesa['importo_dovuto']
-
-                # Formatta il risultato per questa persona
-                persona_result = {
-                    'persona': persona,
-                    'totale_dovuto': totale_persona,
-                    'spese_per_tabella': list(spese_per_tabella.values())
-                }
-
-                risultati.append(persona_result)
-                totale_generale += totale_persona
-
-        if not risultati:
-            doc.add_paragraph('Nessuna ripartizione trovata per i criteri selezionati.')
-        else:
-            # Riepilogo generale
-            doc.add_paragraph()
-            summary_heading = doc.add_heading('RIEPILOGO GENERALE', level=1)
-            summary_heading.alignment = WD_ALIGN_PARAGRAPH.CENTER
-
-            # Tabella riassuntiva
-            summary_table = doc.add_table(rows=1, cols=4)
-            summary_table.style = 'Table Grid'
-            summary_table.alignment = WD_TABLE_ALIGNMENT.CENTER
-
-            # Intestazioni tabella riassuntiva
-            hdr_cells = summary_table.rows[0].cells
-            hdr_cells[0].text = 'Unità'
-            hdr_cells[1].text = 'Intestatario'
-            hdr_cells[2].text = 'Tipo'
-            hdr_cells[3].text = 'Totale Dovuto'
-
-            # Formatta intestazioni
-            for cell in hdr_cells:
-                for paragraph in cell.paragraphs:
-                    paragraph.runs[0].bold = True
-
-            for risultato in risultati:
-                row_cells = summary_table.add_row().cells
-                persona = risultato['persona']
-                row_cells[0].text = str(persona.numero_unita)
-                row_cells[1].text = f"{persona.cognome} {persona.nome}"
-                row_cells[2].text = persona.tipo_persona.replace('_', ' ').title()
-                row_cells[3].text = f'€ {risultato["totale_dovuto"]:.2f}'
-
-            # Totale generale
-            doc.add_paragraph()
-            total_para = doc.add_paragraph()
-            total_para.add_run('TOTALE GENERALE: ').bold = True
-            total_para.add_run(f'€ {totale_generale:.2f}')
-            total_para.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+                # Intestazioni tabella riassuntiva
+                hdr_cells = summary_table.rows[0].cells
+                hdr_cells[0].text = 'Unità'
+                hdr_cells[1].text = 'Intestatario'
+                hdr_cells[2].text = 'Tipo'
+                hdr_cells[3].text = 'Totale Dovuto'
 
-            # Dettaglio per persona
-            for i, risultato in enumerate(risultati):
-                doc.add_paragraph()
-                doc.add_paragraph().add_run("=" * 60).bold = True
-                doc.add_paragraph()
+                # Formatta intestazioni
+                for cell in hdr_cells:
+                    for paragraph in cell.paragraphs:
+                        paragraph.runs[0].bold = True
 
-                persona = risultato['persona']
-                persona_heading = doc.add_heading(f'UNITÀ {persona.numero_unita} - {persona.cognome} {persona.nome}', level=1)
-                persona_heading.alignment = WD_ALIGN_PARAGRAPH.CENTER
+                for risultato in risultati:
+                    row_cells = summary_table.add_row().cells
+                    persona = risultato['persona']
+                    row_cells[0].text = str(persona.numero_unita)
+                    row_cells[1].text = f"{persona.cognome} {persona.nome}"
+                    row_cells[2].text = persona.tipo_persona.replace('_', ' ').title()
+                    row_cells[3].text = f'€ {risultato["totale_dovuto"]:.2f}'
 
-                info_para = doc.add_paragraph()
-                info_para.add_run('Tipo: ').bold = True
-                info_para.add_run(persona.tipo_persona.replace('_', ' ').title())
+                # Totale generale
+                doc.add_paragraph()
+                total_para = doc.add_paragraph()
+                total_para.add_run('TOTALE GENERALE: ').bold = True
+                total_para.add_run(f'€ {totale_generale:.2f}')
+                total_para.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+
+                def chiudi_tabella(tabella, subtotale):
+                    # Subtotale tabella
+                    doc.add_paragraph()
+                    subtotal_para = doc.add_paragraph()
+                    subtotal_para.add_run(f'Subtotale Tabella {tabella}: ').bold = True
+                    subtotal_para.add_run(f'€ {from_cents(subtotale):.2f}')
+                    subtotal_para.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+                    doc.add_paragraph()
 
-                info_para2 = doc.add_paragraph()
-                info_para2.add_run('Totale Dovuto: ').bold = True
-                info_para2.add_run(f'€ {risultato["totale_dovuto"]:.2f}')
+                # Quote dovute ordinate come le persone, poi per tabella
+                righe = iter_rows(conn, f"""
+                    SELECT rs.persona_id, s.tabella_millesimi, s.descrizione, s.importo,
+                           s.data_spesa, rs.importo_dovuto
+                    FROM ripartizione_spese rs
+                    JOIN spese s ON s.id = rs.spesa_id
+                    JOIN persone p ON p.id = rs.persona_id
+                    JOIN unita_immobiliari ui ON p.unita_id = ui.id
+                    WHERE s.condominio_id = ? AND rs.importo_dovuto > 0{filtro_sql}
+                    ORDER BY ui.numero_unita, p.cognome, p.nome, p.id, s.tabella_millesimi, s.created_at DESC
+                """, params)
+                spesa = next(righe, None)
+
+                # Dettaglio per persona
+                for risultato in risultati:
+                    doc.add_paragraph()
+                    doc.add_paragraph().add_run("=" * 60).bold = True
+                    doc.add_paragraph()
 
-                doc.add_paragraph()
+                    persona = risultato['persona']
+                    persona_heading = doc.add_heading(f'UNITÀ {persona.numero_unita} - {persona.cognome} {persona.nome}', level=1)
+                    persona_heading.alignment = WD_ALIGN_PARAGRAPH.CENTER
 
-                # Dettaglio spese per tabella
-                for tabella_data in risultato['spese_per_tabella']:
-                    doc.add_paragraph().add_run(f'Tabella Millesimi: {tabella_data["tabella"]}').bold = True
+                    info_para = doc.add_paragraph()
+                    info_para.add_run('Tipo: ').bold = True
+                    info_para.add_run(persona.tipo_persona.replace('_', ' ').title())
 
-                    # Tabella spese per questa tabella
-                    spese_table = doc.add_table(rows=1, cols=4)
-                    spese_table.style = 'Table Grid'
+                    info_para2 = doc.add_paragraph()
+                    info_para2.add_run('Totale Dovuto: ').bold = True
+                    info_para2.add_run(f'€ {risultato["totale_dovuto"]:.2f}')
 
-                    # Intestazioni tabella spese
-                    spese_hdr_cells = spese_table.rows[0].cells
-                    spese_hdr_cells[0].text = 'Data'
-                    spese_hdr_cells[1].text = 'Descrizione'
-                    spese_hdr_cells[2].text = 'Importo Totale'
-                    spese_hdr_cells[3].text = 'Importo Dovuto'
+                    doc.add_paragraph()
 
-                    # Formatta intestazioni
-                    for cell in spese_hdr_cells:
-                        for paragraph in cell.paragraphs:
-                            paragraph.runs[0].bold = True
+                    # Dettaglio spese per tabella
+                    tabella_corrente = None
+                    subtotale = 0
+                    while spesa is not None and spesa['persona_id'] == persona.id:
+                        if spesa['tabella_millesimi'] != tabella_corrente:
+                            if tabella_corrente is not None:
+                                chiudi_tabella(tabella_corrente, subtotale)
+                            tabella_corrente = spesa['tabella_millesimi']
+                            subtotale = 0
+
+                            doc.add_paragraph().add_run(f'Tabella Millesimi: {tabella_corrente}').bold = True
+
+                            # Tabella spese per questa tabella
+                            spese_table = doc.add_table(rows=1, cols=4)
+                            spese_table.style = 'Table Grid'
+
+                            # Intestazioni tabella spese
+                            spese_hdr_cells = spese_table.rows[0].cells
+                            spese_hdr_cells[0].text = 'Data'
+                            spese_hdr_cells[1].text = 'Descrizione'
+                            spese_hdr_cells[2].text = 'Importo Totale'
+                            spese_hdr_cells[3].text = 'Importo Dovuto'
+
+                            # Formatta intestazioni
+                            for cell in spese_hdr_cells:
+                                for paragraph in cell.paragraphs:
+                                    paragraph.runs[0].bold = True
 
-                    for spesa in tabella_data['spese']:
                         spese_row_cells = spese_table.add_row().cells
 
                         # Gestione del formato data
@@ -2072,27 +2494,27 @@ def stampa_ripartizione(condo_id):
 
                         spese_row_cells[0].text = data_formattata
                         spese_row_cells[1].text = spesa['descrizione']
-                        spese_row_cells[2].text = f'€ {spesa["importo_totale"]:.2f}'
+                        spese_row_cells[2].text = f'€ {spesa["importo"]:.2f}'
                         spese_row_cells[3].text = f'€ {spesa["importo_dovuto"]:.2f}'
+                        subtotale += to_cents(spesa['importo_dovuto'])
 
-                    # Subtotale tabella
-                    doc.add_paragraph()
-                    subtotal_para = doc.add_paragraph()
-                    subtotal_para.add_run(f'Subtotale Tabella {tabella_data["tabella"]}: ').bold = True
-                    subtotal_para.add_run(f'€ {tabella_data["totale_tabella"]:.2f}')
-                    subtotal_para.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-                    doc.add_paragraph()
+                        spesa = next(righe, None)
 
-            # Note finali
-            doc.add_paragraph()
-            doc.add_paragraph().add_run("=" * 60).bold = True
-            doc.add_paragraph()
-            note_para = doc.add_paragraph()
-            note_para.add_run('Note: ').bold = True
-            if tabella_filter:
-                note_para.add_run(f'Questa ripartizione include solo le spese assegnate alla tabella millesimi {tabella_filter}.')
-            else:
-                note_para.add_run('Questa ripartizione include tutte le spese del condominio suddivise per tabelle millesimi.')
+                    if tabella_corrente is not None:
+                        chiudi_tabella(tabella_corrente, subtotale)
+
+                # Note finali
+                doc.add_paragraph()
+                doc.add_paragraph().add_run("=" * 60).bold = True
+                doc.add_paragraph()
+                note_para = doc.add_paragraph()
+                note_para.add_run('Note: ').bold = True
+                if tabella_filter:
+                    note_para.add_run(f'Questa ripartizione include solo le spese assegnate alla tabella millesimi {tabella_filter}.')
+                else:
+                    note_para.add_run('Questa ripartizione include tutte le spese del condominio suddivise per tabelle millesimi.')
+        finally:
+            conn.close()
 
         # Prepara response
         buffer = BytesIO()
@@ -2119,6 +2541,9 @@ def stampa_ripartizione(condo_id):
 def stampa_preventivo(condo_id, anno):
     """Genera documento Word con preventivo annuale e ripartizione prevista"""
     try:
+        from docx import Document
+        from docx.enum.text import WD_ALIGN_PARAGRAPH
+
         # Verifica condominio e permessi
         condominio = Condominio.find_by_id(condo_id)
         if not condominio:
@@ -2252,8 +2677,7 @@ def method_not_allowed(error):
 
 if __name__ == '__main__':
     # Inizializza database
-    init_db()
-    create_default_user()
+    ensure_db_ready()
 
     print("CONDOMINIO NUOVO - WebApp")
     print("Server in esecuzione su http://localhost:5000")
@@ -0,0 +1,244 @@
+"""Entry point ASGI (alternativo a gunicorn con worker WSGI a thread).
+
+    uvicorn asgi:app --workers 2
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker --workers 2
+
+Le letture più frequenti (spese, persone, millesimi, ripartizione) sono
+servite da handler asincroni: con asyncpg le query su PostgreSQL non occupano
+thread mentre attendono il server; su SQLite, e per il ricalcolo della
+ripartizione, girano nel pool di thread di db_async. Tutte le altre route
+(API e frontend) passano all'app Flask tramite a2wsgi, con un proprio pool di
+thread: la generazione dei documenti docx resta fuori dall'event loop.
+
+Gli handler asincroni usano il contesto di richiesta Flask (request, jsonify,
+ETag, after_request per compressione e CORS), quindi le risposte sono le
+stesse dell'app WSGI.
+"""
+import os
+import re
+import sys
+from io import BytesIO
+
+from a2wsgi import WSGIMiddleware
+from flask import request, jsonify
+
+import app as modulo_app
+from app import (
+    app as app_flask, ensure_db_ready, etag_condominio, non_modificato, con_etag,
+    serializza_persone, serializza_millesimi, serializza_spese, risposta_ripartizione
+)
+from models import Condominio, Persona, Spesa, Millesemo
+from utils import token_required_async, log_error
+from database_async import db_async
+
+# Thread per le richieste servite dall'app Flask (WSGI)
+ASGI_WSGI_THREADS = int(os.getenv('ASGI_WSGI_THREADS', '16'))
+
+TABELLE = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'L']
+
+async def condominio_utente(condo_id):
+    """Condominio dell'utente della richiesta: (condominio, None) o (None, risposta 404/403)"""
+    riga = await db_async.riga(Condominio.SQL_PER_ID, (condo_id,))
+    if not riga:
+        return None, (jsonify({'message': 'Condominio non trovato'}), 404)
+    condominio = Condominio.da_riga(riga)
+    if condominio.user_id != request.current_user_id:
+        return None, (jsonify({'message': 'Non autorizzato'}), 403)
+    return condominio, None
+
+# ======================
+# HANDLER ASINCRONI
+# ======================
+
+@token_required_async
+async def get_persone(condo_id):
+    """Lista persone condominio"""
+    try:
+        condominio, errore = await condominio_utente(condo_id)
+        if errore:
+            return errore
+
+        etag = etag_condominio(condominio)
+        cached = non_modificato(etag)
+        if cached:
+            return cached
+
+        righe = await db_async.righe(Persona.SQL_PER_CONDOMINIO, (condo_id,), lettura=[condominio])
+        persone = [Persona.da_riga(row) for row in righe]
+        return con_etag(jsonify(serializza_persone(persone)), etag), 200
+
+    except Exception as e:
+        log_error(str(e), f'asgi get_persone {condo_id}')
+        return jsonify({'message': 'Errore del server'}), 500
+
+@token_required_async
+async def get_millesimi(condo_id):
+    """Tutti millesimi condominio"""
+    try:
+        condominio, errore = await condominio_utente(condo_id)
+        if errore:
+            return errore
+
+        etag = etag_condominio(condominio)
+        cached = non_modificato(etag)
+        if cached:
+            return cached
+
+        righe = await db_async.righe(Millesemo.SQL_PER_CONDOMINIO, (condo_id,), lettura=[condominio])
+        return con_etag(jsonify(serializza_millesimi(Millesemo.per_tabella(righe))), etag), 200
+
+    except Exception as e:
+        log_error(str(e), f'asgi get_millesimi {condo_id}')
+        return jsonify({'message': 'Errore del server'}), 500
+
+@token_required_async
+async def get_spese(condo_id):
+    """Lista spese condominio con filtro opzionale per tabella"""
+    try:
+        condominio, errore = await condominio_utente(condo_id)
+        if errore:
+            return errore
+
+        etag = etag_condominio(condominio)
+        cached = non_modificato(etag)
+        if cached:
+            return cached
+
+        tabella_filter = request.args.get('tabella')
+        if tabella_filter and tabella_filter not in TABELLE:
+            return jsonify({'message': 'Tabella non valida'}), 400
+
+        if tabella_filter:
+            righe = await db_async.righe(Spesa.SQL_PER_TABELLA, (condo_id, tabella_filter), lettura=[condominio])
+        else:
+            righe = await db_async.righe(Spesa.SQL_PER_CONDOMINIO, (condo_id,), lettura=[condominio])
+        spese = [Spesa.da_riga(row) for row in righe]
+        return con_etag(jsonify(serializza_spese(spese)), etag), 200
+
+    except Exception as e:
+        log_error(str(e), f'asgi get_spese {condo_id}')
+        return jsonify({'message': 'Errore del server'}), 500
+
+@token_required_async
+async def get_ripartizione(condo_id):
+    """Ripartizione totale o per tabella specifica"""
+    try:
+        condominio, errore = await condominio_utente(condo_id)
+        if errore:
+            return errore
+
+        etag = etag_condominio(condominio)
+        cached = non_modificato(etag)
+        if cached:
+            return cached
+
+        tabella_filter = request.args.get('tabella')
+        if tabella_filter and tabella_filter not in TABELLE:
+            return jsonify({'message': 'Tabella non valida'}), 400
+
+        # Ricalcolo e scrittura di ripartizione_spese: lavoro sincrono, nel pool di thread
+        ripartizione = await db_async.esegui(risposta_ripartizione, condo_id, tabella_filter)
+        return con_etag(jsonify(ripartizione), etag), 200
+
+    except Exception as e:
+        log_error(str(e), f'asgi get_ripartizione {condo_id}')
+        return jsonify({'message': 'Errore del server'}), 500
+
+# Route GET servite in modo asincrono: percorso -> handler(condo_id)
+ROTTE_ASYNC = [
+    (re.compile(r'/api/condominii/(\d+)/persone'), get_persone),
+    (re.compile(r'/api/condominii/(\d+)/millesimi'), get_millesimi),
+    (re.compile(r'/api/condominii/(\d+)/spese'), get_spese),
+    (re.compile(r'/api/condominii/(\d+)/ripartizione'), get_ripartizione),
+]
+
+# ======================
+# APPLICAZIONE ASGI
+# ======================
+
+def environ_richiesta(scope):
+    """Environ WSGI (senza corpo) per il contesto di richiesta Flask"""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for nome, valore in scope.get('headers', []):
+        nome = nome.decode('latin-1').upper().replace('-', '_')
+        valore = valore.decode('latin-1')
+        chiave = nome if nome in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f'HTTP_{nome}'
+        environ[chiave] = f"{environ[chiave]},{valore}" if chiave in environ else valore
+    return environ
+
+async def servi_async(handler, condo_id, scope, send):
+    """Esegue un handler asincrono nel contesto di richiesta Flask e invia la risposta"""
+    if not modulo_app._db_pronto:
+        await db_async.esegui(ensure_db_ready)
+
+    environ = environ_richiesta(scope)
+    contesto = app_flask.request_context(environ)
+    contesto.push()
+    try:
+        try:
+            risposta = await handler(condo_id)
+        except Exception as e:
+            # Come l'errorhandler 500 dell'app Flask
+            log_error(str(e), f"asgi {scope['path']}")
+            risposta = jsonify({'message': 'Errore interno del server'}), 500
+        response = app_flask.make_response(risposta)
+        # after_request dell'app: charset, compressione, CORS
+        response = app_flask.process_response(response)
+        # Come in WSGI: niente corpo né intestazioni di contenuto per 304 e HEAD
+        corpo, stato, intestazioni = response.get_wsgi_response(environ)
+        corpo = b''.join(corpo)
+        stato = int(stato.split(' ', 1)[0])
+        intestazioni = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in intestazioni]
+    finally:
+        contesto.pop()
+
+    await send({'type': 'http.response.start', 'status': stato, 'headers': intestazioni})
+    await send({'type': 'http.response.body', 'body': corpo})
+
+async def lifespan(receive, send):
+    while True:
+        messaggio = await receive()
+        if messaggio['type'] == 'lifespan.startup':
+            try:
+                await db_async.esegui(ensure_db_ready)
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif messaggio['type'] == 'lifespan.shutdown':
+            await db_async.chiudi()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+app_wsgi = WSGIMiddleware(app_flask, workers=ASGI_WSGI_THREADS)
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    if scope['type'] == 'http' and scope['method'] == 'GET':
+        for percorso, handler in ROTTE_ASYNC:
+            trovato = percorso.fullmatch(scope['path'])
+            if trovato:
+                await servi_async(handler, int(trovato.group(1)), scope, send)
+                return
+
+    await app_wsgi(scope, receive, send)
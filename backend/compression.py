@@ -0,0 +1,185 @@
+import os
+import re
+import gzip
+import hashlib
+import mimetypes
+import threading
+
+# Brotli è opzionale: senza la libreria si usa solo gzip
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+# Risposte JSON più piccole di questa soglia (byte) non vengono compresse
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))
+
+# Estensioni dei file statici da precomprimere
+ESTENSIONI_COMPRIMIBILI = ('.html', '.js', '.css', '.svg', '.json')
+
+# Cartella (dentro il frontend) per le copie .gz/.br condivise tra i worker
+CARTELLA_PRECOMPRESSI = '.precompressed'
+
+CACHE_IMMUTABILE = 'public, max-age=31536000, immutable'
+
+def scegli_encoding(accept_encodings):
+    """Sceglie la codifica migliore supportata dal client ('br', 'gzip' o None)"""
+    if BROTLI_AVAILABLE and accept_encodings['br']:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+def comprimi(data, encoding, statico=False):
+    """Comprime i byte con la codifica indicata.
+
+    Per i file statici (compressi una volta sola) usa il livello massimo,
+    per le risposte dinamiche un livello più veloce.
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if statico else 5)
+    return gzip.compress(data, compresslevel=9 if statico else 6)
+
+def comprimi_risposta(response, accept_encodings):
+    """Comprime una risposta JSON sopra soglia secondo l'Accept-Encoding del client"""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or response.mimetype != 'application/json'
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    encoding = scegli_encoding(accept_encodings)
+    response.vary.add('Accept-Encoding')
+    if not encoding:
+        return response
+
+    response.set_data(comprimi(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+class StaticAsset:
+    """File statico con hash del contenuto e varianti precompresse"""
+
+    def __init__(self, nome, data, mtime):
+        self.nome = nome
+        self.data = data
+        self.mtime = mtime
+        self.hash = hashlib.sha256(data).hexdigest()[:12]
+        self.mimetype = mimetypes.guess_type(nome)[0] or 'application/octet-stream'
+        self.varianti = {}
+
+class StaticAssets:
+    """Catalogo dei file del frontend con hash di contenuto e copie .gz/.br.
+
+    Le copie compresse vengono scritte in `<frontend>/.precompressed/` con l'hash
+    nel nome, così i worker successivi le riusano invece di ricomprimere.
+    """
+
+    # Riferimenti locali in index.html: "app.js?v=39", '/vendor/react.production.min.js', ...
+    RIFERIMENTO_RE = re.compile(r"""(["'])(/?)((?:[\w-]+/)*[\w.-]+\.(?:js|css|svg))(?:\?v=[^"']*)?\1""")
+
+    def __init__(self, cartella):
+        self.cartella = os.path.abspath(cartella)
+        self._assets = {}
+        self._lock = threading.Lock()
+
+    def _percorso(self, nome):
+        percorso = os.path.abspath(os.path.join(self.cartella, nome))
+        if not percorso.startswith(self.cartella + os.sep) or not os.path.isfile(percorso):
+            return None
+        return percorso
+
+    def get(self, nome):
+        """Ritorna l'asset (ricaricato se il file è cambiato) o None se non esiste"""
+        percorso = self._percorso(nome)
+        if not percorso:
+            return None
+        mtime = os.path.getmtime(percorso)
+        asset = self._assets.get(nome)
+        if asset and asset.mtime == mtime:
+            return asset
+        with self._lock:
+            asset = self._assets.get(nome)
+            if asset and asset.mtime == mtime:
+                return asset
+            with open(percorso, 'rb') as f:
+                asset = StaticAsset(nome, f.read(), mtime)
+            if nome.endswith(ESTENSIONI_COMPRIMIBILI):
+                for encoding in (('br', 'gzip') if BROTLI_AVAILABLE else ('gzip',)):
+                    asset.varianti[encoding] = self._precomprimi(asset, encoding)
+            self._assets[nome] = asset
+            return asset
+
+    def _precomprimi(self, asset, encoding):
+        estensione = 'br' if encoding == 'br' else 'gz'
+        cartella = os.path.join(self.cartella, CARTELLA_PRECOMPRESSI)
+        copia = os.path.join(cartella, f"{asset.nome.replace('/', '__')}.{asset.hash}.{estensione}")
+        try:
+            with open(copia, 'rb') as f:
+                return f.read()
+        except OSError:
+            pass
+
+        data = comprimi(asset.data, encoding, statico=True)
+        try:
+            os.makedirs(cartella, exist_ok=True)
+            tmp = f"{copia}.{os.getpid()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, copia)
+        except OSError:
+            # Filesystem in sola lettura: la copia resta solo in memoria
+            pass
+        return data
+
+    def precomprimi_tutto(self):
+        """Costruisce hash e copie compresse di tutti i file del frontend"""
+        for radice, cartelle, files in os.walk(self.cartella):
+            cartelle[:] = [c for c in cartelle if not c.startswith('.')]
+            for nome_file in files:
+                nome = os.path.relpath(os.path.join(radice, nome_file), self.cartella).replace(os.sep, '/')
+                self.get(nome)
+
+    def avvia_precompressione(self):
+        """Precomprime in background per non rallentare l'avvio del worker"""
+        thread = threading.Thread(target=self.precomprimi_tutto, name='precompressione-statici', daemon=True)
+        thread.start()
+        return thread
+
+    def url_versionato(self, nome):
+        """Nome del file con parametro ?v=<hash contenuto> (None se non esiste)"""
+        asset = self.get(nome)
+        return f"{nome}?v={asset.hash}" if asset else None
+
+    def rendi_html(self, nome):
+        """Asset HTML con i riferimenti locali riscritti con l'hash del contenuto.
+
+        Il risultato dipende anche dagli hash dei file referenziati, quindi la
+        cache è indicizzata sull'hash dell'HTML riscritto.
+        """
+        asset = self.get(nome)
+        if not asset:
+            return None
+
+        def sostituisci(match):
+            quote, slash, riferimento = match.group(1), match.group(2), match.group(3)
+            url = self.url_versionato(riferimento)
+            if not url:
+                return match.group(0)
+            return f"{quote}{slash}{url}{quote}"
+
+        html = self.RIFERIMENTO_RE.sub(sostituisci, asset.data.decode('utf-8')).encode('utf-8')
+        chiave = f"{nome}#versionato"
+        renderizzato = self._assets.get(chiave)
+        if renderizzato and renderizzato.data == html:
+            return renderizzato
+
+        renderizzato = StaticAsset(nome, html, asset.mtime)
+        for encoding in asset.varianti:
+            renderizzato.varianti[encoding] = comprimi(html, encoding, statico=True)
+        self._assets[chiave] = renderizzato
+        return renderizzato
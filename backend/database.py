@@ -18,209 +18,19 @@ def get_db():
     return conn
 
 def init_db():
-    """Inizializza il database con tutte le tabelle necessarie"""
-    conn = get_db()
-    cursor = conn.cursor()
+    """Inizializza il database con tutte le tabelle necessarie.
 
-    # Aggiunge la colonna data_spesa alla tabella spese se non esiste (per compatibilità con database esistenti)
-    try:
-        cursor.execute("ALTER TABLE spese ADD COLUMN data_spesa DATE")
-        # Aggiorna le spese esistenti con la data di creazione come data_spesa
-        cursor.execute("UPDATE spese SET data_spesa = DATE(created_at) WHERE data_spesa IS NULL")
-    except sqlite3.OperationalError:
-        # La colonna esiste già, ignora l'errore
-        pass
-
-    # Tabella users
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # Tabella condominii
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS condominii (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            nome TEXT NOT NULL,
-            indirizzo TEXT,
-            num_unita INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Tabella unita_immobiliari
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS unita_immobiliari (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            condominio_id INTEGER NOT NULL,
-            numero_unita INTEGER NOT NULL,
-            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE,
-            UNIQUE (condominio_id, numero_unita)
-        )
-    ''')
-
-    # Tabella persone
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS persone (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            condominio_id INTEGER NOT NULL,
-            unita_id INTEGER NOT NULL,
-            nome TEXT NOT NULL,
-            cognome TEXT NOT NULL,
-            email TEXT,
-            tipo_persona TEXT NOT NULL CHECK (tipo_persona IN ('proprietario', 'inquilino', 'proprietario_inquilino')),
-            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE,
-            FOREIGN KEY (unita_id) REFERENCES unita_immobiliari(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Tabella millesimi (per tutte le tabelle A-L)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS millesimi (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            condominio_id INTEGER NOT NULL,
-            unita_id INTEGER NOT NULL,
-            tabella TEXT NOT NULL CHECK (tabella IN ('A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'L')),
-            valore INTEGER NOT NULL CHECK (valore >= 0 AND valore <= 1000),
-            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE,
-            FOREIGN KEY (unita_id) REFERENCES unita_immobiliari(id) ON DELETE CASCADE,
-            UNIQUE (condominio_id, unita_id, tabella)
-        )
-    ''')
-
-    # Tabella spese
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS spese (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            condominio_id INTEGER NOT NULL,
-            descrizione TEXT NOT NULL,
-            importo REAL NOT NULL CHECK (importo > 0),
-            data_spesa DATE NOT NULL,
-            tabella_millesimi TEXT NOT NULL CHECK (tabella_millesimi IN ('A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'L')),
-            logica_pi TEXT NOT NULL CHECK (logica_pi IN ('proprietario', 'inquilino', '50/50', 'personalizzato')),
-            percentuale_proprietario REAL DEFAULT 100 CHECK (percentuale_proprietario >= 0 AND percentuale_proprietario <= 100),
-            percentuale_inquilino REAL DEFAULT 0 CHECK (percentuale_inquilino >= 0 AND percentuale_inquilino <= 100),
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Tabella ripartizione_spese
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS ripartizione_spese (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            condominio_id INTEGER NOT NULL,
-            persona_id INTEGER NOT NULL,
-            spesa_id INTEGER NOT NULL,
-            importo_dovuto REAL NOT NULL,
-            anno INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE,
-            FOREIGN KEY (persona_id) REFERENCES persone(id) ON DELETE CASCADE,
-            FOREIGN KEY (spesa_id) REFERENCES spese(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Tabella preventivi_annuali
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS preventivi_annuali (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            condominio_id INTEGER NOT NULL,
-            anno INTEGER NOT NULL,
-            importo_totale_preventivato REAL NOT NULL,
-            importo_totale_speso REAL DEFAULT 0,
-            differenza REAL DEFAULT 0,
-            note TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE,
-            UNIQUE (condominio_id, anno)
-        )
-    ''')
-
-    # Tabella preventivi_dettaglio
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS preventivi_dettaglio (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            preventivo_id INTEGER NOT NULL,
-            persona_id INTEGER NOT NULL,
-            importo_preventivato REAL NOT NULL,
-            importo_effettivo REAL DEFAULT 0,
-            differenza REAL DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (preventivo_id) REFERENCES preventivi_annuali(id) ON DELETE CASCADE,
-            FOREIGN KEY (persona_id) REFERENCES persone(id) ON DELETE CASCADE,
-            UNIQUE (preventivo_id, persona_id)
-        )
-    ''')
-
-    # Tabella spese_preventivate
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS spese_preventivate (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            condominio_id INTEGER NOT NULL,
-            preventivo_id INTEGER NOT NULL,
-            descrizione TEXT NOT NULL,
-            importo_previsto REAL NOT NULL CHECK (importo_previsto > 0),
-            tabella_millesimi TEXT NOT NULL CHECK (tabella_millesimi IN ('A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'L')),
-            logica_pi TEXT NOT NULL CHECK (logica_pi IN ('proprietario', 'inquilino', '50/50', 'personalizzato')),
-            percentuale_proprietario REAL DEFAULT 100 CHECK (percentuale_proprietario >= 0 AND percentuale_proprietario <= 100),
-            percentuale_inquilino REAL DEFAULT 0 CHECK (percentuale_inquilino >= 0 AND percentuale_inquilino <= 100),
-            mese_previsto INTEGER CHECK (mese_previsto BETWEEN 1 AND 12),
-            data_prevista DATE,
-            note TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE,
-            FOREIGN KEY (preventivo_id) REFERENCES preventivi_annuali(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Migrazione leggera: aggiunge colonna data_prevista se non esiste (per DB esistenti)
-    try:
-        cursor.execute("ALTER TABLE spese_preventivate ADD COLUMN data_prevista DATE")
-    except sqlite3.OperationalError:
-        pass
+    Lo schema è definito una sola volta in migrations.py (condiviso con
+    database_universal) e applicato in base alla versione registrata.
+    """
+    from migrations import applica_migrazioni
 
-    # Tabella ripartizione_preventivo
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS ripartizione_preventivo (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            condominio_id INTEGER NOT NULL,
-            preventivo_id INTEGER NOT NULL,
-            persona_id INTEGER NOT NULL,
-            importo_previsto_dovuto REAL NOT NULL,
-            anno INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE,
-            FOREIGN KEY (preventivo_id) REFERENCES preventivi_annuali(id) ON DELETE CASCADE,
-            FOREIGN KEY (persona_id) REFERENCES persone(id) ON DELETE CASCADE,
-            UNIQUE (preventivo_id, persona_id)
-        )
-    ''')
-
-    # Tabella storici_anni
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS storici_anni (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            condominio_id INTEGER NOT NULL,
-            anno INTEGER NOT NULL,
-            importo_totale_speso REAL NOT NULL,
-            note TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE,
-            UNIQUE (condominio_id, anno)
-        )
-    ''')
-
-    conn.commit()
-    conn.close()
-    print(f"Database inizializzato con successo: {DATABASE_PATH}")
+    conn = get_db()
+    try:
+        versione = applica_migrazioni(conn)
+    finally:
+        conn.close()
+    print(f"Database inizializzato con successo: {DATABASE_PATH} (schema v{versione})")
 
 def create_default_user():
     """Crea l'utente di default se non esiste"""
@@ -0,0 +1,121 @@
+import os
+import re
+import asyncio
+import contextvars
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+from database_universal import (
+    IS_POSTGRES, DATABASE_URL, DATABASE_REPLICA_URL, STATEMENT_CACHE_SIZE, exec_sql, get_db, get_read_db
+)
+
+# asyncpg è opzionale: senza la libreria le query su PostgreSQL girano nel pool di thread
+try:
+    import asyncpg
+    ASYNCPG_AVAILABLE = True
+except ImportError:
+    ASYNCPG_AVAILABLE = False
+
+ASYNC_PG = IS_POSTGRES and ASYNCPG_AVAILABLE
+
+# Thread per le query sincrone (SQLite) e i calcoli del percorso asincrono
+ASGI_THREADS = int(os.getenv('ASGI_THREADS', '16'))
+# Connessioni asyncpg massime per processo (ogni pool: primario e replica)
+ASYNC_PG_POOL_SIZE = int(os.getenv('ASYNC_PG_POOL_SIZE', '20'))
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _placeholder_asyncpg(sql):
+    """'?' -> $1, $2, ... (asyncpg usa parametri numerati)"""
+    contatore = iter(range(1, sql.count('?') + 1))
+    return re.sub(r'\?', lambda _: f"${next(contatore)}", sql)
+
+def _righe_sync(sql, params, lettura):
+    conn = get_read_db(*lettura) if lettura is not None else get_db()
+    try:
+        cursor = conn.cursor()
+        exec_sql(cursor, sql, params)
+        return cursor.fetchall()
+    finally:
+        conn.close()
+
+class DatabaseAsync:
+    """Accesso al database per gli handler asincroni (asgi.py).
+
+    Su PostgreSQL con asyncpg le query non occupano thread: l'event loop
+    attende la risposta del server. Negli altri casi (SQLite, asyncpg non
+    installato) girano in un pool di thread dedicato, come i calcoli sincroni
+    passati a esegui(). Le righe hanno accesso per nome come sqlite3.Row, quindi
+    i modelli le convertono con i loro da_riga().
+    """
+
+    def __init__(self, threads=ASGI_THREADS, dimensione_pool=ASYNC_PG_POOL_SIZE):
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi-db')
+        self.dimensione_pool = dimensione_pool
+        self._pool = {}
+        self._lock = None
+
+    async def esegui(self, funzione, *args):
+        """Esegue una funzione sincrona nel pool di thread.
+
+        Le ContextVar della richiesta (shard, scritture) vengono copiate nel thread.
+        """
+        contesto = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, lambda: contesto.run(funzione, *args)
+        )
+
+    async def righe(self, sql, params=(), lettura=None):
+        """Righe di una SELECT con placeholder '?'.
+
+        Con `lettura` (lista dei condominii a cui la risposta è legata) la query
+        può andare alla replica, alle stesse condizioni di get_read_db;
+        altrimenti usa il primario.
+        """
+        if not ASYNC_PG:
+            return await self.esegui(_righe_sync, sql, params, lettura)
+
+        sql = _placeholder_asyncpg(sql)
+        if lettura is not None and DATABASE_REPLICA_URL:
+            async with (await self._pool_per(DATABASE_REPLICA_URL)).acquire() as conn:
+                if await self._replica_aggiornata(conn, lettura):
+                    return await conn.fetch(sql, *params)
+        async with (await self._pool_per(DATABASE_URL)).acquire() as conn:
+            return await conn.fetch(sql, *params)
+
+    async def riga(self, sql, params=(), lettura=None):
+        righe = await self.righe(sql, params, lettura)
+        return righe[0] if righe else None
+
+    async def _replica_aggiornata(self, conn, condominii):
+        attese = {c.id: c.data_version or 0 for c in condominii}
+        if not attese:
+            return True
+        try:
+            viste = {row['id']: row['data_version'] or 0 for row in await conn.fetch(
+                "SELECT id, data_version FROM condominii WHERE id = ANY($1::int[])", list(attese)
+            )}
+        except asyncpg.PostgresError:
+            return False
+        return all(viste.get(cid, -1) >= versione for cid, versione in attese.items())
+
+    async def _pool_per(self, url):
+        # Il pool appartiene all'event loop del worker: creato alla prima richiesta
+        pool = self._pool.get(url)
+        if pool is None:
+            if self._lock is None:
+                self._lock = asyncio.Lock()
+            async with self._lock:
+                pool = self._pool.get(url)
+                if pool is None:
+                    pool = self._pool[url] = await asyncpg.create_pool(
+                        url, min_size=1, max_size=self.dimensione_pool
+                    )
+        return pool
+
+    async def chiudi(self):
+        """Chiude i pool asyncpg (fine del worker)"""
+        pool, self._pool = self._pool, {}
+        for p in pool.values():
+            await p.close()
+
+db_async = DatabaseAsync()
@@ -1,6 +1,12 @@
 import os
+import re
+import contextvars
 import sqlite3
+import itertools
+import threading
 from datetime import datetime
+from functools import lru_cache
+from urllib.request import pathname2url
 
 # Importa psycopg2 solo se necessario
 try:
@@ -14,20 +20,236 @@ except ImportError:
 DATABASE_URL = os.getenv('DATABASE_URL')
 IS_POSTGRES = DATABASE_URL and DATABASE_URL.startswith('postgres') and PSYCOPG2_AVAILABLE
 
+# Connessioni Postgres inattive conservate per il riuso in ogni processo (0 = nessun pool)
+PG_POOL_SIZE = int(os.getenv('PG_POOL_SIZE', '8'))
+
+# Esecuzioni dopo le quali un'istruzione viene preparata lato server (PREPARE/EXECUTE, 0 = mai)
+PG_PREPARE_THRESHOLD = int(os.getenv('PG_PREPARE_THRESHOLD', '5'))
+
+# Istruzioni distinte memorizzate (oltre il limite l'SQL viene solo tradotto)
+STATEMENT_CACHE_SIZE = 1024
+
+# Replica in sola lettura per le letture pesanti (Postgres); su SQLite
+# SQLITE_READ_ONLY=1 apre le connessioni di lettura con mode=ro sullo stesso file
+DATABASE_REPLICA_URL = os.getenv('DATABASE_REPLICA_URL') if IS_POSTGRES else None
+SQLITE_READ_ONLY = os.getenv('SQLITE_READ_ONLY', '0') == '1' and not IS_POSTGRES
+
+# Un file SQLite per utente (scelto dallo user_id del JWT) invece di un unico database.
+# Utenti e token revocati restano nel database catalogo (CONDOMINIO_DB_PATH).
+SQLITE_SHARDING = os.getenv('SQLITE_SHARDING', '0') == '1' and not IS_POSTGRES
+SQLITE_SHARD_DIR = os.getenv('SQLITE_SHARD_DIR')
+
+# Gli id generati in uno shard partono da user_id * SHARD_ID_BLOCCO: restano unici
+# tra tutti gli shard (cache e ETag per id) e l'unione nel catalogo non ha conflitti
+SHARD_ID_BLOCCO = 10 ** 9
+
+# Connessioni SQLite inattive conservate per il riuso in ogni processo (0 = nessun pool)
+SQLITE_POOL_SIZE = int(os.getenv('SQLITE_POOL_SIZE', '8'))
+
+# Profili di PRAGMA applicati una volta per connessione SQLite (SQLITE_PROFILO).
+# journal_size_limit riporta il file WAL a questa dimensione dopo ogni checkpoint.
+PROFILI_SQLITE = {
+    'standard': {
+        'synchronous': 'NORMAL', 'cache_size': 10000, 'temp_store': 'MEMORY',
+        'mmap_size': 268435456, 'busy_timeout': 30000,
+        'wal_autocheckpoint': 1000, 'journal_size_limit': 67108864,
+    },
+    # Report e dataset grandi: più cache e file mappato in memoria
+    'letture': {
+        'synchronous': 'NORMAL', 'cache_size': -65536, 'temp_store': 'MEMORY',
+        'mmap_size': 1073741824, 'busy_timeout': 30000,
+        'wal_autocheckpoint': 1000, 'journal_size_limit': 67108864,
+    },
+    # Ogni commit sincronizzato su disco (più lento, nessuna perdita su crash del sistema)
+    'durabile': {
+        'synchronous': 'FULL', 'cache_size': 10000, 'temp_store': 'MEMORY',
+        'mmap_size': 0, 'busy_timeout': 60000,
+        'wal_autocheckpoint': 1000, 'journal_size_limit': 67108864,
+    },
+}
+# PRAGMA validi anche sulle connessioni in sola lettura
+PRAGMA_LETTURA = ('cache_size', 'temp_store', 'mmap_size', 'busy_timeout')
+
+def _profilo_sqlite():
+    """PRAGMA del profilo SQLITE_PROFILO con le modifiche di SQLITE_PRAGMA
+    (es. "mmap_size=0,cache_size=-20000")"""
+    nome = os.getenv('SQLITE_PROFILO', 'standard')
+    if nome not in PROFILI_SQLITE:
+        raise ValueError(f"SQLITE_PROFILO non valido: {nome} (validi: {', '.join(PROFILI_SQLITE)})")
+    profilo = dict(PROFILI_SQLITE[nome])
+    for voce in filter(None, (v.strip() for v in os.getenv('SQLITE_PRAGMA', '').split(','))):
+        chiave, _, valore = voce.partition('=')
+        chiave, valore = chiave.strip().lower(), valore.strip()
+        if chiave not in profilo or not re.fullmatch(r'-?\w+', valore):
+            raise ValueError(f"SQLITE_PRAGMA non valido: {voce}")
+        profilo[chiave] = valore
+    return profilo
+
+PROFILO_SQLITE = _profilo_sqlite()
+
+# Righe lette per ogni giro nelle letture in streaming (iter_rows)
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', '500'))
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _traduci_placeholder(sql):
+    return sql.replace('?', '%s')
+
 def format_sql(sql: str) -> str:
     """Adatta i placeholder SQL allo specifico driver.
 
     - SQLite usa '?'
     - Postgres/psycopg2 usa '%s'
+
+    La traduzione è memorizzata per testo SQL (le stesse stringhe letterali
+    vengono eseguite migliaia di volte).
     """
     if IS_POSTGRES and isinstance(sql, str):
-        return sql.replace('?', '%s')
+        return _traduci_placeholder(sql)
     return sql
 
+class Istruzione:
+    """Istruzione SQL registrata: contatore di esecuzioni e testo per PREPARE"""
+
+    def __init__(self, sql, numero):
+        self.nome = f"cp_{numero}"
+        self.esecuzioni = 0
+        self.num_parametri = sql.count('?')
+        contatore = iter(range(1, self.num_parametri + 1))
+        self.testo_prepare = re.sub(r'\?', lambda _: f"${next(contatore)}", sql)
+        self.parametri_execute = ', '.join(['%s'] * self.num_parametri)
+        # Solo DML parametrizzato; un PREPARE fallito (tipi non deducibili) la disabilita
+        self.preparabile = (self.num_parametri > 0 and ';' not in sql and '%' not in sql
+                            and sql.lstrip().split(None, 1)[0].upper() in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH'))
+
+_istruzioni = {}
+_istruzioni_lock = threading.Lock()
+
+def _istruzione(sql):
+    """Istruzione registrata per il testo SQL (None se il registro è pieno)"""
+    istruzione = _istruzioni.get(sql)
+    if istruzione is None:
+        with _istruzioni_lock:
+            istruzione = _istruzioni.get(sql)
+            if istruzione is None:
+                if len(_istruzioni) >= STATEMENT_CACHE_SIZE:
+                    return None
+                istruzione = Istruzione(sql, len(_istruzioni) + 1)
+                _istruzioni[sql] = istruzione
+    # Contatore non atomico: serve solo a riconoscere le istruzioni frequenti
+    istruzione.esecuzioni += 1
+    return istruzione
+
+def _sql_preparato(cursor, sql):
+    """Testo EXECUTE per le istruzioni frequenti su connessioni del pool (None = esecuzione normale).
+
+    Il PREPARE avviene una volta per connessione, dentro un savepoint così che
+    un errore non interrompa la transazione in corso.
+    """
+    conn = cursor.connection
+    if not isinstance(conn, ConnessionePostgres) or conn.autocommit:
+        return None
+    istruzione = _istruzione(sql)
+    if not istruzione or not istruzione.preparabile or istruzione.esecuzioni < PG_PREPARE_THRESHOLD:
+        return None
+
+    if istruzione.nome not in conn.preparati:
+        try:
+            cursor.execute("SAVEPOINT cp_prepare")
+            cursor.execute(f"PREPARE {istruzione.nome} AS {istruzione.testo_prepare}")
+            cursor.execute("RELEASE SAVEPOINT cp_prepare")
+        except psycopg2.Error:
+            cursor.execute("ROLLBACK TO SAVEPOINT cp_prepare")
+            cursor.execute("RELEASE SAVEPOINT cp_prepare")
+            istruzione.preparabile = False
+            return None
+        conn.preparati.add(istruzione.nome)
+
+    return f"EXECUTE {istruzione.nome} ({istruzione.parametri_execute})"
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _e_scrittura(sql):
+    """True se l'istruzione modifica dati o schema"""
+    parola = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+    if parola == 'WITH':
+        return re.search(r'\b(INSERT|UPDATE|DELETE)\b', sql, re.IGNORECASE) is not None
+    return parola in ('INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'CREATE', 'ALTER', 'DROP')
+
+def _registra_scrittura(sql):
+    if not _scrittura_richiesta.get() and isinstance(sql, str) and _e_scrittura(sql):
+        _scrittura_richiesta.set(True)
+
 def exec_sql(cursor, sql: str, params=()):
-    """Esegue SQL con adattamento placeholder automatico."""
+    """Esegue SQL con adattamento placeholder automatico.
+
+    Su Postgres le istruzioni eseguite spesso usano PREPARE/EXECUTE.
+    Le scritture vengono annotate: le letture successive della stessa
+    richiesta non usano più la replica (get_read_db).
+    """
+    _registra_scrittura(sql)
+    if IS_POSTGRES and params and PG_PREPARE_THRESHOLD and PG_POOL_SIZE:
+        preparato = _sql_preparato(cursor, sql)
+        if preparato:
+            return cursor.execute(preparato, params)
     return cursor.execute(format_sql(sql), params)
 
+def exec_many(cursor, sql: str, seq_params):
+    """Come exec_sql, per più righe di parametri (executemany)."""
+    _registra_scrittura(sql)
+    if IS_POSTGRES and PG_PREPARE_THRESHOLD and PG_POOL_SIZE:
+        preparato = _sql_preparato(cursor, sql)
+        if preparato:
+            return cursor.executemany(preparato, seq_params)
+    return cursor.executemany(format_sql(sql), seq_params)
+
+_contatore_cursori = itertools.count(1)
+
+def iter_rows(conn, sql: str, params=(), chunk_size=None):
+    """Esegue una SELECT e genera le righe leggendole a blocchi.
+
+    Su Postgres usa un cursore con nome (lato server): il risultato resta sul
+    server e ne arrivano `chunk_size` righe per volta. Su SQLite il cursore è
+    già incrementale e le righe sono lette con fetchmany. La memoria occupata
+    dipende quindi dal blocco e non dal numero di righe.
+
+    Il generatore va consumato sulla stessa connessione, prima di commit o
+    rollback (il cursore Postgres vive dentro la transazione corrente).
+    """
+    chunk_size = chunk_size or STREAM_CHUNK_SIZE
+    if IS_POSTGRES:
+        cursor = conn.cursor(name=f"cp_stream_{next(_contatore_cursori)}")
+        cursor.itersize = chunk_size
+        cursor.execute(format_sql(sql), params)
+    else:
+        cursor = conn.cursor()
+        exec_sql(cursor, sql, params)
+    try:
+        while True:
+            righe = cursor.fetchmany(chunk_size)
+            if not righe:
+                break
+            yield from righe
+    finally:
+        cursor.close()
+
+def sql_anno(colonna: str) -> str:
+    """Espressione SQL (intera) per l'anno di una colonna data/timestamp."""
+    if IS_POSTGRES:
+        return f"CAST(EXTRACT(YEAR FROM {colonna}) AS INTEGER)"
+    return f"CAST(strftime('%Y', {colonna}) AS INTEGER)"
+
+def sql_mese(colonna: str) -> str:
+    """Espressione SQL (intera, 1-12) per il mese di una colonna data/timestamp."""
+    if IS_POSTGRES:
+        return f"CAST(EXTRACT(MONTH FROM {colonna}) AS INTEGER)"
+    return f"CAST(strftime('%m', {colonna}) AS INTEGER)"
+
+# Documento full-text (Postgres) per ogni tabella ricercabile: deve coincidere
+# con l'espressione degli indici GIN creati dalle migrazioni
+TSVECTOR_RICERCA = {
+    'spese': "to_tsvector('simple', descrizione)",
+    'spese_preventivate': "to_tsvector('simple', descrizione || ' ' || COALESCE(note, ''))",
+}
+
 def get_db():
     """Ottiene una connessione al database (SQLite o PostgreSQL)"""
     if IS_POSTGRES:
@@ -35,317 +257,413 @@ def get_db():
     else:
         return get_sqlite_db()
 
-def get_sqlite_db():
-    """Connessione SQLite per sviluppo locale"""
-    DATABASE_PATH = os.getenv('CONDOMINIO_DB_PATH', 'condominio_nuovo.db')
-    conn = sqlite3.connect(DATABASE_PATH, timeout=30.0)
+def get_sqlite_db(percorso=None, sola_lettura=False):
+    """Connessione SQLite per sviluppo locale (dal pool del processo).
+
+    Con SQLITE_SHARDING attivo e uno shard impostato per la richiesta
+    (imposta_shard) apre il file dell'utente, altrimenti il catalogo.
+    Con `sola_lettura` apre il file in mode=ro (nessun lock di scrittura).
+    """
+    if percorso is None:
+        user_id = _shard_corrente.get() if SQLITE_SHARDING else None
+        if user_id is not None:
+            return _connessione_shard(user_id, sola_lettura)
+        percorso = percorso_catalogo()
+    return _pool_sqlite.prendi(percorso, sola_lettura)
+
+class ConnessioneSQLite(sqlite3.Connection):
+    """Connessione sqlite3 del pool: close() la restituisce al pool"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chiave = None
+        self.nel_pool = False
+        self.pool = None
+
+    def close(self):
+        if self.nel_pool:
+            return
+        if self.pool is not None:
+            self.pool.restituisci(self)
+        else:
+            super().close()
+
+    def chiudi(self):
+        """Chiude davvero la connessione"""
+        super().close()
+
+class ConnessionePrestata:
+    """Connessione consegnata dal pool a un chiamante.
+
+    Il primo close() restituisce la connessione al pool, i successivi non
+    fanno nulla: molti chiamanti chiudono sia nel ramo normale sia in
+    except/finally, e la stessa connessione, nel frattempo presa da un altro
+    thread, non deve tornare nel pool una seconda volta. Il resto è delegato
+    alla connessione (anche isinstance, tramite __class__). `errore` è
+    l'eccezione del driver per l'uso dopo la chiusura.
+    """
+
+    __slots__ = ('_conn', '_errore')
+
+    def __init__(self, conn, errore=sqlite3.ProgrammingError):
+        object.__setattr__(self, '_conn', conn)
+        object.__setattr__(self, '_errore', errore)
+
+    @property
+    def __class__(self):
+        return type(self._conn)
+
+    def _connessione(self):
+        conn = object.__getattribute__(self, '_conn')
+        if conn is None:
+            raise object.__getattribute__(self, '_errore')('connessione già chiusa')
+        return conn
+
+    def __getattr__(self, nome):
+        return getattr(self._connessione(), nome)
+
+    def __setattr__(self, nome, valore):
+        setattr(self._connessione(), nome, valore)
+
+    def __enter__(self):
+        self._connessione().__enter__()
+        return self
+
+    def __exit__(self, *eccezione):
+        return self._connessione().__exit__(*eccezione)
+
+    def close(self):
+        conn = object.__getattribute__(self, '_conn')
+        if conn is not None:
+            object.__setattr__(self, '_conn', None)
+            conn.close()
+
+def _apri_sqlite(percorso, sola_lettura):
+    """Nuova connessione SQLite configurata con il profilo PRAGMA"""
+    # sqlite3 riusa le istruzioni già compilate sulla connessione (cache per testo SQL);
+    # check_same_thread=False: dal pool la connessione passa tra i thread (una richiesta alla volta)
+    if sola_lettura:
+        conn = sqlite3.connect(f"file:{pathname2url(percorso)}?mode=ro", uri=True, timeout=30.0,
+                               cached_statements=256, check_same_thread=False, factory=ConnessioneSQLite)
+    else:
+        conn = sqlite3.connect(percorso, timeout=30.0, cached_statements=256,
+                               check_same_thread=False, factory=ConnessioneSQLite)
     conn.row_factory = sqlite3.Row
 
-    # Configurazione SQLite
-    conn.execute('PRAGMA journal_mode=WAL')
-    conn.execute('PRAGMA synchronous=NORMAL')
-    conn.execute('PRAGMA cache_size=10000')
-    conn.execute('PRAGMA temp_store=MEMORY')
+    # Configurazione SQLite (journal e sync si impostano solo in scrittura)
+    if not sola_lettura:
+        conn.execute('PRAGMA journal_mode=WAL')
+        _file_sqlite_usati.add(percorso)
+    for pragma, valore in PROFILO_SQLITE.items():
+        if not sola_lettura or pragma in PRAGMA_LETTURA:
+            conn.execute(f'PRAGMA {pragma}={valore}')
 
     return conn
 
-def get_postgres_db():
-    """Connessione PostgreSQL per produzione"""
-    conn = psycopg2.connect(DATABASE_URL)
-    return conn
+class PoolSQLite:
+    """Pool di connessioni SQLite per processo, per file e modalità.
 
-def init_db():
-    """Inizializza il database con tutte le tabelle necessarie"""
+    Conserva fino a `dimensione` connessioni inattive in totale (LIFO; oltre il
+    limite chiude la meno recente), così profilo PRAGMA e istruzioni compilate
+    restano validi tra le richieste. Dopo un fork le connessioni del processo
+    padre non vengono riusate.
+    """
+
+    def __init__(self, dimensione):
+        self.dimensione = dimensione
+        self._libere = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def prendi(self, percorso, sola_lettura=False):
+        chiave = (os.path.abspath(percorso), sola_lettura)
+        conn = None
+        with self._lock:
+            if self._pid != os.getpid():
+                self._libere = []
+                self._pid = os.getpid()
+            for i in range(len(self._libere) - 1, -1, -1):
+                if self._libere[i].chiave == chiave:
+                    conn = self._libere.pop(i)
+                    break
+        if conn is None:
+            conn = _apri_sqlite(*chiave)
+            conn.chiave = chiave
+            conn.pool = self
+        conn.nel_pool = False
+        return ConnessionePrestata(conn)
+
+    def restituisci(self, conn):
+        try:
+            # Annulla eventuali transazioni lasciate aperte (come farebbe la chiusura)
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.chiudi()
+            return
+        eccedente = conn
+        with self._lock:
+            if self._pid == os.getpid() and self.dimensione > 0:
+                conn.nel_pool = True
+                self._libere.append(conn)
+                eccedente = self._libere.pop(0) if len(self._libere) > self.dimensione else None
+        if eccedente is not None:
+            eccedente.nel_pool = False
+            eccedente.chiudi()
+
+_pool_sqlite = PoolSQLite(SQLITE_POOL_SIZE)
+
+# File SQLite aperti in scrittura da questo processo (per la manutenzione periodica)
+_file_sqlite_usati = set()
+
+def file_sqlite_in_uso():
+    return sorted(_file_sqlite_usati)
+
+def get_catalog_db():
+    """Connessione al database condiviso di utenti e token (mai uno shard)"""
     if IS_POSTGRES:
-        init_postgres_db()
-    else:
-        init_sqlite_db()
+        return get_postgres_db()
+    return get_sqlite_db(percorso_catalogo())
+
+# ======================
+# SHARD SQLITE PER UTENTE
+# ======================
+
+# user_id dello shard usato dalla richiesta corrente (None = catalogo)
+_shard_corrente = contextvars.ContextVar('shard_corrente', default=None)
+# True dopo la prima scrittura della richiesta corrente (read-your-writes)
+_scrittura_richiesta = contextvars.ContextVar('scrittura_richiesta', default=False)
+_shard_pronti = set()
+_shard_lock = threading.Lock()
+
+def percorso_catalogo():
+    return os.getenv('CONDOMINIO_DB_PATH', 'condominio_nuovo.db')
 
-def init_sqlite_db():
-    """Inizializza il database SQLite"""
-    conn = get_sqlite_db()
+def percorso_shard(user_id):
+    """File SQLite dello shard di un utente (di default in 'shards/' accanto al catalogo)"""
+    cartella = SQLITE_SHARD_DIR or os.path.join(os.path.dirname(os.path.abspath(percorso_catalogo())), 'shards')
+    return os.path.join(cartella, f"utente_{int(user_id)}.db")
+
+def imposta_shard(user_id):
+    """Instrada le connessioni successive di questo contesto allo shard dell'utente.
+
+    Ritorna il token da passare a ripristina_shard a fine richiesta.
+    """
+    return _shard_corrente.set(user_id if SQLITE_SHARDING else None)
+
+def ripristina_shard(token):
+    _shard_corrente.reset(token)
+
+def nello_shard_corrente(generatore):
+    """Consuma `generatore` nello shard attivo ora (risposte in streaming, iterate
+    dopo la fine della view)"""
+    user_id = _shard_corrente.get()
+
+    def itera():
+        token = _shard_corrente.set(user_id)
+        try:
+            yield from generatore
+        finally:
+            _shard_corrente.reset(token)
+    return itera()
+
+def prepara_shard(conn, user_id):
+    """Porta lo schema dello shard all'ultima versione e sposta i contatori
+    AUTOINCREMENT all'inizio del blocco di id dell'utente."""
+    from migrations import applica_migrazioni
+    applica_migrazioni(conn, verbose=False)
+
+    inizio = int(user_id) * SHARD_ID_BLOCCO
     cursor = conn.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND sql LIKE '%AUTOINCREMENT%'")
+    for (tabella,) in cursor.fetchall():
+        cursor.execute("""
+            INSERT INTO sqlite_sequence (name, seq)
+            SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)
+        """, (tabella, inizio, tabella))
+        cursor.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = ? AND seq < ?", (inizio, tabella, inizio))
+    conn.commit()
 
-    # Aggiunge la colonna data_spesa se non esiste
-    try:
-        cursor.execute("ALTER TABLE spese ADD COLUMN data_spesa DATE")
-        cursor.execute("UPDATE spese SET data_spesa = DATE(created_at) WHERE data_spesa IS NULL")
-    except sqlite3.OperationalError:
+def _connessione_shard(user_id, sola_lettura=False):
+    percorso = percorso_shard(user_id)
+    if percorso not in _shard_pronti:
+        with _shard_lock:
+            if percorso not in _shard_pronti:
+                os.makedirs(os.path.dirname(percorso), exist_ok=True)
+                conn = get_sqlite_db(percorso)
+                try:
+                    prepara_shard(conn, user_id)
+                finally:
+                    conn.close()
+                _shard_pronti.add(percorso)
+    return get_sqlite_db(percorso, sola_lettura)
+
+if PSYCOPG2_AVAILABLE:
+    class ConnessionePostgres(psycopg2.extensions.connection):
+        """Connessione psycopg2 del pool: close() la restituisce al pool.
+
+        Tiene traccia delle istruzioni preparate lato server su questa sessione.
+        """
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.preparati = set()
+            self.nel_pool = False
+            self.pool = None
+
+        def close(self):
+            if not self.nel_pool and self.pool is not None:
+                self.pool.restituisci(self)
+            elif not self.nel_pool:
+                super().close()
+
+        def chiudi(self):
+            """Chiude davvero la connessione"""
+            super().close()
+else:
+    class ConnessionePostgres:
         pass
 
-    # Tabella users
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # Tabella condominii
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS condominii (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            nome TEXT NOT NULL,
-            indirizzo TEXT,
-            num_unita INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Tabella unita_immobiliari
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS unita_immobiliari (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            condominio_id INTEGER NOT NULL,
-            numero_unita INTEGER NOT NULL,
-            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE,
-            UNIQUE (condominio_id, numero_unita)
-        )
-    ''')
-
-    # Tabella persone
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS persone (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            condominio_id INTEGER NOT NULL,
-            unita_id INTEGER NOT NULL,
-            nome TEXT NOT NULL,
-            cognome TEXT NOT NULL,
-            email TEXT,
-            tipo_persona TEXT NOT NULL CHECK (tipo_persona IN ('proprietario', 'inquilino', 'proprietario_inquilino')),
-            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE,
-            FOREIGN KEY (unita_id) REFERENCES unita_immobiliari(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Tabella millesimi
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS millesimi (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            condominio_id INTEGER NOT NULL,
-            unita_id INTEGER NOT NULL,
-            tabella TEXT NOT NULL CHECK (tabella IN ('A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'L')),
-            valore INTEGER NOT NULL CHECK (valore >= 0 AND valore <= 1000),
-            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE,
-            FOREIGN KEY (unita_id) REFERENCES unita_immobiliari(id) ON DELETE CASCADE,
-            UNIQUE (condominio_id, unita_id, tabella)
-        )
-    ''')
-
-    # Tabella spese
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS spese (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            condominio_id INTEGER NOT NULL,
-            descrizione TEXT NOT NULL,
-            importo REAL NOT NULL CHECK (importo > 0),
-            data_spesa DATE NOT NULL,
-            tabella_millesimi TEXT NOT NULL CHECK (tabella_millesimi IN ('A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'L')),
-            logica_pi TEXT NOT NULL CHECK (logica_pi IN ('proprietario', 'inquilino', '50/50', 'personalizzato')),
-            percentuale_proprietario REAL DEFAULT 100 CHECK (percentuale_proprietario >= 0 AND percentuale_proprietario <= 100),
-            percentuale_inquilino REAL DEFAULT 0 CHECK (percentuale_inquilino >= 0 AND percentuale_inquilino <= 100),
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Tabella ripartizione_spese
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS ripartizione_spese (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            condominio_id INTEGER NOT NULL,
-            persona_id INTEGER NOT NULL,
-            spesa_id INTEGER NOT NULL,
-            importo_dovuto REAL NOT NULL,
-            anno INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE,
-            FOREIGN KEY (persona_id) REFERENCES persone(id) ON DELETE CASCADE,
-            FOREIGN KEY (spesa_id) REFERENCES spese(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Tabella preventivi_annuali
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS preventivi_annuali (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            condominio_id INTEGER NOT NULL,
-            anno INTEGER NOT NULL,
-            importo_totale_preventivato REAL NOT NULL,
-            importo_totale_speso REAL DEFAULT 0,
-            differenza REAL DEFAULT 0,
-            note TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE,
-            UNIQUE (condominio_id, anno)
-        )
-    ''')
-
-    # Tabella spese_preventivate
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS spese_preventivate (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            condominio_id INTEGER NOT NULL,
-            preventivo_id INTEGER NOT NULL,
-            descrizione TEXT NOT NULL,
-            importo_previsto REAL NOT NULL CHECK (importo_previsto > 0),
-            tabella_millesimi TEXT NOT NULL CHECK (tabella_millesimi IN ('A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'L')),
-            logica_pi TEXT NOT NULL CHECK (logica_pi IN ('proprietario', 'inquilino', '50/50', 'personalizzato')),
-            percentuale_proprietario REAL DEFAULT 100 CHECK (percentuale_proprietario >= 0 AND percentuale_proprietario <= 100),
-            percentuale_inquilino REAL DEFAULT 0 CHECK (percentuale_inquilino >= 0 AND percentuale_inquilino <= 100),
-            mese_previsto INTEGER CHECK (mese_previsto BETWEEN 1 AND 12),
-            data_prevista DATE,
-            note TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE,
-            FOREIGN KEY (preventivo_id) REFERENCES preventivi_annuali(id) ON DELETE CASCADE
-        )
-    ''')
-
-    # Aggiunge colonna data_prevista se non esiste
-    try:
-        cursor.execute("ALTER TABLE spese_preventivate ADD COLUMN data_prevista DATE")
-    except sqlite3.OperationalError:
-        pass
+class PoolPostgres:
+    """Pool minimo di connessioni psycopg2 per processo.
 
-    conn.commit()
+    Conserva fino a `dimensione` connessioni inattive (LIFO); le connessioni in
+    uso non sono limitate. Dopo un fork le connessioni del processo padre non
+    vengono riusate.
+    """
+
+    def __init__(self, dimensione, url, sola_lettura=False):
+        self.dimensione = dimensione
+        self.url = url
+        self.sola_lettura = sola_lettura
+        self._libere = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def prendi(self):
+        conn = None
+        with self._lock:
+            if self._pid != os.getpid():
+                self._libere = []
+                self._pid = os.getpid()
+            while self._libere and conn is None:
+                conn = self._libere.pop()
+                if conn.closed or conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    conn = None
+        if conn is None:
+            # RealDictCursor: le righe sono accessibili per nome come sqlite3.Row
+            conn = psycopg2.connect(self.url, cursor_factory=RealDictCursor,
+                                    connection_factory=ConnessionePostgres)
+            conn.pool = self
+            if self.sola_lettura:
+                conn.set_session(readonly=True)
+        conn.nel_pool = False
+        return ConnessionePrestata(conn, psycopg2.InterfaceError)
+
+    def restituisci(self, conn):
+        if conn.closed:
+            return
+        try:
+            # Annulla eventuali transazioni lasciate aperte (come farebbe la chiusura)
+            conn.rollback()
+            if conn.autocommit:
+                conn.autocommit = False
+        except psycopg2.Error:
+            conn.chiudi()
+            return
+        with self._lock:
+            if self._pid == os.getpid() and len(self._libere) < self.dimensione:
+                conn.nel_pool = True
+                self._libere.append(conn)
+                return
+        conn.chiudi()
+
+_pool_postgres = PoolPostgres(PG_POOL_SIZE, DATABASE_URL)
+_pool_replica = PoolPostgres(PG_POOL_SIZE, DATABASE_REPLICA_URL, sola_lettura=True)
+
+def get_postgres_db():
+    """Connessione PostgreSQL per produzione (dal pool del processo)"""
+    return _pool_postgres.prendi()
+
+def get_read_db(*condominii):
+    """Connessione per richieste di sola lettura.
+
+    Usa la replica (DATABASE_REPLICA_URL) o, su SQLite, una connessione mode=ro
+    (SQLITE_READ_ONLY); altrimenti è uguale a get_db(). Ritorna il primario se
+    la richiesta ha già scritto, o se la replica non ha ancora raggiunto la
+    data_version dei `condominii` indicati (le risposte con ETag derivato da
+    quella versione non devono contenere dati più vecchi).
+    """
+    if _scrittura_richiesta.get():
+        return get_db()
+    if SQLITE_READ_ONLY:
+        return get_sqlite_db(sola_lettura=True)
+    if not DATABASE_REPLICA_URL:
+        return get_db()
+
+    conn = _pool_replica.prendi()
+    try:
+        aggiornata = _replica_aggiornata(conn, condominii)
+        # Chiude la transazione del controllo: begin_read_snapshot deve essere la prima istruzione
+        conn.rollback()
+    except psycopg2.Error:
+        aggiornata = False
+    if aggiornata:
+        return conn
     conn.close()
-    print(f"Database SQLite inizializzato con successo")
+    return get_db()
 
-def init_postgres_db():
-    """Inizializza il database PostgreSQL"""
-    conn = get_postgres_db()
+def _replica_aggiornata(conn, condominii):
+    attese = {c.id: c.data_version or 0 for c in condominii}
+    if not attese:
+        return True
     cursor = conn.cursor()
+    segnaposto = ', '.join(['?'] * len(attese))
+    cursor.execute(format_sql(f"SELECT id, data_version FROM condominii WHERE id IN ({segnaposto})"),
+                   tuple(attese))
+    viste = {row['id']: row['data_version'] or 0 for row in cursor.fetchall()}
+    return all(viste.get(cid, -1) >= versione for cid, versione in attese.items())
+
+def segna_scrittura():
+    """Annota una scrittura della richiesta eseguita su un'altra connessione/thread"""
+    _scrittura_richiesta.set(True)
+
+def percorso_db_corrente():
+    """File SQLite usato da get_db() in questo contesto (shard dell'utente o catalogo)"""
+    user_id = _shard_corrente.get() if SQLITE_SHARDING else None
+    if user_id is not None:
+        _connessione_shard(user_id).close()  # crea e migra lo shard se serve
+        return percorso_shard(user_id)
+    return percorso_catalogo()
+
+def nuova_richiesta_db():
+    """Azzera l'annotazione delle scritture all'inizio di una richiesta.
+
+    Ritorna il token da passare a fine_richiesta_db.
+    """
+    return _scrittura_richiesta.set(False)
 
-    # Tabella users
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id SERIAL PRIMARY KEY,
-            username TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # Tabella condominii
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS condominii (
-            id SERIAL PRIMARY KEY,
-            user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-            nome TEXT NOT NULL,
-            indirizzo TEXT,
-            num_unita INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # Tabella unita_immobiliari
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS unita_immobiliari (
-            id SERIAL PRIMARY KEY,
-            condominio_id INTEGER NOT NULL REFERENCES condominii(id) ON DELETE CASCADE,
-            numero_unita INTEGER NOT NULL,
-            UNIQUE (condominio_id, numero_unita)
-        )
-    ''')
-
-    # Tabella persone
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS persone (
-            id SERIAL PRIMARY KEY,
-            condominio_id INTEGER NOT NULL REFERENCES condominii(id) ON DELETE CASCADE,
-            unita_id INTEGER NOT NULL REFERENCES unita_immobiliari(id) ON DELETE CASCADE,
-            nome TEXT NOT NULL,
-            cognome TEXT NOT NULL,
-            email TEXT,
-            tipo_persona TEXT NOT NULL CHECK (tipo_persona IN ('proprietario', 'inquilino', 'proprietario_inquilino'))
-        )
-    ''')
-
-    # Tabella millesimi
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS millesimi (
-            id SERIAL PRIMARY KEY,
-            condominio_id INTEGER NOT NULL REFERENCES condominii(id) ON DELETE CASCADE,
-            unita_id INTEGER NOT NULL REFERENCES unita_immobiliari(id) ON DELETE CASCADE,
-            tabella TEXT NOT NULL CHECK (tabella IN ('A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'L')),
-            valore INTEGER NOT NULL CHECK (valore >= 0 AND valore <= 1000),
-            UNIQUE (condominio_id, unita_id, tabella)
-        )
-    ''')
-
-    # Tabella spese
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS spese (
-            id SERIAL PRIMARY KEY,
-            condominio_id INTEGER NOT NULL REFERENCES condominii(id) ON DELETE CASCADE,
-            descrizione TEXT NOT NULL,
-            importo REAL NOT NULL CHECK (importo > 0),
-            data_spesa DATE NOT NULL,
-            tabella_millesimi TEXT NOT NULL CHECK (tabella_millesimi IN ('A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'L')),
-            logica_pi TEXT NOT NULL CHECK (logica_pi IN ('proprietario', 'inquilino', '50/50', 'personalizzato')),
-            percentuale_proprietario REAL DEFAULT 100 CHECK (percentuale_proprietario >= 0 AND percentuale_proprietario <= 100),
-            percentuale_inquilino REAL DEFAULT 0 CHECK (percentuale_inquilino >= 0 AND percentuale_inquilino <= 100),
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # Tabella ripartizione_spese
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS ripartizione_spese (
-            id SERIAL PRIMARY KEY,
-            condominio_id INTEGER NOT NULL REFERENCES condominii(id) ON DELETE CASCADE,
-            persona_id INTEGER NOT NULL REFERENCES persone(id) ON DELETE CASCADE,
-            spesa_id INTEGER NOT NULL REFERENCES spese(id) ON DELETE CASCADE,
-            importo_dovuto REAL NOT NULL,
-            anno INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # Tabella preventivi_annuali
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS preventivi_annuali (
-            id SERIAL PRIMARY KEY,
-            condominio_id INTEGER NOT NULL REFERENCES condominii(id) ON DELETE CASCADE,
-            anno INTEGER NOT NULL,
-            importo_totale_preventivato REAL NOT NULL,
-            importo_totale_speso REAL DEFAULT 0,
-            differenza REAL DEFAULT 0,
-            note TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE (condominio_id, anno)
-        )
-    ''')
-
-    # Tabella spese_preventivate
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS spese_preventivate (
-            id SERIAL PRIMARY KEY,
-            condominio_id INTEGER NOT NULL REFERENCES condominii(id) ON DELETE CASCADE,
-            preventivo_id INTEGER NOT NULL REFERENCES preventivi_annuali(id) ON DELETE CASCADE,
-            descrizione TEXT NOT NULL,
-            importo_previsto REAL NOT NULL CHECK (importo_previsto > 0),
-            tabella_millesimi TEXT NOT NULL CHECK (tabella_millesimi IN ('A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'L')),
-            logica_pi TEXT NOT NULL CHECK (logica_pi IN ('proprietario', 'inquilino', '50/50', 'personalizzato')),
-            percentuale_proprietario REAL DEFAULT 100 CHECK (percentuale_proprietario >= 0 AND percentuale_proprietario <= 100),
-            percentuale_inquilino REAL DEFAULT 0 CHECK (percentuale_inquilino >= 0 AND percentuale_inquilino <= 100),
-            mese_previsto INTEGER CHECK (mese_previsto BETWEEN 1 AND 12),
-            data_prevista DATE,
-            note TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
+def fine_richiesta_db(token):
+    _scrittura_richiesta.reset(token)
 
-    conn.commit()
-    conn.close()
-    print("Database PostgreSQL inizializzato con successo")
+def begin_read_snapshot(conn):
+    """Apre una transazione di sola lettura con vista consistente dei dati.
+
+    Tutte le query successive sulla connessione vedono lo stesso stato del
+    database (utile per risposte composte da più query).
+    """
+    if IS_POSTGRES:
+        conn.cursor().execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+    else:
+        conn.execute("BEGIN")
+
+def init_db():
+    """Inizializza/aggiorna lo schema tramite le migrazioni versionate.
+
+    Se lo schema è già alla versione corrente non viene eseguito alcun DDL.
+    """
+    from migrations import applica_migrazioni
+    applica_migrazioni()
 
 def create_default_user():
     """Crea l'utente di default se non esiste"""
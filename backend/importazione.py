@@ -0,0 +1,196 @@
+import os
+import io
+import math
+import csv
+import itertools
+from datetime import datetime, date
+
+# openpyxl è opzionale: senza la libreria si importano solo file CSV
+try:
+    from openpyxl import load_workbook
+    OPENPYXL_AVAILABLE = True
+except ImportError:
+    OPENPYXL_AVAILABLE = False
+
+# Righe validate e inserite per ogni transazione
+IMPORT_CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE', '500'))
+
+# Numero massimo di righe con errori riportate nella risposta (il conteggio resta completo)
+MAX_ERRORI_RIPORTATI = 200
+
+# Intestazioni accettate (minuscole) -> campo della spesa
+ALIAS_COLONNE = {
+    'descrizione': 'descrizione',
+    'causale': 'descrizione',
+    'importo': 'importo',
+    'data_spesa': 'data_spesa',
+    'data': 'data_spesa',
+    'tabella_millesimi': 'tabella_millesimi',
+    'tabella': 'tabella_millesimi',
+    'logica_pi': 'logica_pi',
+    'logica': 'logica_pi',
+    'percentuale_proprietario': 'percentuale_proprietario',
+    'percentuale_inquilino': 'percentuale_inquilino',
+}
+
+COLONNE_OBBLIGATORIE = ('descrizione', 'importo', 'tabella_millesimi', 'logica_pi')
+
+FORMATI_DATA = ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y')
+
+def formato_file(nome_file):
+    """Formato dedotto dall'estensione del file ('csv', 'xlsx' o None)"""
+    estensione = os.path.splitext(nome_file or '')[1].lower()
+    return {'.csv': 'csv', '.xlsx': 'xlsx'}.get(estensione)
+
+def _intestazione(valori):
+    """Mappa indice colonna -> campo spesa; ValueError se mancano colonne obbligatorie"""
+    colonne = {}
+    for indice, valore in enumerate(valori):
+        campo = ALIAS_COLONNE.get(str(valore or '').strip().lower())
+        if campo and campo not in colonne.values():
+            colonne[indice] = campo
+    mancanti = [c for c in COLONNE_OBBLIGATORIE if c not in colonne.values()]
+    if mancanti:
+        raise ValueError(f"Colonne obbligatorie mancanti: {', '.join(mancanti)}")
+    return colonne
+
+def _righe_csv(stream):
+    testo = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    prima = testo.readline()
+    # Gli export bancari italiani usano spesso il punto e virgola
+    separatore = ';' if prima.count(';') > prima.count(',') else ','
+    return csv.reader(itertools.chain([prima], testo), delimiter=separatore)
+
+def _righe_xlsx(stream):
+    if not OPENPYXL_AVAILABLE:
+        raise ValueError('Import XLSX non disponibile (libreria openpyxl non installata)')
+    workbook = load_workbook(stream, read_only=True, data_only=True)
+    try:
+        yield from workbook.active.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+def leggi_righe(stream, formato):
+    """Legge il file una riga alla volta: genera (numero_riga, {campo: valore}).
+
+    La riga 1 è l'intestazione; le righe vuote vengono saltate.
+    """
+    righe = _righe_csv(stream) if formato == 'csv' else _righe_xlsx(stream)
+    try:
+        colonne = _intestazione(next(righe))
+    except StopIteration:
+        raise ValueError('File vuoto')
+
+    for numero_riga, valori in enumerate(righe, start=2):
+        if not any(v not in (None, '') and str(v).strip() for v in valori):
+            continue
+        yield numero_riga, {campo: valori[i] for i, campo in colonne.items() if i < len(valori)}
+
+def _numero(valore):
+    """Numero da cella XLSX o testo CSV ('1.234,56', '1234.56', '€ 12,50')"""
+    if isinstance(valore, (int, float)) and not isinstance(valore, bool):
+        return valore
+    testo = str(valore or '').replace('€', '').replace(' ', '').strip()
+    if not testo:
+        return None
+    if ',' in testo:
+        testo = testo.replace('.', '').replace(',', '.')
+    numero = float(testo)
+    if not math.isfinite(numero):
+        raise ValueError(testo)
+    return numero
+
+def _data(valore):
+    """Data ISO (YYYY-MM-DD) da cella XLSX o testo CSV"""
+    if isinstance(valore, datetime):
+        return valore.date().isoformat()
+    if isinstance(valore, date):
+        return valore.isoformat()
+    testo = str(valore).strip()
+    for formato in FORMATI_DATA:
+        try:
+            return datetime.strptime(testo, formato).date().isoformat()
+        except ValueError:
+            continue
+    raise ValueError(testo)
+
+def normalizza_riga(riga):
+    """Converte una riga letta dal file nel formato di validate_spesa_data.
+
+    Ritorna (dati, errori di formato).
+    """
+    dati = {
+        'descrizione': str(riga.get('descrizione') or '').strip(),
+        'tabella_millesimi': str(riga.get('tabella_millesimi') or '').strip().upper(),
+        'logica_pi': str(riga.get('logica_pi') or '').strip().lower(),
+    }
+    errori = []
+
+    for campo in ('importo', 'percentuale_proprietario', 'percentuale_inquilino'):
+        if riga.get(campo) in (None, ''):
+            continue
+        try:
+            dati[campo] = _numero(riga[campo])
+        except ValueError:
+            errori.append(f'{campo} non numerico: {riga[campo]}')
+
+    if riga.get('data_spesa') not in (None, ''):
+        try:
+            dati['data_spesa'] = _data(riga['data_spesa'])
+        except ValueError:
+            errori.append(f"Data non valida: {riga['data_spesa']} (usa YYYY-MM-DD o GG/MM/AAAA)")
+    else:
+        dati['data_spesa'] = datetime.now().strftime('%Y-%m-%d')
+
+    return dati, errori
+
+def importa_spese(condominio_id, righe, dry_run=False):
+    """Valida e inserisce le spese a blocchi di IMPORT_CHUNK_SIZE righe.
+
+    Le righe valide di ogni blocco sono inserite in una sola transazione, le
+    righe con errori vengono scartate e riportate con il loro numero. Al termine
+    la ripartizione viene aggiornata una sola volta per le spese nuove.
+    Con `dry_run` esegue solo la validazione.
+    """
+    from models import Spesa
+    from utils import validate_spesa_data, ripartisci_spese_non_ripartite
+
+    report = {'righe_lette': 0, 'valide': 0, 'importate': 0, 'scartate': 0,
+              'errori': [], 'errori_troncati': False}
+
+    while True:
+        try:
+            blocco = list(itertools.islice(righe, IMPORT_CHUNK_SIZE))
+        except ValueError as e:
+            # Intestazione non valida o file non leggibile (anche UnicodeDecodeError)
+            if not report['righe_lette']:
+                raise
+            # File illeggibile a metà: si conserva quanto già importato
+            report['errore_lettura'] = str(e)
+            break
+        if not blocco:
+            break
+
+        valide = []
+        for numero_riga, riga in blocco:
+            dati, errori = normalizza_riga(riga)
+            errori = errori or validate_spesa_data(dati)
+            if errori:
+                report['scartate'] += 1
+                if len(report['errori']) < MAX_ERRORI_RIPORTATI:
+                    report['errori'].append({'riga': numero_riga, 'errori': errori})
+                else:
+                    report['errori_troncati'] = True
+            else:
+                valide.append(dati)
+
+        report['righe_lette'] += len(blocco)
+        report['valide'] += len(valide)
+        if valide and not dry_run:
+            Spesa.insert_many(condominio_id, valide)
+            report['importate'] += len(valide)
+
+    if report['importate'] and not dry_run:
+        report['ripartite'] = ripartisci_spese_non_ripartite(condominio_id)
+
+    return report
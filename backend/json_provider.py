@@ -0,0 +1,63 @@
+import json
+import decimal
+from datetime import date, datetime, time
+from flask.json.provider import DefaultJSONProvider
+
+# orjson è opzionale: senza la libreria si usa il modulo json della libreria standard
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+def json_default(o):
+    """Tipi non nativi JSON: date in ISO 8601, Decimal come numero"""
+    if isinstance(o, (datetime, date, time)):
+        return o.isoformat()
+    if isinstance(o, decimal.Decimal):
+        return float(o)
+    # dataclass, UUID, oggetti con __html__ come nel provider standard di Flask
+    return DefaultJSONProvider.default(o)
+
+class ProviderJSON(DefaultJSONProvider):
+    """Provider JSON dell'app: orjson se installato, altrimenti json standard.
+
+    Le risposte sono prodotte direttamente in byte UTF-8 (senza escape dei
+    caratteri non ASCII), con chiavi ordinate come il provider di Flask.
+    """
+
+    default = staticmethod(json_default)
+    ensure_ascii = False
+
+    def _opzioni_orjson(self, indent=None):
+        # Chiavi non stringa (es. id interi) convertite come fa json standard
+        opzioni = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            opzioni |= orjson.OPT_SORT_KEYS
+        if indent:
+            opzioni |= orjson.OPT_INDENT_2
+        return opzioni
+
+    def dumps_bytes(self, obj, indent=None):
+        """Serializza `obj` in byte UTF-8"""
+        if ORJSON_AVAILABLE:
+            return orjson.dumps(obj, default=json_default, option=self._opzioni_orjson(indent))
+        separatori = None if indent else (',', ':')
+        return json.dumps(obj, default=json_default, ensure_ascii=False, sort_keys=self.sort_keys,
+                          indent=indent, separators=separatori).encode('utf-8')
+
+    def dumps(self, obj, **kwargs):
+        # Argomenti particolari (es. cls, ensure_ascii) restano al modulo standard
+        if ORJSON_AVAILABLE and set(kwargs) <= {'indent', 'separators'}:
+            return self.dumps_bytes(obj, kwargs.get('indent')).decode('utf-8')
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if ORJSON_AVAILABLE and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = 2 if (self.compact is None and self._app.debug) or self.compact is False else None
+        return self._app.response_class(self.dumps_bytes(obj, indent) + b'\n', mimetype=self.mimetype)
@@ -0,0 +1,127 @@
+import os
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from database_universal import IS_POSTGRES, file_sqlite_in_uso
+
+# fcntl non esiste su Windows: senza lock ogni processo esegue la propria manutenzione
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
+# Intervallo tra due giri di manutenzione dei file SQLite (secondi, 0 = disattivata)
+SQLITE_MANUTENZIONE_SECONDI = int(os.getenv('SQLITE_MANUTENZIONE_SECONDI', '300'))
+# Ogni quante ore ricalcolare le statistiche con ANALYZE
+SQLITE_ANALYZE_ORE = float(os.getenv('SQLITE_ANALYZE_ORE', '24'))
+# Oltre questa dimensione (MB) il WAL viene svuotato con un checkpoint TRUNCATE
+SQLITE_WAL_MAX_MB = int(os.getenv('SQLITE_WAL_MAX_MB', '64'))
+
+# Righe esaminate per indice da ANALYZE (statistiche approssimate ma veloci)
+ANALYSIS_LIMIT = 1000
+
+@contextmanager
+def _lock_processi(percorso):
+    """Lock non bloccante tra i worker sullo stesso file: True se ottenuto"""
+    if not FCNTL_AVAILABLE:
+        yield True
+        return
+    try:
+        f = open(f"{percorso}.manutenzione", 'a')
+    except OSError:
+        yield True
+        return
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+class ManutenzioneSQLite:
+    """Manutenzione periodica dei file SQLite, fuori dal percorso delle richieste.
+
+    A ogni giro, per ogni file aperto in scrittura dal processo: checkpoint del
+    WAL (PASSIVE, oppure TRUNCATE se il WAL supera SQLITE_WAL_MAX_MB) e
+    PRAGMA optimize; ogni SQLITE_ANALYZE_ORE un ANALYZE con analysis_limit.
+    Con più worker un lock su file evita che lo stesso lavoro venga ripetuto.
+    """
+
+    def __init__(self, intervallo=SQLITE_MANUTENZIONE_SECONDI, ore_analyze=SQLITE_ANALYZE_ORE):
+        self.intervallo = intervallo
+        self.ore_analyze = ore_analyze
+        self._ultimo_analyze = {}
+        self._ferma = threading.Event()
+        self._thread = None
+
+    def avvia(self):
+        """Avvia il thread (una volta per processo; no-op su Postgres o con intervallo 0)"""
+        if IS_POSTGRES or self.intervallo <= 0 or (self._thread and self._thread.is_alive()):
+            return None
+        self._ferma.clear()
+        self._thread = threading.Thread(target=self._ciclo, name='manutenzione-sqlite', daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def ferma(self):
+        self._ferma.set()
+
+    def _ciclo(self):
+        while not self._ferma.wait(self.intervallo):
+            for percorso in file_sqlite_in_uso():
+                try:
+                    self.esegui(percorso)
+                except Exception as e:
+                    print(f"[Manutenzione SQLite] {percorso}: {str(e)}")
+
+    def esegui(self, percorso):
+        """Un giro di manutenzione su un file; ritorna le operazioni eseguite"""
+        if not os.path.exists(percorso):
+            return []
+        with _lock_processi(percorso) as ottenuto:
+            if not ottenuto:
+                return []
+            # Connessione dedicata, fuori dal pool delle richieste
+            conn = sqlite3.connect(percorso, timeout=5.0)
+            try:
+                return self._esegui(conn, percorso)
+            finally:
+                conn.close()
+
+    def _esegui(self, conn, percorso):
+        eseguite = []
+        wal = f"{percorso}-wal"
+        dimensione_wal = os.path.getsize(wal) if os.path.exists(wal) else 0
+        modo = 'TRUNCATE' if dimensione_wal > SQLITE_WAL_MAX_MB * 1024 * 1024 else 'PASSIVE'
+        conn.execute(f"PRAGMA wal_checkpoint({modo})")
+        eseguite.append(f"checkpoint {modo.lower()}")
+
+        adesso = time.monotonic()
+        if percorso not in self._ultimo_analyze:
+            # Statistiche già presenti: il primo ANALYZE arriva dopo un intero periodo
+            presenti = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'"
+            ).fetchone()
+            self._ultimo_analyze[percorso] = adesso if presenti else None
+
+        ultimo = self._ultimo_analyze[percorso]
+        if ultimo is None or adesso - ultimo >= self.ore_analyze * 3600:
+            conn.execute(f"PRAGMA analysis_limit={ANALYSIS_LIMIT}")
+            conn.execute("ANALYZE")
+            conn.commit()
+            self._ultimo_analyze[percorso] = adesso
+            eseguite.append('analyze')
+        else:
+            conn.execute("PRAGMA optimize")
+            eseguite.append('optimize')
+        return eseguite
+
+manutenzione_sqlite = ManutenzioneSQLite()
@@ -0,0 +1,465 @@
+import sqlite3
+import time
+
+from database_universal import get_db, exec_sql, TSVECTOR_RICERCA
+
+# Dimensione dei lotti per backfill su tabelle grandi
+BATCH_SIZE = 5000
+
+# Identificativo del lock advisory PostgreSQL usato durante le migrazioni
+PG_LOCK_ID = 7210326
+
+TABELLE_CHECK = "('A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'L')"
+LOGICHE_CHECK = "('proprietario', 'inquilino', '50/50', 'personalizzato')"
+
+def is_postgres_conn(conn):
+    """True se la connessione non è SQLite"""
+    return not isinstance(conn, sqlite3.Connection)
+
+def _pk(conn):
+    return 'SERIAL PRIMARY KEY' if is_postgres_conn(conn) else 'INTEGER PRIMARY KEY AUTOINCREMENT'
+
+def _colonne(conn, tabella):
+    """Nomi delle colonne esistenti in una tabella"""
+    cursor = conn.cursor()
+    if is_postgres_conn(conn):
+        exec_sql(cursor, """
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = ?
+        """, (tabella,))
+        return {row['column_name'] for row in cursor.fetchall()}
+    cursor.execute(f"PRAGMA table_info({tabella})")
+    return {row[1] for row in cursor.fetchall()}
+
+def _esegui(conn, *statements):
+    cursor = conn.cursor()
+    for sql in statements:
+        cursor.execute(sql)
+
+def _backfill(conn, sql_update):
+    """Esegue un UPDATE a lotti (parametro ? = dimensione lotto) con commit per lotto,
+    così da non tenere bloccato il database su tabelle grandi."""
+    cursor = conn.cursor()
+    while True:
+        exec_sql(cursor, sql_update, (BATCH_SIZE,))
+        aggiornate = cursor.rowcount
+        conn.commit()
+        if not aggiornate or aggiornate < BATCH_SIZE:
+            break
+
+# ======================
+# MIGRAZIONI
+# ======================
+
+def m001_schema_base(conn):
+    """Tabelle principali"""
+    pk = _pk(conn)
+    _esegui(conn, f'''
+        CREATE TABLE IF NOT EXISTS users (
+            id {pk},
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''', f'''
+        CREATE TABLE IF NOT EXISTS condominii (
+            id {pk},
+            user_id INTEGER NOT NULL,
+            nome TEXT NOT NULL,
+            indirizzo TEXT,
+            num_unita INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+    ''', f'''
+        CREATE TABLE IF NOT EXISTS unita_immobiliari (
+            id {pk},
+            condominio_id INTEGER NOT NULL,
+            numero_unita INTEGER NOT NULL,
+            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE,
+            UNIQUE (condominio_id, numero_unita)
+        )
+    ''', f'''
+        CREATE TABLE IF NOT EXISTS persone (
+            id {pk},
+            condominio_id INTEGER NOT NULL,
+            unita_id INTEGER NOT NULL,
+            nome TEXT NOT NULL,
+            cognome TEXT NOT NULL,
+            email TEXT,
+            tipo_persona TEXT NOT NULL CHECK (tipo_persona IN ('proprietario', 'inquilino', 'proprietario_inquilino')),
+            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE,
+            FOREIGN KEY (unita_id) REFERENCES unita_immobiliari(id) ON DELETE CASCADE
+        )
+    ''', f'''
+        CREATE TABLE IF NOT EXISTS millesimi (
+            id {pk},
+            condominio_id INTEGER NOT NULL,
+            unita_id INTEGER NOT NULL,
+            tabella TEXT NOT NULL CHECK (tabella IN {TABELLE_CHECK}),
+            valore INTEGER NOT NULL CHECK (valore >= 0 AND valore <= 1000),
+            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE,
+            FOREIGN KEY (unita_id) REFERENCES unita_immobiliari(id) ON DELETE CASCADE,
+            UNIQUE (condominio_id, unita_id, tabella)
+        )
+    ''', f'''
+        CREATE TABLE IF NOT EXISTS spese (
+            id {pk},
+            condominio_id INTEGER NOT NULL,
+            descrizione TEXT NOT NULL,
+            importo REAL NOT NULL CHECK (importo > 0),
+            data_spesa DATE NOT NULL,
+            tabella_millesimi TEXT NOT NULL CHECK (tabella_millesimi IN {TABELLE_CHECK}),
+            logica_pi TEXT NOT NULL CHECK (logica_pi IN {LOGICHE_CHECK}),
+            percentuale_proprietario REAL DEFAULT 100 CHECK (percentuale_proprietario >= 0 AND percentuale_proprietario <= 100),
+            percentuale_inquilino REAL DEFAULT 0 CHECK (percentuale_inquilino >= 0 AND percentuale_inquilino <= 100),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE
+        )
+    ''', f'''
+        CREATE TABLE IF NOT EXISTS ripartizione_spese (
+            id {pk},
+            condominio_id INTEGER NOT NULL,
+            persona_id INTEGER NOT NULL,
+            spesa_id INTEGER NOT NULL,
+            importo_dovuto REAL NOT NULL,
+            anno INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE,
+            FOREIGN KEY (persona_id) REFERENCES persone(id) ON DELETE CASCADE,
+            FOREIGN KEY (spesa_id) REFERENCES spese(id) ON DELETE CASCADE
+        )
+    ''', f'''
+        CREATE TABLE IF NOT EXISTS preventivi_annuali (
+            id {pk},
+            condominio_id INTEGER NOT NULL,
+            anno INTEGER NOT NULL,
+            importo_totale_preventivato REAL NOT NULL,
+            importo_totale_speso REAL DEFAULT 0,
+            differenza REAL DEFAULT 0,
+            note TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE,
+            UNIQUE (condominio_id, anno)
+        )
+    ''', f'''
+        CREATE TABLE IF NOT EXISTS spese_preventivate (
+            id {pk},
+            condominio_id INTEGER NOT NULL,
+            preventivo_id INTEGER NOT NULL,
+            descrizione TEXT NOT NULL,
+            importo_previsto REAL NOT NULL CHECK (importo_previsto > 0),
+            tabella_millesimi TEXT NOT NULL CHECK (tabella_millesimi IN {TABELLE_CHECK}),
+            logica_pi TEXT NOT NULL CHECK (logica_pi IN {LOGICHE_CHECK}),
+            percentuale_proprietario REAL DEFAULT 100 CHECK (percentuale_proprietario >= 0 AND percentuale_proprietario <= 100),
+            percentuale_inquilino REAL DEFAULT 0 CHECK (percentuale_inquilino >= 0 AND percentuale_inquilino <= 100),
+            mese_previsto INTEGER CHECK (mese_previsto BETWEEN 1 AND 12),
+            data_prevista DATE,
+            note TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE,
+            FOREIGN KEY (preventivo_id) REFERENCES preventivi_annuali(id) ON DELETE CASCADE
+        )
+    ''')
+
+def m002_spese_data_spesa(conn):
+    """Colonna spese.data_spesa per database creati prima della sua introduzione"""
+    if 'data_spesa' in _colonne(conn, 'spese'):
+        return
+    _esegui(conn, "ALTER TABLE spese ADD COLUMN data_spesa DATE")
+    conn.commit()
+    if is_postgres_conn(conn):
+        _backfill(conn, """
+            UPDATE spese SET data_spesa = created_at::date
+            WHERE id IN (SELECT id FROM spese WHERE data_spesa IS NULL LIMIT ?)
+        """)
+    else:
+        _backfill(conn, """
+            UPDATE spese SET data_spesa = DATE(created_at)
+            WHERE id IN (SELECT id FROM spese WHERE data_spesa IS NULL LIMIT ?)
+        """)
+
+def m003_spese_preventivate_data_prevista(conn):
+    """Colonna spese_preventivate.data_prevista"""
+    if 'data_prevista' not in _colonne(conn, 'spese_preventivate'):
+        _esegui(conn, "ALTER TABLE spese_preventivate ADD COLUMN data_prevista DATE")
+
+def m004_tabelle_preventivo(conn):
+    """Tabelle presenti solo nello schema SQLite storico (database.py)"""
+    pk = _pk(conn)
+    _esegui(conn, f'''
+        CREATE TABLE IF NOT EXISTS ripartizione_preventivo (
+            id {pk},
+            condominio_id INTEGER NOT NULL,
+            preventivo_id INTEGER NOT NULL,
+            persona_id INTEGER NOT NULL,
+            importo_previsto_dovuto REAL NOT NULL,
+            anno INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE,
+            FOREIGN KEY (preventivo_id) REFERENCES preventivi_annuali(id) ON DELETE CASCADE,
+            FOREIGN KEY (persona_id) REFERENCES persone(id) ON DELETE CASCADE,
+            UNIQUE (preventivo_id, persona_id)
+        )
+    ''', f'''
+        CREATE TABLE IF NOT EXISTS preventivi_dettaglio (
+            id {pk},
+            preventivo_id INTEGER NOT NULL,
+            persona_id INTEGER NOT NULL,
+            importo_preventivato REAL NOT NULL,
+            importo_effettivo REAL DEFAULT 0,
+            differenza REAL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (preventivo_id) REFERENCES preventivi_annuali(id) ON DELETE CASCADE,
+            FOREIGN KEY (persona_id) REFERENCES persone(id) ON DELETE CASCADE,
+            UNIQUE (preventivo_id, persona_id)
+        )
+    ''', f'''
+        CREATE TABLE IF NOT EXISTS storici_anni (
+            id {pk},
+            condominio_id INTEGER NOT NULL,
+            anno INTEGER NOT NULL,
+            importo_totale_speso REAL NOT NULL,
+            note TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE,
+            UNIQUE (condominio_id, anno)
+        )
+    ''')
+
+def m005_indici(conn):
+    """Indici sulle colonne usate nei filtri per condominio/persona"""
+    indici = [
+        "idx_condominii_user ON condominii (user_id)",
+        "idx_persone_condominio ON persone (condominio_id)",
+        "idx_persone_unita ON persone (unita_id)",
+        "idx_millesimi_unita_tabella ON millesimi (unita_id, tabella)",
+        "idx_spese_condominio_data ON spese (condominio_id, data_spesa)",
+        "idx_ripartizione_spese_condominio ON ripartizione_spese (condominio_id, persona_id)",
+        "idx_ripartizione_spese_spesa ON ripartizione_spese (spesa_id)",
+        "idx_spese_preventivate_preventivo ON spese_preventivate (preventivo_id)",
+    ]
+    if is_postgres_conn(conn):
+        # CONCURRENTLY evita di bloccare le scritture, ma richiede autocommit
+        conn.commit()
+        conn.autocommit = True
+        try:
+            for indice in indici:
+                _esegui(conn, f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {indice}")
+        finally:
+            conn.autocommit = False
+    else:
+        for indice in indici:
+            _esegui(conn, f"CREATE INDEX IF NOT EXISTS {indice}")
+            conn.commit()
+
+def m006_condominii_data_version(conn):
+    """Versione dati per condominio, incrementata ad ogni scrittura (ETag/cache)"""
+    if 'data_version' not in _colonne(conn, 'condominii'):
+        _esegui(conn, "ALTER TABLE condominii ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0")
+
+def m007_token_revocati(conn):
+    """Token JWT revocati (logout), identificati dal claim jti"""
+    _esegui(conn, '''
+        CREATE TABLE IF NOT EXISTS token_revocati (
+            jti TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            scadenza INTEGER NOT NULL,
+            revocato_il TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''', "CREATE INDEX IF NOT EXISTS idx_token_revocati_scadenza ON token_revocati(scadenza)")
+
+def m008_preventivi_ripartizione_version(conn):
+    """Versione dati del condominio a cui è aggiornata ripartizione_preventivo"""
+    if 'ripartizione_version' not in _colonne(conn, 'preventivi_annuali'):
+        _esegui(conn, "ALTER TABLE preventivi_annuali ADD COLUMN ripartizione_version INTEGER")
+
+def m009_spese_rollup(conn):
+    """Aggregati delle spese per anno/mese/tabella/logica P/I (analytics)"""
+    _esegui(conn, '''
+        CREATE TABLE IF NOT EXISTS spese_rollup (
+            condominio_id INTEGER NOT NULL,
+            anno INTEGER NOT NULL,
+            mese INTEGER NOT NULL,
+            tabella_millesimi TEXT NOT NULL,
+            logica_pi TEXT NOT NULL,
+            numero_spese INTEGER NOT NULL,
+            totale REAL NOT NULL,
+            PRIMARY KEY (condominio_id, anno, mese, tabella_millesimi, logica_pi),
+            FOREIGN KEY (condominio_id) REFERENCES condominii(id) ON DELETE CASCADE
+        )
+    ''')
+    if 'rollup_version' not in _colonne(conn, 'condominii'):
+        _esegui(conn, "ALTER TABLE condominii ADD COLUMN rollup_version INTEGER")
+
+def m010_ricerca_full_text(conn):
+    """Indici full-text su descrizione/note di spese e spese preventivate.
+
+    Postgres: indici GIN su espressione tsvector (sempre allineati).
+    SQLite: tabelle FTS5 external-content sincronizzate da trigger; se la
+    libreria SQLite non include FTS5 la ricerca usa LIKE.
+    """
+    if is_postgres_conn(conn):
+        conn.commit()
+        conn.autocommit = True
+        try:
+            for tabella, documento in TSVECTOR_RICERCA.items():
+                _esegui(conn, f"CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_{tabella}_ricerca "
+                              f"ON {tabella} USING GIN ({documento})")
+        finally:
+            conn.autocommit = False
+        return
+
+    colonne_fts = {'spese': ['descrizione'], 'spese_preventivate': ['descrizione', 'note']}
+    for tabella, colonne in colonne_fts.items():
+        fts = f"{tabella}_fts"
+        nuove = ', '.join(f"new.{c}" for c in colonne)
+        vecchie = ', '.join(f"old.{c}" for c in colonne)
+        elenco = ', '.join(colonne)
+        try:
+            _esegui(conn, f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+                    {elenco}, content='{tabella}', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2'
+                )
+            """)
+        except sqlite3.OperationalError:
+            # SQLite compilato senza FTS5
+            return
+        _esegui(conn, f"""
+            CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {tabella} BEGIN
+                INSERT INTO {fts} (rowid, {elenco}) VALUES (new.id, {nuove});
+            END
+        """, f"""
+            CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {tabella} BEGIN
+                INSERT INTO {fts} ({fts}, rowid, {elenco}) VALUES ('delete', old.id, {vecchie});
+            END
+        """, f"""
+            CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {elenco} ON {tabella} BEGIN
+                INSERT INTO {fts} ({fts}, rowid, {elenco}) VALUES ('delete', old.id, {vecchie});
+                INSERT INTO {fts} (rowid, {elenco}) VALUES (new.id, {nuove});
+            END
+        """, f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+
+def m011_condominii_persone_version(conn):
+    """Versione delle persone del condominio (cache del profilo dei ruoli per unità)"""
+    if 'persone_version' not in _colonne(conn, 'condominii'):
+        _esegui(conn, "ALTER TABLE condominii ADD COLUMN persone_version INTEGER NOT NULL DEFAULT 0")
+
+# Elenco ordinato: (versione, funzione). Ogni migrazione deve essere idempotente.
+MIGRAZIONI = [
+    (1, m001_schema_base),
+    (2, m002_spese_data_spesa),
+    (3, m003_spese_preventivate_data_prevista),
+    (4, m004_tabelle_preventivo),
+    (5, m005_indici),
+    (6, m006_condominii_data_version),
+    (7, m007_token_revocati),
+    (8, m008_preventivi_ripartizione_version),
+    (9, m009_spese_rollup),
+    (10, m010_ricerca_full_text),
+    (11, m011_condominii_persone_version),
+]
+
+SCHEMA_VERSION = MIGRAZIONI[-1][0]
+
+# ======================
+# RUNNER
+# ======================
+
+def get_schema_version(conn):
+    """Versione dello schema registrata (0 se il database non è versionato)"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT MAX(versione) AS versione FROM schema_version")
+        row = cursor.fetchone()
+    except Exception:
+        conn.rollback()
+        return 0
+    if not row:
+        return 0
+    return row['versione'] or 0
+
+def _registra_versione(conn, versione):
+    cursor = conn.cursor()
+    exec_sql(cursor, """
+        INSERT INTO schema_version (versione) VALUES (?)
+        ON CONFLICT (versione) DO NOTHING
+    """, (versione,))
+    conn.commit()
+
+def _rilascia_lock(conn):
+    """Rilascia il lock advisory delle migrazioni (PostgreSQL).
+
+    Dopo una migrazione fallita la transazione è annullata: senza rollback
+    l'unlock fallirebbe e il lock di sessione resterebbe alla connessione,
+    che torna nel pool. Se l'unlock non riesce la connessione viene chiusa
+    davvero: chiudere la sessione rilascia il lock.
+    """
+    try:
+        conn.rollback()
+        conn.cursor().execute("SELECT pg_advisory_unlock(%s)", (PG_LOCK_ID,))
+        conn.commit()
+    except Exception as e:
+        print(f"[Migrazioni] rilascio del lock non riuscito, chiusura della connessione: {str(e)}")
+        getattr(conn, 'chiudi', conn.close)()
+
+def applica_migrazioni(conn=None, verbose=True):
+    """Applica le migrazioni mancanti e ritorna la versione finale dello schema.
+
+    Se lo schema è già aggiornato esegue una sola SELECT e nessun DDL.
+    """
+    chiudi = conn is None
+    if conn is None:
+        conn = get_db()
+    postgres = is_postgres_conn(conn)
+
+    try:
+        versione = get_schema_version(conn)
+        if versione >= SCHEMA_VERSION:
+            return versione
+
+        cursor = conn.cursor()
+        if postgres:
+            # Serializza i worker che partono insieme
+            cursor.execute("SELECT pg_advisory_lock(%s)", (PG_LOCK_ID,))
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    versione INTEGER PRIMARY KEY,
+                    applicata_il TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            conn.commit()
+
+            versione = get_schema_version(conn)
+            for numero, migrazione in MIGRAZIONI:
+                if numero <= versione:
+                    continue
+                t0 = time.perf_counter()
+                migrazione(conn)
+                conn.commit()
+                _registra_versione(conn, numero)
+                versione = numero
+                if verbose:
+                    print(f"Migrazione {numero} ({migrazione.__name__}) applicata "
+                          f"in {(time.perf_counter() - t0) * 1000:.0f} ms")
+        except Exception:
+            # La migrazione fallita non è registrata: verrà ripetuta al prossimo avvio
+            # (su PostgreSQL il rollback lo esegue _rilascia_lock)
+            if not postgres:
+                conn.rollback()
+            raise
+        finally:
+            if postgres:
+                _rilascia_lock(conn)
+
+        return versione
+    finally:
+        if chiudi:
+            conn.close()
+
+if __name__ == '__main__':
+    versione = applica_migrazioni()
+    print(f"Schema database alla versione {versione}")
@@ -1,6 +1,38 @@
-from database_universal import get_db, exec_sql
+from database_universal import (
+    get_db, get_catalog_db, exec_sql, exec_many, sql_anno, sql_mese, IS_POSTGRES, TSVECTOR_RICERCA,
+    percorso_db_corrente
+)
 from datetime import datetime
+from collections import OrderedDict
+import threading
+import time
 import json
+import re
+
+from scritture import esegui_scrittura
+
+# Cache in-process dei metadati dei preventivi: condominio_id -> (data_version, {anno: riga})
+PREVENTIVI_CACHE_SIZE = 256
+_preventivi_cache = OrderedDict()
+_preventivi_cache_lock = threading.Lock()
+
+def bump_data_version(cursor, condominio_id, persone=False):
+    """Incrementa la versione dati del condominio (usata per ETag e cache).
+
+    Con `persone` incrementa anche la versione delle persone (profilo dei
+    ruoli per unità). Va eseguita nella stessa transazione della scrittura.
+    """
+    if persone:
+        exec_sql(cursor, """
+            UPDATE condominii SET data_version = data_version + 1,
+            persone_version = persone_version + 1
+            WHERE id = ?
+        """, (condominio_id,))
+        return
+    exec_sql(cursor, """
+        UPDATE condominii SET data_version = data_version + 1
+        WHERE id = ?
+    """, (condominio_id,))
 
 class User:
     """Modello per la tabella users"""
@@ -14,7 +46,7 @@ class User:
     @classmethod
     def find_by_username(cls, username):
         """Trova utente per username"""
-        conn = get_db()
+        conn = get_catalog_db()
         cursor = conn.cursor()
         exec_sql(cursor, "SELECT * FROM users WHERE username = ?", (username,))
         row = cursor.fetchone()
@@ -32,7 +64,7 @@ class User:
     @classmethod
     def find_by_id(cls, user_id):
         """Trova utente per ID"""
-        conn = get_db()
+        conn = get_catalog_db()
         cursor = conn.cursor()
         exec_sql(cursor, "SELECT * FROM users WHERE id = ?", (user_id,))
         row = cursor.fetchone()
@@ -49,7 +81,7 @@ class User:
 
     def save(self):
         """Salva utente nel database"""
-        conn = get_db()
+        conn = get_catalog_db()
         cursor = conn.cursor()
 
         if self.id:
@@ -76,7 +108,7 @@ class Condominio:
                  responsabile=None, telefono_responsabile=None, email_responsabile=None,
                  amministratore_esterno=None, partita_iva=None, iban_condominio=None,
                  banca_appoggio=None, descrizione_edificio=None, note_interne=None,
-                 id=None, created_at=None):
+                 id=None, created_at=None, data_version=0):
         self.id = id
         self.user_id = user_id
         self.nome = nome
@@ -95,6 +127,7 @@ class Condominio:
         self.descrizione_edificio = descrizione_edificio
         self.note_interne = note_interne
         self.created_at = created_at
+        self.data_version = data_version
 
     @classmethod
     def get_by_user_id(cls, user_id):
@@ -127,43 +160,51 @@ class Condominio:
                 banca_appoggio=row['banca_appoggio'] if 'banca_appoggio' in row.keys() else None,
                 descrizione_edificio=row['descrizione_edificio'] if 'descrizione_edificio' in row.keys() else None,
                 note_interne=row['note_interne'] if 'note_interne' in row.keys() else None,
-                created_at=row['created_at']
+                created_at=row['created_at'],
+                data_version=row['data_version'] if 'data_version' in row.keys() else 0
             ))
 
         conn.close()
         return condominii
 
+    SQL_PER_ID = "SELECT * FROM condominii WHERE id = ?"
+
     @classmethod
-    def find_by_id(cls, condo_id):
+    def find_by_id(cls, condo_id, conn=None):
         """Trova condominio per ID"""
-        conn = get_db()
+        chiudi = conn is None
+        conn = conn or get_db()
         cursor = conn.cursor()
-        exec_sql(cursor, "SELECT * FROM condominii WHERE id = ?", (condo_id,))
+        exec_sql(cursor, cls.SQL_PER_ID, (condo_id,))
         row = cursor.fetchone()
-        conn.close()
+        if chiudi:
+            conn.close()
+        return cls.da_riga(row) if row else None
 
-        if row:
-            return cls(
-                id=row['id'],
-                user_id=row['user_id'],
-                nome=row['nome'],
-                indirizzo=row['indirizzo'],
-                num_unita=row['num_unita'],
-                anno_costruzione=row['anno_costruzione'] if 'anno_costruzione' in row.keys() else None,
-                numero_scale=row['numero_scale'] if 'numero_scale' in row.keys() else None,
-                presidente_assemblea=row['presidente_assemblea'] if 'presidente_assemblea' in row.keys() else None,
-                responsabile=row['responsabile'] if 'responsabile' in row.keys() else None,
-                telefono_responsabile=row['telefono_responsabile'] if 'telefono_responsabile' in row.keys() else None,
-                email_responsabile=row['email_responsabile'] if 'email_responsabile' in row.keys() else None,
-                amministratore_esterno=row['amministratore_esterno'] if 'amministratore_esterno' in row.keys() else None,
-                partita_iva=row['partita_iva'] if 'partita_iva' in row.keys() else None,
-                iban_condominio=row['iban_condominio'] if 'iban_condominio' in row.keys() else None,
-                banca_appoggio=row['banca_appoggio'] if 'banca_appoggio' in row.keys() else None,
-                descrizione_edificio=row['descrizione_edificio'] if 'descrizione_edificio' in row.keys() else None,
-                note_interne=row['note_interne'] if 'note_interne' in row.keys() else None,
-                created_at=row['created_at']
-            )
-        return None
+    @classmethod
+    def da_riga(cls, row):
+        """Condominio da una riga di condominii (sqlite3.Row, dict o record asyncpg)"""
+        return cls(
+            id=row['id'],
+            user_id=row['user_id'],
+            nome=row['nome'],
+            indirizzo=row['indirizzo'],
+            num_unita=row['num_unita'],
+            anno_costruzione=row['anno_costruzione'] if 'anno_costruzione' in row.keys() else None,
+            numero_scale=row['numero_scale'] if 'numero_scale' in row.keys() else None,
+            presidente_assemblea=row['presidente_assemblea'] if 'presidente_assemblea' in row.keys() else None,
+            responsabile=row['responsabile'] if 'responsabile' in row.keys() else None,
+            telefono_responsabile=row['telefono_responsabile'] if 'telefono_responsabile' in row.keys() else None,
+            email_responsabile=row['email_responsabile'] if 'email_responsabile' in row.keys() else None,
+            amministratore_esterno=row['amministratore_esterno'] if 'amministratore_esterno' in row.keys() else None,
+            partita_iva=row['partita_iva'] if 'partita_iva' in row.keys() else None,
+            iban_condominio=row['iban_condominio'] if 'iban_condominio' in row.keys() else None,
+            banca_appoggio=row['banca_appoggio'] if 'banca_appoggio' in row.keys() else None,
+            descrizione_edificio=row['descrizione_edificio'] if 'descrizione_edificio' in row.keys() else None,
+            note_interne=row['note_interne'] if 'note_interne' in row.keys() else None,
+            created_at=row['created_at'],
+            data_version=row['data_version'] if 'data_version' in row.keys() else 0
+        )
 
     def save(self):
         """Salva condominio nel database"""
@@ -174,7 +215,8 @@ class Condominio:
             if self.id:
                 # Aggiorna solo i campi esistenti nello schema attuale
                 exec_sql(cursor, """
-                    UPDATE condominii SET nome = ?, indirizzo = ?
+                    UPDATE condominii SET nome = ?, indirizzo = ?,
+                    data_version = data_version + 1
                     WHERE id = ?
                 """, (self.nome, self.indirizzo, self.id))
             else:
@@ -208,6 +250,7 @@ class Condominio:
         exec_sql(cursor, "DELETE FROM condominii WHERE id = ?", (self.id,))
         conn.commit()
         conn.close()
+        PreventivoAnnuale.invalida_cache(self.id)
 
 class UnitaImmobiliare:
     """Modello per la tabella unita_immobiliari"""
@@ -218,9 +261,10 @@ class UnitaImmobiliare:
         self.numero_unita = numero_unita
 
     @classmethod
-    def get_by_condominio(cls, condominio_id):
+    def get_by_condominio(cls, condominio_id, conn=None):
         """Ottiene tutte le unità di un condominio"""
-        conn = get_db()
+        chiudi = conn is None
+        conn = conn or get_db()
         cursor = conn.cursor()
         exec_sql(cursor, """
             SELECT * FROM unita_immobiliari
@@ -236,7 +280,8 @@ class UnitaImmobiliare:
                 numero_unita=row['numero_unita']
             ))
 
-        conn.close()
+        if chiudi:
+            conn.close()
         return unita
 
 class Persona:
@@ -252,34 +297,39 @@ class Persona:
         self.email = email
         self.tipo_persona = tipo_persona  # 'proprietario' o 'inquilino'
 
+    SQL_PER_CONDOMINIO = """
+        SELECT p.*, ui.numero_unita
+        FROM persone p
+        JOIN unita_immobiliari ui ON p.unita_id = ui.id
+        WHERE p.condominio_id = ?
+        ORDER BY ui.numero_unita, p.cognome, p.nome
+    """
+
     @classmethod
-    def get_by_condominio(cls, condominio_id):
+    def get_by_condominio(cls, condominio_id, conn=None):
         """Ottiene tutte le persone di un condominio con dettagli unità"""
-        conn = get_db()
+        chiudi = conn is None
+        conn = conn or get_db()
         cursor = conn.cursor()
-        exec_sql(cursor, """
-            SELECT p.*, ui.numero_unita
-            FROM persone p
-            JOIN unita_immobiliari ui ON p.unita_id = ui.id
-            WHERE p.condominio_id = ?
-            ORDER BY ui.numero_unita, p.cognome, p.nome
-        """, (condominio_id,))
+        exec_sql(cursor, cls.SQL_PER_CONDOMINIO, (condominio_id,))
+        persone = [cls.da_riga(row) for row in cursor.fetchall()]
 
-        persone = []
-        for row in cursor.fetchall():
-            persone.append(cls(
-                id=row['id'],
-                condominio_id=row['condominio_id'],
-                unita_id=row['unita_id'],
-                nome=row['nome'],
-                cognome=row['cognome'],
-                email=row['email'],
-                tipo_persona=row['tipo_persona']
-            ))
-
-        conn.close()
+        if chiudi:
+            conn.close()
         return persone
 
+    @classmethod
+    def da_riga(cls, row):
+        return cls(
+            id=row['id'],
+            condominio_id=row['condominio_id'],
+            unita_id=row['unita_id'],
+            nome=row['nome'],
+            cognome=row['cognome'],
+            email=row['email'],
+            tipo_persona=row['tipo_persona']
+        )
+
     @classmethod
     def find_by_id(cls, persona_id):
         """Trova persona per ID"""
@@ -309,16 +359,19 @@ class Persona:
 
     def save(self):
         """Salva persona nel database"""
-        conn = get_db()
-        cursor = conn.cursor()
+        self.id = esegui_scrittura(self._salva)
+        return self
 
-        if self.id:
+    def _salva(self, cursor):
+        """Scrittura di save() sul cursore dato; ritorna l'id della persona"""
+        persona_id = self.id
+        if persona_id:
             exec_sql(cursor, """
                 UPDATE persone SET unita_id = ?, nome = ?, cognome = ?,
                 email = ?, tipo_persona = ?
                 WHERE id = ?
             """, (self.unita_id, self.nome, self.cognome,
-                  self.email, self.tipo_persona, self.id))
+                  self.email, self.tipo_persona, persona_id))
         else:
             exec_sql(cursor, """
                 INSERT INTO persone (condominio_id, unita_id, nome, cognome,
@@ -326,19 +379,18 @@ class Persona:
                 VALUES (?, ?, ?, ?, ?, ?)
             """, (self.condominio_id, self.unita_id, self.nome, self.cognome,
                   self.email, self.tipo_persona))
-            self.id = cursor.lastrowid
+            persona_id = cursor.lastrowid
 
-        conn.commit()
-        conn.close()
-        return self
+        bump_data_version(cursor, self.condominio_id, persone=True)
+        return persona_id
 
     def delete(self):
         """Elimina persona dal database"""
-        conn = get_db()
-        cursor = conn.cursor()
+        esegui_scrittura(self._elimina)
+
+    def _elimina(self, cursor):
         exec_sql(cursor, "DELETE FROM persone WHERE id = ?", (self.id,))
-        conn.commit()
-        conn.close()
+        bump_data_version(cursor, self.condominio_id, persone=True)
 
 class Spesa:
     """Modello per la tabella spese"""
@@ -357,43 +409,49 @@ class Spesa:
         self.percentuale_inquilino = percentuale_inquilino
         self.created_at = created_at
 
+    SQL_PER_CONDOMINIO = """
+        SELECT * FROM spese
+        WHERE condominio_id = ?
+        ORDER BY data_spesa DESC, created_at DESC
+    """
+    SQL_PER_TABELLA = """
+        SELECT * FROM spese
+        WHERE condominio_id = ? AND tabella_millesimi = ?
+        ORDER BY data_spesa DESC, created_at DESC
+    """
+
     @classmethod
-    def get_by_condominio(cls, condominio_id, tabella_filter=None):
+    def get_by_condominio(cls, condominio_id, tabella_filter=None, conn=None):
         """Ottiene tutte le spese di un condominio, con filtro opzionale per tabella"""
-        conn = get_db()
+        chiudi = conn is None
+        conn = conn or get_db()
         cursor = conn.cursor()
 
         if tabella_filter:
-            exec_sql(cursor, """
-                SELECT * FROM spese
-                WHERE condominio_id = ? AND tabella_millesimi = ?
-                ORDER BY data_spesa DESC, created_at DESC
-            """, (condominio_id, tabella_filter))
+            exec_sql(cursor, cls.SQL_PER_TABELLA, (condominio_id, tabella_filter))
         else:
-            exec_sql(cursor, """
-                SELECT * FROM spese
-                WHERE condominio_id = ?
-                ORDER BY data_spesa DESC, created_at DESC
-            """, (condominio_id,))
-
-        spese = []
-        for row in cursor.fetchall():
-            spese.append(cls(
-                id=row['id'],
-                condominio_id=row['condominio_id'],
-                descrizione=row['descrizione'],
-                importo=row['importo'],
-                data_spesa=row['data_spesa'],
-                tabella_millesimi=row['tabella_millesimi'],
-                logica_pi=row['logica_pi'],
-                percentuale_proprietario=row['percentuale_proprietario'],
-                percentuale_inquilino=row['percentuale_inquilino'],
-                created_at=row['created_at']
-            ))
+            exec_sql(cursor, cls.SQL_PER_CONDOMINIO, (condominio_id,))
+        spese = [cls.da_riga(row) for row in cursor.fetchall()]
 
-        conn.close()
+        if chiudi:
+            conn.close()
         return spese
 
+    @classmethod
+    def da_riga(cls, row):
+        return cls(
+            id=row['id'],
+            condominio_id=row['condominio_id'],
+            descrizione=row['descrizione'],
+            importo=row['importo'],
+            data_spesa=row['data_spesa'],
+            tabella_millesimi=row['tabella_millesimi'],
+            logica_pi=row['logica_pi'],
+            percentuale_proprietario=row['percentuale_proprietario'],
+            percentuale_inquilino=row['percentuale_inquilino'],
+            created_at=row['created_at']
+        )
+
     @classmethod
     def find_by_id(cls, spesa_id):
         """Trova spesa per ID"""
@@ -421,10 +479,13 @@ class Spesa:
 
     def save(self):
         """Salva spesa nel database"""
-        conn = get_db()
-        cursor = conn.cursor()
+        self.id = esegui_scrittura(self._salva)
+        return self
 
-        if self.id:
+    def _salva(self, cursor):
+        """Scrittura di save() sul cursore dato; ritorna l'id della spesa"""
+        spesa_id = self.id
+        if spesa_id:
             exec_sql(cursor, """
                 UPDATE spese SET descrizione = ?, importo = ?, data_spesa = ?,
                 tabella_millesimi = ?, logica_pi = ?,
@@ -432,7 +493,7 @@ class Spesa:
                 WHERE id = ?
             """, (self.descrizione, self.importo, self.data_spesa, self.tabella_millesimi,
                   self.logica_pi, self.percentuale_proprietario,
-                  self.percentuale_inquilino, self.id))
+                  self.percentuale_inquilino, spesa_id))
         else:
             exec_sql(cursor, """
                 INSERT INTO spese (condominio_id, descrizione, importo, data_spesa,
@@ -442,19 +503,42 @@ class Spesa:
             """, (self.condominio_id, self.descrizione, self.importo, self.data_spesa,
                   self.tabella_millesimi, self.logica_pi,
                   self.percentuale_proprietario, self.percentuale_inquilino))
-            self.id = cursor.lastrowid
+            spesa_id = cursor.lastrowid
 
-        conn.commit()
-        conn.close()
-        return self
+        bump_data_version(cursor, self.condominio_id)
+        return spesa_id
 
-    def delete(self):
-        """Elimina spesa dal database"""
+    @classmethod
+    def insert_many(cls, condominio_id, spese):
+        """Inserisce più spese (dict validati) in una sola transazione"""
         conn = get_db()
         cursor = conn.cursor()
+
+        try:
+            exec_many(cursor, """
+                INSERT INTO spese (condominio_id, descrizione, importo, data_spesa,
+                tabella_millesimi, logica_pi, percentuale_proprietario,
+                percentuale_inquilino)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, [(condominio_id, s['descrizione'], s['importo'], s['data_spesa'],
+                   s['tabella_millesimi'], s['logica_pi'],
+                   s.get('percentuale_proprietario', 100), s.get('percentuale_inquilino', 0))
+                  for s in spese])
+            bump_data_version(cursor, condominio_id)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise e
+        finally:
+            conn.close()
+
+    def delete(self):
+        """Elimina spesa dal database"""
+        esegui_scrittura(self._elimina)
+
+    def _elimina(self, cursor):
         exec_sql(cursor, "DELETE FROM spese WHERE id = ?", (self.id,))
-        conn.commit()
-        conn.close()
+        bump_data_version(cursor, self.condominio_id)
 
 class Millesemo:
     """Modello per la tabella millesimi"""
@@ -493,6 +577,60 @@ class Millesemo:
         conn.close()
         return millesimi
 
+    SQL_PER_CONDOMINIO = """
+        SELECT m.*, ui.numero_unita
+        FROM millesimi m
+        JOIN unita_immobiliari ui ON m.unita_id = ui.id
+        WHERE m.condominio_id = ?
+        ORDER BY m.tabella, ui.numero_unita
+    """
+
+    @classmethod
+    def get_by_condominio(cls, condominio_id, conn=None):
+        """Ottiene i millesimi di tutte le tabelle con una sola query, raggruppati per tabella"""
+        chiudi = conn is None
+        conn = conn or get_db()
+        cursor = conn.cursor()
+        exec_sql(cursor, cls.SQL_PER_CONDOMINIO, (condominio_id,))
+        millesimi = cls.per_tabella(cursor.fetchall())
+
+        if chiudi:
+            conn.close()
+        return millesimi
+
+    @classmethod
+    def per_tabella(cls, righe):
+        """Righe di SQL_PER_CONDOMINIO raggruppate in {tabella: [Millesemo]}"""
+        millesimi = {}
+        for row in righe:
+            millesimi.setdefault(row['tabella'], []).append(cls(
+                id=row['id'],
+                condominio_id=row['condominio_id'],
+                unita_id=row['unita_id'],
+                tabella=row['tabella'],
+                valore=row['valore']
+            ))
+        return millesimi
+
+    @classmethod
+    def validate_totals(cls, condominio_id, conn=None):
+        """Come validate_total, per tutte le tabelle con una sola query"""
+        chiudi = conn is None
+        conn = conn or get_db()
+        cursor = conn.cursor()
+        exec_sql(cursor, """
+            SELECT tabella, SUM(valore) as totale
+            FROM millesimi
+            WHERE condominio_id = ?
+            GROUP BY tabella
+        """, (condominio_id,))
+
+        risultato = {row['tabella']: (row['totale'] == 1000 if row['totale'] else False)
+                     for row in cursor.fetchall()}
+        if chiudi:
+            conn.close()
+        return risultato
+
     @classmethod
     def get_unita_millesimi(cls, unita_id):
         """Ottiene tutti i millesimi di un'unità"""
@@ -513,18 +651,17 @@ class Millesemo:
 
     def save(self):
         """Salva o aggiorna millesimo nel database"""
-        conn = get_db()
-        cursor = conn.cursor()
+        esegui_scrittura(self._salva)
+        return self
 
+    def _salva(self, cursor):
         exec_sql(cursor, """
             INSERT OR REPLACE INTO millesimi
             (condominio_id, unita_id, tabella, valore)
             VALUES (?, ?, ?, ?)
         """, (self.condominio_id, self.unita_id, self.tabella, self.valore))
 
-        conn.commit()
-        conn.close()
-        return self
+        bump_data_version(cursor, self.condominio_id)
 
     @classmethod
     def validate_total(cls, condominio_id, tabella):
@@ -558,9 +695,10 @@ class PreventivoAnnuale:
         self.updated_at = updated_at
 
     @classmethod
-    def get_by_condominio(cls, condominio_id):
+    def get_by_condominio(cls, condominio_id, conn=None):
         """Ottiene tutti i preventivi di un condominio"""
-        conn = get_db()
+        chiudi = conn is None
+        conn = conn or get_db()
         cursor = conn.cursor()
         exec_sql(cursor, """
             SELECT * FROM preventivi_annuali
@@ -568,22 +706,70 @@ class PreventivoAnnuale:
             ORDER BY anno DESC
         """, (condominio_id,))
 
-        preventivi = []
-        for row in cursor.fetchall():
-            preventivi.append(cls(
-                id=row['id'],
-                condominio_id=row['condominio_id'],
-                anno=row['anno'],
-                importo_totale_preventivato=row['importo_totale_preventivato'],
-                importo_totale_speso=row['importo_totale_speso'],
-                note=row['note'],
-                created_at=row['created_at'],
-                updated_at=row['updated_at']
-            ))
+        preventivi = [cls._from_row(row) for row in cursor.fetchall()]
 
-        conn.close()
+        if chiudi:
+            conn.close()
         return preventivi
 
+    @classmethod
+    def _from_row(cls, row):
+        return cls(
+            id=row['id'],
+            condominio_id=row['condominio_id'],
+            anno=row['anno'],
+            importo_totale_preventivato=row['importo_totale_preventivato'],
+            importo_totale_speso=row['importo_totale_speso'],
+            note=row['note'],
+            created_at=row['created_at'],
+            updated_at=row['updated_at']
+        )
+
+    @classmethod
+    def find_by_condominio_anno(cls, condominio_id, anno, data_version=None):
+        """Trova il preventivo di un condominio per anno (indice UNIQUE condominio_id, anno).
+
+        Con `data_version` (versione dati corrente del condominio) il risultato
+        viene letto/salvato nella cache in-process; la cache è invalidata da
+        save() e, tra worker diversi, dal cambio di versione.
+        """
+        if data_version is not None:
+            with _preventivi_cache_lock:
+                voce = _preventivi_cache.get(condominio_id)
+                if voce and voce[0] == data_version and anno in voce[1]:
+                    _preventivi_cache.move_to_end(condominio_id)
+                    row = voce[1][anno]
+                    return cls._from_row(row) if row else None
+
+        conn = get_db()
+        cursor = conn.cursor()
+        exec_sql(cursor, """
+            SELECT * FROM preventivi_annuali
+            WHERE condominio_id = ? AND anno = ?
+        """, (condominio_id, anno))
+        row = cursor.fetchone()
+        conn.close()
+        row = dict(row) if row else None
+
+        if data_version is not None:
+            with _preventivi_cache_lock:
+                voce = _preventivi_cache.get(condominio_id)
+                if not voce or voce[0] != data_version:
+                    voce = (data_version, {})
+                    _preventivi_cache[condominio_id] = voce
+                voce[1][anno] = row
+                _preventivi_cache.move_to_end(condominio_id)
+                while len(_preventivi_cache) > PREVENTIVI_CACHE_SIZE:
+                    _preventivi_cache.popitem(last=False)
+
+        return cls._from_row(row) if row else None
+
+    @classmethod
+    def invalida_cache(cls, condominio_id):
+        """Rimuove dalla cache i preventivi del condominio"""
+        with _preventivi_cache_lock:
+            _preventivi_cache.pop(condominio_id, None)
+
     @classmethod
     def find_by_id(cls, preventivo_id):
         """Trova preventivo annuale per ID"""
@@ -594,46 +780,42 @@ class PreventivoAnnuale:
         row = cursor.fetchone()
         conn.close()
 
-        if row:
-            return cls(
-                id=row['id'],
-                condominio_id=row['condominio_id'],
-                anno=row['anno'],
-                importo_totale_preventivato=row['importo_totale_preventivato'],
-                importo_totale_speso=row['importo_totale_speso'],
-                note=row['note'],
-                created_at=row['created_at'],
-                updated_at=row['updated_at']
-            )
-        return None
+        return cls._from_row(row) if row else None
 
     def save(self):
         """Salva preventivo nel database"""
         conn = get_db()
         cursor = conn.cursor()
 
-        if self.id:
-            exec_sql(cursor, """
-                UPDATE preventivi_annuali SET
-                importo_totale_preventivato = ?,
-                importo_totale_speso = ?,
-                note = ?,
-                updated_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            """, (self.importo_totale_preventivato, self.importo_totale_speso,
-                  self.note, self.id))
-        else:
-            exec_sql(cursor, """
-                INSERT INTO preventivi_annuali
-                (condominio_id, anno, importo_totale_preventivato,
-                importo_totale_speso, note)
-                VALUES (?, ?, ?, ?, ?)
-            """, (self.condominio_id, self.anno, self.importo_totale_preventivato,
-                  self.importo_totale_speso, self.note))
-            self.id = cursor.lastrowid
+        try:
+            if self.id:
+                exec_sql(cursor, """
+                    UPDATE preventivi_annuali SET
+                    importo_totale_preventivato = ?,
+                    importo_totale_speso = ?,
+                    note = ?,
+                    updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                """, (self.importo_totale_preventivato, self.importo_totale_speso,
+                      self.note, self.id))
+            else:
+                exec_sql(cursor, """
+                    INSERT INTO preventivi_annuali
+                    (condominio_id, anno, importo_totale_preventivato,
+                    importo_totale_speso, note)
+                    VALUES (?, ?, ?, ?, ?)
+                """, (self.condominio_id, self.anno, self.importo_totale_preventivato,
+                      self.importo_totale_speso, self.note))
+                self.id = cursor.lastrowid
 
-        conn.commit()
-        conn.close()
+            bump_data_version(cursor, self.condominio_id)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise e
+        finally:
+            conn.close()
+        PreventivoAnnuale.invalida_cache(self.condominio_id)
         return self
 
 class SpesaPreventivata:
@@ -755,40 +937,71 @@ class SpesaPreventivata:
         conn = get_db()
         cursor = conn.cursor()
 
-        if self.id:
-            exec_sql(cursor, """
-                UPDATE spese_preventivate SET
-                descrizione = ?, importo_previsto = ?, tabella_millesimi = ?,
-                logica_pi = ?, percentuale_proprietario = ?, percentuale_inquilino = ?,
-                mese_previsto = ?, data_prevista = ?, note = ?
-                WHERE id = ?
-            """, (self.descrizione, self.importo_previsto, self.tabella_millesimi,
-                  self.logica_pi, self.percentuale_proprietario, self.percentuale_inquilino,
-                  self.mese_previsto, self.data_prevista, self.note, self.id))
-        else:
-            exec_sql(cursor, """
-                INSERT INTO spese_preventivate
-                (condominio_id, preventivo_id, descrizione, importo_previsto,
-                tabella_millesimi, logica_pi, percentuale_proprietario,
-                percentuale_inquilino, mese_previsto, data_prevista, note)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (self.condominio_id, self.preventivo_id, self.descrizione,
-                  self.importo_previsto, self.tabella_millesimi, self.logica_pi,
-                  self.percentuale_proprietario, self.percentuale_inquilino,
-                  self.mese_previsto, self.data_prevista, self.note))
-            self.id = cursor.lastrowid
+        try:
+            if self.id:
+                exec_sql(cursor, """
+                    UPDATE spese_preventivate SET
+                    descrizione = ?, importo_previsto = ?, tabella_millesimi = ?,
+                    logica_pi = ?, percentuale_proprietario = ?, percentuale_inquilino = ?,
+                    mese_previsto = ?, data_prevista = ?, note = ?
+                    WHERE id = ?
+                """, (self.descrizione, self.importo_previsto, self.tabella_millesimi,
+                      self.logica_pi, self.percentuale_proprietario, self.percentuale_inquilino,
+                      self.mese_previsto, self.data_prevista, self.note, self.id))
+            else:
+                exec_sql(cursor, """
+                    INSERT INTO spese_preventivate
+                    (condominio_id, preventivo_id, descrizione, importo_previsto,
+                    tabella_millesimi, logica_pi, percentuale_proprietario,
+                    percentuale_inquilino, mese_previsto, data_prevista, note)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (self.condominio_id, self.preventivo_id, self.descrizione,
+                      self.importo_previsto, self.tabella_millesimi, self.logica_pi,
+                      self.percentuale_proprietario, self.percentuale_inquilino,
+                      self.mese_previsto, self.data_prevista, self.note))
+                self.id = cursor.lastrowid
 
-        conn.commit()
-        conn.close()
+            bump_data_version(cursor, self.condominio_id)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise e
+        finally:
+            conn.close()
         return self
 
     def delete(self):
         """Elimina spesa preventivata dal database"""
         conn = get_db()
         cursor = conn.cursor()
-        exec_sql(cursor, "DELETE FROM spese_preventivate WHERE id = ?", (self.id,))
-        conn.commit()
+
+        try:
+            exec_sql(cursor, "DELETE FROM spese_preventivate WHERE id = ?", (self.id,))
+            bump_data_version(cursor, self.condominio_id)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise e
+        finally:
+            conn.close()
+
+    @classmethod
+    def get_totali_per_anno(cls, condominio_id, anno_da, anno_a):
+        """Totale previsto per anno e tabella millesimi (aggregato nel database)"""
+        conn = get_db()
+        cursor = conn.cursor()
+        exec_sql(cursor, """
+            SELECT pa.anno, sp.tabella_millesimi, COUNT(*) AS numero_spese, SUM(sp.importo_previsto) AS totale
+            FROM spese_preventivate sp
+            JOIN preventivi_annuali pa ON sp.preventivo_id = pa.id
+            WHERE pa.condominio_id = ? AND pa.anno BETWEEN ? AND ?
+            GROUP BY pa.anno, sp.tabella_millesimi
+            ORDER BY pa.anno, sp.tabella_millesimi
+        """, (condominio_id, anno_da, anno_a))
+        totali = [dict(row) for row in cursor.fetchall()]
         conn.close()
+        return totali
+
 
 class RipartizionePreventivo:
     """Modello per la tabella ripartizione_preventivo"""
@@ -878,6 +1091,44 @@ class RipartizionePreventivo:
         conn.close()
         return self
 
+    @classmethod
+    def replace_for_preventivo(cls, condominio_id, preventivo_id, anno, importi, data_version):
+        """Sostituisce tutte le ripartizioni di un preventivo in una sola transazione.
+
+        `importi` è un dizionario persona_id -> importo previsto dovuto.
+        Se le righe sono già state calcolate sulla stessa versione dati del
+        condominio non scrive nulla. Ritorna True se ha scritto.
+        """
+        conn = get_db()
+        cursor = conn.cursor()
+        exec_sql(cursor, "SELECT ripartizione_version FROM preventivi_annuali WHERE id = ?", (preventivo_id,))
+        row = cursor.fetchone()
+        if not row or row['ripartizione_version'] == data_version:
+            conn.close()
+            return False
+
+        # Aggiornamento condizionale: se un'altra richiesta ha già scritto questa versione non si riscrive
+        exec_sql(cursor, """
+            UPDATE preventivi_annuali SET ripartizione_version = ?
+            WHERE id = ? AND (ripartizione_version IS NULL OR ripartizione_version <> ?)
+        """, (data_version, preventivo_id, data_version))
+        if cursor.rowcount == 0:
+            conn.rollback()
+            conn.close()
+            return False
+
+        exec_sql(cursor, "DELETE FROM ripartizione_preventivo WHERE preventivo_id = ?", (preventivo_id,))
+        exec_many(cursor, """
+            INSERT INTO ripartizione_preventivo
+            (condominio_id, preventivo_id, persona_id, importo_previsto_dovuto, anno)
+            VALUES (?, ?, ?, ?, ?)
+        """, [(condominio_id, preventivo_id, persona_id, importo, anno)
+              for persona_id, importo in importi.items()])
+
+        conn.commit()
+        conn.close()
+        return True
+
     @classmethod
     def delete_by_preventivo(cls, preventivo_id):
         """Elimina tutte le ripartizioni per un preventivo"""
@@ -887,3 +1138,222 @@ class RipartizionePreventivo:
         conn.commit()
         conn.close()
 
+
+class TokenRevocato:
+    """Modello per la tabella token_revocati (logout dei token JWT)"""
+
+    @classmethod
+    def revoca(cls, jti, user_id, scadenza):
+        """Registra la revoca di un token (scadenza: timestamp Unix del claim exp).
+
+        Nella stessa transazione elimina le revoche di token già scaduti: la
+        pulizia avviene al logout, fuori dal percorso di autenticazione.
+        """
+        conn = get_catalog_db()
+        cursor = conn.cursor()
+
+        try:
+            exec_sql(cursor, "DELETE FROM token_revocati WHERE scadenza <= ?", (int(time.time()),))
+            exec_sql(cursor, """
+                INSERT INTO token_revocati (jti, user_id, scadenza)
+                VALUES (?, ?, ?)
+                ON CONFLICT (jti) DO NOTHING
+            """, (jti, user_id, scadenza))
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise e
+        finally:
+            conn.close()
+
+    @classmethod
+    def get_attivi(cls, adesso):
+        """jti dei token revocati non ancora scaduti (sola lettura)"""
+        conn = get_catalog_db()
+        cursor = conn.cursor()
+        try:
+            exec_sql(cursor, "SELECT jti FROM token_revocati WHERE scadenza > ?", (adesso,))
+            return {row['jti'] for row in cursor.fetchall()}
+        finally:
+            conn.close()
+
+
+class SpeseRollup:
+    """Modello per la tabella spese_rollup (aggregati delle spese per analytics)"""
+
+    @classmethod
+    def _select_aggregati(cls):
+        """SELECT delle spese di un condominio raggruppate per anno/mese/tabella/logica P/I"""
+        return f"""
+            SELECT {sql_anno('data_spesa')} AS anno, {sql_mese('data_spesa')} AS mese,
+                   tabella_millesimi, logica_pi, COUNT(*) AS numero_spese, SUM(importo) AS totale
+            FROM spese
+            WHERE condominio_id = ? AND data_spesa IS NOT NULL {{filtro}}
+            GROUP BY anno, mese, tabella_millesimi, logica_pi
+        """
+
+    @classmethod
+    def aggiorna(cls, condominio_id, data_version):
+        """Ricalcola nel database gli aggregati del condominio se non allineati alla versione dati.
+
+        Ritorna True se ha scritto.
+        """
+        conn = get_db()
+        cursor = conn.cursor()
+        exec_sql(cursor, "SELECT rollup_version FROM condominii WHERE id = ?", (condominio_id,))
+        row = cursor.fetchone()
+        if not row or row['rollup_version'] == data_version:
+            conn.close()
+            return False
+
+        # Aggiornamento condizionale: se un'altra richiesta ha già scritto questa versione non si riscrive
+        exec_sql(cursor, """
+            UPDATE condominii SET rollup_version = ?
+            WHERE id = ? AND (rollup_version IS NULL OR rollup_version <> ?)
+        """, (data_version, condominio_id, data_version))
+        if cursor.rowcount == 0:
+            conn.rollback()
+            conn.close()
+            return False
+
+        exec_sql(cursor, "DELETE FROM spese_rollup WHERE condominio_id = ?", (condominio_id,))
+        exec_sql(cursor, """
+            INSERT INTO spese_rollup
+            (condominio_id, anno, mese, tabella_millesimi, logica_pi, numero_spese, totale)
+            SELECT ?, anno, mese, tabella_millesimi, logica_pi, numero_spese, totale
+            FROM (""" + cls._select_aggregati().format(filtro='') + """) aggregati
+        """, (condominio_id, condominio_id))
+
+        conn.commit()
+        conn.close()
+        return True
+
+    @classmethod
+    def get_aggregati(cls, condominio_id, anno_da, anno_a, data_version=None):
+        """Spese aggregate per anno/mese/tabella/logica P/I negli anni indicati (estremi inclusi).
+
+        Con `data_version` legge dalla tabella di rollup, aggiornandola se non è
+        allineata alla versione dati; altrimenti aggrega direttamente le spese.
+        """
+        if data_version is not None:
+            cls.aggiorna(condominio_id, data_version)
+            sql = """
+                SELECT anno, mese, tabella_millesimi, logica_pi, numero_spese, totale
+                FROM spese_rollup
+                WHERE condominio_id = ? AND anno BETWEEN ? AND ?
+            """
+            params = (condominio_id, anno_da, anno_a)
+        else:
+            # Filtro per intervallo di date: usa l'indice (condominio_id, data_spesa)
+            sql = cls._select_aggregati().format(filtro='AND data_spesa >= ? AND data_spesa < ?')
+            params = (condominio_id, f'{anno_da}-01-01', f'{anno_a + 1}-01-01')
+
+        conn = get_db()
+        cursor = conn.cursor()
+        exec_sql(cursor, f"""
+            SELECT * FROM ({sql}) aggregati
+            ORDER BY anno, mese, tabella_millesimi, logica_pi
+        """, params)
+        aggregati = [dict(row) for row in cursor.fetchall()]
+        conn.close()
+        return aggregati
+
+
+class RicercaSpese:
+    """Ricerca full-text su spese e spese preventivate (FTS5 su SQLite, tsvector su Postgres)"""
+
+    # Presenza delle tabelle FTS5 per file SQLite (ogni shard ha il proprio schema)
+    _fts_disponibile = {}
+
+    @classmethod
+    def fts_disponibile(cls, cursor):
+        percorso = percorso_db_corrente()
+        if percorso not in cls._fts_disponibile:
+            exec_sql(cursor, "SELECT COUNT(*) AS n FROM sqlite_master WHERE name IN ('spese_fts', 'spese_preventivate_fts')")
+            cls._fts_disponibile[percorso] = cursor.fetchone()['n'] == 2
+        return cls._fts_disponibile[percorso]
+
+    @classmethod
+    def _sorgente(cls, tipo, parole, fts):
+        """SELECT (sql, parametri) dei risultati di un tipo, con colonna `punteggio` (più bassa = migliore)"""
+        if tipo == 'spesa':
+            tabella, alias = 'spese', 's'
+            colonne = ("'spesa' AS tipo, s.id, s.descrizione, NULL AS note, s.importo, "
+                       "s.data_spesa AS data, s.tabella_millesimi, s.logica_pi, NULL AS anno")
+            join = ""
+            condominio = "s.condominio_id = ?"
+        else:
+            tabella, alias = 'spese_preventivate', 'sp'
+            colonne = ("'preventivata' AS tipo, sp.id, sp.descrizione, sp.note, sp.importo_previsto AS importo, "
+                       "sp.data_prevista AS data, sp.tabella_millesimi, sp.logica_pi, pa.anno")
+            join = " JOIN preventivi_annuali pa ON sp.preventivo_id = pa.id"
+            condominio = "sp.condominio_id = ?"
+
+        if IS_POSTGRES:
+            documento = re.sub(r'\b(descrizione|note)\b', rf'{alias}.\1', TSVECTOR_RICERCA[tabella])
+            query = ' & '.join(f"{p}:*" for p in parole)
+            sql = (f"SELECT {colonne}, -ts_rank({documento}, to_tsquery('simple', ?)) AS punteggio "
+                   f"FROM {tabella} {alias}{join} "
+                   f"WHERE {documento} @@ to_tsquery('simple', ?) AND {condominio}")
+            return sql, [query, query]
+
+        if fts:
+            query = ' '.join(f'"{p}"*' for p in parole)
+            sql = (f"SELECT {colonne}, bm25({tabella}_fts) AS punteggio "
+                   f"FROM {tabella}_fts JOIN {tabella} {alias} ON {alias}.id = {tabella}_fts.rowid{join} "
+                   f"WHERE {tabella}_fts MATCH ? AND {condominio}")
+            return sql, [query]
+
+        # Senza FTS5: tutte le parole contenute nella descrizione (o nelle note), nessun punteggio
+        testo = f"{alias}.descrizione" if tipo == 'spesa' else f"{alias}.descrizione || ' ' || COALESCE({alias}.note, '')"
+        sql = (f"SELECT {colonne}, 0 AS punteggio FROM {tabella} {alias}{join} WHERE "
+               + ' AND '.join(f"{testo} LIKE ?" for _ in parole) + f" AND {condominio}")
+        return sql, [f"%{p}%" for p in parole]
+
+    @classmethod
+    def cerca(cls, condominio_id, parole, tipi=('spesa', 'preventivata'), tabella=None,
+              data_da=None, data_a=None, limit=20, offset=0, conn=None):
+        """Cerca le parole (come prefissi, tutte presenti) nelle descrizioni e note.
+
+        Ritorna (risultati della pagina ordinati per rilevanza, numero totale di risultati).
+        """
+        chiudi = conn is None
+        conn = conn or get_db()
+        cursor = conn.cursor()
+        fts = not IS_POSTGRES and cls.fts_disponibile(cursor)
+
+        parti = []
+        params = []
+        for tipo in tipi:
+            sql, parametri = cls._sorgente(tipo, parole, fts)
+            alias = 's' if tipo == 'spesa' else 'sp'
+            colonna_data = 's.data_spesa' if tipo == 'spesa' else 'sp.data_prevista'
+            parametri.append(condominio_id)
+            if tabella:
+                sql += f" AND {alias}.tabella_millesimi = ?"
+                parametri.append(tabella)
+            if data_da:
+                sql += f" AND {colonna_data} >= ?"
+                parametri.append(data_da)
+            if data_a:
+                sql += f" AND {colonna_data} <= ?"
+                parametri.append(data_a)
+            parti.append(sql)
+            params.extend(parametri)
+
+        unione = ' UNION ALL '.join(parti)
+        exec_sql(cursor, f"SELECT COUNT(*) AS n FROM ({unione}) risultati", params)
+        totale = cursor.fetchone()['n']
+
+        risultati = []
+        if totale > offset:
+            exec_sql(cursor, f"""
+                SELECT * FROM ({unione}) risultati
+                ORDER BY punteggio, data DESC, id DESC
+                LIMIT ? OFFSET ?
+            """, params + [limit, offset])
+            risultati = [dict(row) for row in cursor.fetchall()]
+
+        if chiudi:
+            conn.close()
+        return risultati, totale
@@ -0,0 +1,77 @@
+import math
+from decimal import Decimal, ROUND_HALF_UP
+
+# Cifre decimali conservate per millesimi (es. 333.333) e percentuali (es. 33.3333)
+DECIMALI_MILLESIMI = 3
+DECIMALI_PERCENTUALE = 4
+
+def _scala(valore, decimali):
+    """Converte un numero in intero scalato di 10**decimali (arrotondamento half-up)"""
+    return int(Decimal(str(valore or 0)).scaleb(decimali).to_integral_value(ROUND_HALF_UP))
+
+def to_cents(importo):
+    """Importo in euro -> centesimi interi"""
+    return _scala(importo, 2)
+
+def from_cents(centesimi):
+    """Centesimi interi -> importo in euro (float con al più due decimali)"""
+    return centesimi / 100
+
+def somma(importi):
+    """Somma esatta di importi in euro (evita la deriva dei float)"""
+    return from_cents(sum(to_cents(i) for i in importi))
+
+def _dividi_arrotondando(numeratore, denominatore):
+    """Divisione intera con arrotondamento half-up (lontano da zero)"""
+    if numeratore < 0:
+        return -_dividi_arrotondando(-numeratore, denominatore)
+    return (2 * numeratore + denominatore) // (2 * denominatore)
+
+def alloca(totale, pesi):
+    """Divide `totale` centesimi in proporzione ai pesi (interi >= 0).
+
+    Metodo del resto maggiore: ogni quota riceve la parte intera, i centesimi
+    rimanenti vanno alle quote con il resto più alto (a parità, la prima).
+    La somma delle quote è sempre esattamente `totale`.
+    """
+    somma_pesi = sum(pesi)
+    if totale == 0 or somma_pesi <= 0:
+        return [0] * len(pesi)
+
+    segno = -1 if totale < 0 else 1
+    totale = abs(totale)
+
+    quote = []
+    resti = []
+    for peso in pesi:
+        quota, resto = divmod(totale * peso, somma_pesi)
+        quote.append(quota)
+        resti.append(resto)
+
+    mancanti = totale - sum(quote)
+    for i in sorted(range(len(pesi)), key=lambda i: -resti[i])[:mancanti]:
+        quote[i] += 1
+
+    return [segno * q for q in quote]
+
+def ripartisci(importo, quote):
+    """Ripartisce una spesa in centesimi tra più quote.
+
+    `quote` è una lista di (millesimi, percentuale, divisore): la quota esatta è
+    importo * millesimi/1000 * percentuale/100 / divisore. I calcoli sono in
+    aritmetica intera; il totale ripartito è l'arrotondamento al centesimo della
+    somma esatta delle quote (pari a `importo` quando le quote coprono 1000
+    millesimi al 100%) e viene distribuito con `alloca`.
+    """
+    if not quote:
+        return []
+
+    divisore_comune = math.lcm(*(int(d) for _, _, d in quote))
+    pesi = [
+        _scala(millesimi, DECIMALI_MILLESIMI) * _scala(percentuale, DECIMALI_PERCENTUALE) * (divisore_comune // int(d))
+        for millesimi, percentuale, d in quote
+    ]
+    denominatore = 1000 * 10 ** DECIMALI_MILLESIMI * 100 * 10 ** DECIMALI_PERCENTUALE * divisore_comune
+
+    totale = _dividi_arrotondando(to_cents(importo) * sum(pesi), denominatore)
+    return alloca(totale, pesi)
@@ -0,0 +1,204 @@
+"""Calcolo della ripartizione su più processi.
+
+La ripartizione di una tabella dipende solo dai suoi millesimi e dalle sue
+spese: ripartisci_per_tabella() distribuisce le tabelle (A-L) di un
+condominio su un pool di processi quando il calcolo è grande. Nel percorso
+delle richieste è disattivato di default (RIPARTIZIONE_PROCESSI=1); se
+attivato usa un unico pool per processo, avviato con 'spawn': i worker non
+ereditano thread e connessioni del worker web. Il ricalcolo completo di tutti
+i condominii (es. notturno da cron) li distribuisce invece per condominio, con
+un pool creato per l'esecuzione:
+
+    python ripartizione_parallela.py [--processi N]
+
+In entrambi i casi i risultati sono uniti in un ordine fisso (tabella, poi
+ordine delle spese; id del condominio), indipendente da quale processo
+finisce prima, e le quote sono in centesimi interi: l'esito è identico al
+calcolo sequenziale.
+"""
+import os
+import time
+import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Processi per il calcolo per tabella durante le richieste (0 o 1 = sempre sequenziale)
+RIPARTIZIONE_PROCESSI = int(os.getenv('RIPARTIZIONE_PROCESSI', '1'))
+# Quote da calcolare (spese × persone) sotto cui una ripartizione resta nel processo corrente
+RIPARTIZIONE_PARALLELA_SOGLIA = int(os.getenv('RIPARTIZIONE_PARALLELA_SOGLIA', '200000'))
+
+# True nei processi del ricalcolo completo: niente pool annidati
+_nel_pool = False
+
+# Pool del calcolo per tabella: uno per processo, creato alla prima richiesta grande
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def dati_spesa(chiave, importo, logica_pi, percentuale_proprietario, percentuale_inquilino):
+    """Spesa nel formato del kernel (tupla serializzabile verso i processi del pool)"""
+    return (chiave, importo, logica_pi, percentuale_proprietario, percentuale_inquilino)
+
+def dati_persona(row):
+    """Persona con millesimi nel formato del kernel (le righe sqlite3.Row non sono serializzabili)"""
+    return {
+        'persona_id': row['persona_id'],
+        'unita_id': row['unita_id'],
+        'tipo_persona': row['tipo_persona'],
+        'millesimi': row['millesimi']
+    }
+
+def ripartisci_tabella(spese, persone_con_millesimi, profilo):
+    """Kernel: quote in centesimi delle spese di una tabella, [(chiave, {persona_id: centesimi})]"""
+    from utils import ripartisci_spesa
+    return [
+        (chiave, ripartisci_spesa(importo, logica_pi, percentuale_proprietario, percentuale_inquilino,
+                                  persone_con_millesimi, profilo))
+        for chiave, importo, logica_pi, percentuale_proprietario, percentuale_inquilino in spese
+    ]
+
+def _pool_tabelle(processi):
+    """Pool 'spawn' del processo corrente (ricreato dopo un fork o se si è rotto)"""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=processi, mp_context=multiprocessing.get_context('spawn'))
+            _pool_pid = os.getpid()
+        return _pool
+
+def _scarta_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+def ripartisci_per_tabella(lavori, profilo, processi=None):
+    """Quote di tutte le spese, calcolate tabella per tabella.
+
+    `lavori` è {tabella: (spese, persone_con_millesimi)} con spese da
+    dati_spesa(). Ritorna {chiave spesa: {persona_id: centesimi}}.
+    Ogni partizione porta le spese e le persone della propria tabella; se il
+    pool si rompe (es. un processo terminato) il calcolo riprende in sequenza.
+    """
+    processi = RIPARTIZIONE_PROCESSI if processi is None else processi
+    dimensione = sum(len(spese) * len(persone) for spese, persone in lavori.values())
+    partizioni = None
+    if not _nel_pool and processi >= 2 and len(lavori) >= 2 and dimensione >= RIPARTIZIONE_PARALLELA_SOGLIA:
+        pool = _pool_tabelle(processi)
+        try:
+            futuri = {tabella: pool.submit(ripartisci_tabella, spese, persone, profilo)
+                      for tabella, (spese, persone) in lavori.items()}
+            partizioni = {tabella: futuro.result() for tabella, futuro in futuri.items()}
+        except BrokenProcessPool:
+            _scarta_pool(pool)
+    if partizioni is None:
+        partizioni = {tabella: ripartisci_tabella(spese, persone, profilo)
+                      for tabella, (spese, persone) in lavori.items()}
+
+    quote = {}
+    for tabella in sorted(partizioni):
+        quote.update(partizioni[tabella])
+    return quote
+
+# ======================
+# RICALCOLO COMPLETO (per condominio)
+# ======================
+
+def _inizializza_ricalcolo():
+    # Il flag va sul modulo importato da utils anche quando questo file è eseguito come script
+    import ripartizione_parallela
+    ripartizione_parallela._nel_pool = True
+
+def ricalcola_condominio(condominio_id, user_id, anno):
+    """Ripartizione completa e ripartizione del preventivo dell'anno di un condominio.
+
+    Ritorna (condominio_id, persone ripartite, ms, errore o None): un errore
+    su un condominio non interrompe il ricalcolo degli altri.
+    """
+    from database_universal import imposta_shard, ripristina_shard
+    from utils import calculate_ripartizione_completa, calculate_ripartizione_preventivo, log_error
+
+    shard = imposta_shard(user_id)
+    t0 = time.perf_counter()
+    try:
+        totali = calculate_ripartizione_completa(condominio_id)
+        calculate_ripartizione_preventivo(condominio_id, anno)
+        return condominio_id, len(totali), round((time.perf_counter() - t0) * 1000, 1), None
+    except Exception as e:
+        log_error(str(e), f'ricalcola_condominio {condominio_id}')
+        return condominio_id, 0, round((time.perf_counter() - t0) * 1000, 1), str(e)
+    finally:
+        ripristina_shard(shard)
+
+def condominii_da_ricalcolare():
+    """(condominio_id, user_id) di tutti i condominii, anche negli shard per utente"""
+    from database_universal import SQLITE_SHARDING, get_db, get_catalog_db, exec_sql, imposta_shard, ripristina_shard
+
+    conn = get_catalog_db()
+    try:
+        cursor = conn.cursor()
+        if not SQLITE_SHARDING:
+            exec_sql(cursor, "SELECT id, user_id FROM condominii ORDER BY id")
+            return [(row['id'], row['user_id']) for row in cursor.fetchall()]
+        exec_sql(cursor, "SELECT id FROM users ORDER BY id")
+        utenti = [row['id'] for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+    condominii = []
+    for user_id in utenti:
+        shard = imposta_shard(user_id)
+        try:
+            conn = get_db()
+            try:
+                cursor = conn.cursor()
+                exec_sql(cursor, "SELECT id FROM condominii WHERE user_id = ? ORDER BY id", (user_id,))
+                condominii.extend((row['id'], user_id) for row in cursor.fetchall())
+            finally:
+                conn.close()
+        finally:
+            ripristina_shard(shard)
+    return condominii
+
+def ricalcola_tutti(processi=None, anno=None):
+    """Ricalcola le ripartizioni di tutti i condominii su un pool di processi.
+
+    Ritorna [(condominio_id, persone, ms, errore)] in ordine di id. Dentro ai
+    processi il calcolo per tabella resta sequenziale (un core per condominio).
+    """
+    from datetime import datetime
+
+    processi = (os.cpu_count() or 1) if processi is None else processi
+    anno = anno or datetime.now().year
+    condominii = condominii_da_ricalcolare()
+    argomenti = [(condominio_id, user_id, anno) for condominio_id, user_id in condominii]
+
+    if processi < 2 or len(condominii) < 2:
+        return [ricalcola_condominio(*a) for a in argomenti]
+    with ProcessPoolExecutor(max_workers=min(processi, len(condominii)),
+                             initializer=_inizializza_ricalcolo) as pool:
+        # map mantiene l'ordine degli argomenti, non quello di completamento
+        return list(pool.map(ricalcola_condominio, *zip(*argomenti)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ricalcolo completo delle ripartizioni')
+    parser.add_argument('--processi', type=int, default=os.cpu_count() or 1,
+                        help='processi paralleli (default: numero di core)')
+    parser.add_argument('--anno', type=int, help="anno dei preventivi (default: anno corrente)")
+    argomenti = parser.parse_args()
+
+    from migrations import applica_migrazioni
+    applica_migrazioni(verbose=False)
+
+    t0 = time.perf_counter()
+    risultati = ricalcola_tutti(argomenti.processi, argomenti.anno)
+    for condominio_id, persone, ms, errore in risultati:
+        if errore:
+            print(f"Condominio {condominio_id}: ERRORE {errore}")
+        else:
+            print(f"Condominio {condominio_id}: {persone} persone, {ms} ms")
+    print(f"{len(risultati)} condominii ricalcolati in {round(time.perf_counter() - t0, 1)} s "
+          f"con {max(1, argomenti.processi)} processi")
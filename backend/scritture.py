@@ -0,0 +1,127 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+from database_universal import IS_POSTGRES, get_db, get_sqlite_db, percorso_db_corrente, segna_scrittura
+
+# Group commit (solo SQLite): le scritture dei modelli vengono raccolte da un
+# thread dedicato ed eseguite in un'unica transazione, con un solo commit/fsync
+WRITE_COALESCING = os.getenv('WRITE_COALESCING', '0') == '1' and not IS_POSTGRES
+# Attesa massima (ms) di altre scritture dopo la prima di un lotto
+WRITE_COALESCING_MS = float(os.getenv('WRITE_COALESCING_MS', '2'))
+# Scritture massime per transazione
+WRITE_COALESCING_MAX = int(os.getenv('WRITE_COALESCING_MAX', '256'))
+# Secondi di attesa massima dell'esito per il thread della richiesta
+WRITE_COALESCING_TIMEOUT = 60
+
+class CoalescitoreScritture:
+    """Thread scrittore unico per processo che esegue le scritture a lotti.
+
+    Ogni scrittura è una funzione che riceve il cursore e ritorna un valore
+    (es. l'id della riga). Nel lotto ciascuna gira in un proprio SAVEPOINT:
+    se fallisce viene annullata solo lei e il chiamante riceve l'eccezione.
+    Dopo un fork il processo figlio avvia un nuovo thread con una nuova coda.
+    """
+
+    def __init__(self, finestra_ms=WRITE_COALESCING_MS, massimo=WRITE_COALESCING_MAX):
+        self.finestra = finestra_ms / 1000
+        self.massimo = massimo
+        self._coda = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def invia(self, percorso, funzione):
+        """Accoda funzione(cursor) per il file `percorso`; ritorna un Future con il risultato"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._coda = queue.Queue()
+                self._pid = os.getpid()
+                threading.Thread(target=self._ciclo, args=(self._coda,),
+                                 name='scrittore-sqlite', daemon=True).start()
+            coda = self._coda
+        futuro = Future()
+        coda.put((percorso, funzione, futuro))
+        return futuro
+
+    def _ciclo(self, coda):
+        while True:
+            lotto = [coda.get()]
+            scadenza = time.monotonic() + self.finestra
+            while len(lotto) < self.massimo:
+                attesa = scadenza - time.monotonic()
+                if attesa <= 0:
+                    break
+                try:
+                    lotto.append(coda.get(timeout=attesa))
+                except queue.Empty:
+                    break
+
+            per_file = {}
+            for percorso, funzione, futuro in lotto:
+                per_file.setdefault(percorso, []).append((funzione, futuro))
+            for percorso, voci in per_file.items():
+                self._scrivi(percorso, voci)
+
+    def _scrivi(self, percorso, voci):
+        completate = []
+        conn = None
+        try:
+            conn = get_sqlite_db(percorso)
+            cursor = conn.cursor()
+            # Transazione esplicita: i SAVEPOINT restano annidati fino al commit
+            cursor.execute("BEGIN IMMEDIATE")
+            for funzione, futuro in voci:
+                if not futuro.set_running_or_notify_cancel():
+                    continue
+                cursor.execute("SAVEPOINT scrittura")
+                try:
+                    risultato = funzione(cursor)
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO scrittura")
+                    cursor.execute("RELEASE scrittura")
+                    futuro.set_exception(e)
+                    continue
+                cursor.execute("RELEASE scrittura")
+                completate.append((futuro, risultato))
+            conn.commit()
+        except Exception as e:
+            if conn is not None:
+                conn.rollback()
+            # Commit (o apertura della transazione) fallito: falliscono tutte le scritture del lotto
+            for _, futuro in voci:
+                if not futuro.done():
+                    if not futuro.running():
+                        futuro.set_running_or_notify_cancel()
+                    futuro.set_exception(e)
+            for futuro, _ in completate:
+                if not futuro.done():
+                    futuro.set_exception(e)
+            return
+        finally:
+            if conn is not None:
+                conn.close()
+        for futuro, risultato in completate:
+            futuro.set_result(risultato)
+
+_coalescitore = CoalescitoreScritture()
+
+def esegui_scrittura(funzione):
+    """Esegue funzione(cursor) in una transazione e ne ritorna il risultato.
+
+    Con WRITE_COALESCING la scrittura passa dal thread scrittore e condivide
+    il commit con le altre richieste arrivate nella stessa finestra; altrimenti
+    usa una connessione propria con un commit dedicato.
+    """
+    if not WRITE_COALESCING:
+        conn = get_db()
+        try:
+            risultato = funzione(conn.cursor())
+            conn.commit()
+            return risultato
+        finally:
+            conn.close()
+
+    segna_scrittura()
+    return _coalescitore.invia(percorso_db_corrente(), funzione).result(timeout=WRITE_COALESCING_TIMEOUT)
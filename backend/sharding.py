@@ -0,0 +1,144 @@
+"""Strumenti per gli shard SQLite per utente (SQLITE_SHARDING=1).
+
+    python sharding.py dividi [--elimina]   copia i dati di ogni utente dal catalogo al suo shard
+    python sharding.py unisci               riporta nel catalogo i dati di tutti gli shard
+
+Da eseguire con l'applicazione ferma. Gli id vengono conservati: gli shard
+generano id in blocchi distinti per utente, quindi l'unione non ha conflitti.
+"""
+import os
+import re
+import sys
+import argparse
+
+from database_universal import (
+    IS_POSTGRES, get_catalog_db, get_sqlite_db, percorso_shard, prepara_shard
+)
+
+# Tabelle con i dati di un utente, in ordine di dipendenza (padri prima dei figli)
+TABELLE_UTENTE = [
+    'condominii', 'unita_immobiliari', 'persone', 'millesimi', 'spese', 'ripartizione_spese',
+    'preventivi_annuali', 'spese_preventivate', 'ripartizione_preventivo', 'preventivi_dettaglio',
+    'storici_anni', 'spese_rollup',
+]
+
+def _filtro(tabella, schema):
+    """Condizione WHERE (parametro: user_id) che seleziona le righe di un utente"""
+    condominii = f"SELECT id FROM {schema}.condominii WHERE user_id = ?"
+    if tabella == 'condominii':
+        return "user_id = ?"
+    if tabella == 'preventivi_dettaglio':
+        return f"preventivo_id IN (SELECT id FROM {schema}.preventivi_annuali WHERE condominio_id IN ({condominii}))"
+    return f"condominio_id IN ({condominii})"
+
+def _colonne_comuni(cursor, tabella):
+    """Colonne presenti sia nel catalogo (main) sia nello shard"""
+    cursor.execute(f"PRAGMA main.table_info({tabella})")
+    principali = [row[1] for row in cursor.fetchall()]
+    cursor.execute(f"PRAGMA shard.table_info({tabella})")
+    nello_shard = {row[1] for row in cursor.fetchall()}
+    return ', '.join(c for c in principali if c in nello_shard)
+
+def _copia(cursor, origine, destinazione, user_id):
+    """Copia le righe dell'utente tra i due schemi; ritorna le righe per tabella"""
+    copiate = {}
+    for tabella in TABELLE_UTENTE:
+        colonne = _colonne_comuni(cursor, tabella)
+        cursor.execute(f"""
+            INSERT INTO {destinazione}.{tabella} ({colonne})
+            SELECT {colonne} FROM {origine}.{tabella} WHERE {_filtro(tabella, origine)}
+        """, (user_id,))
+        copiate[tabella] = cursor.rowcount
+    return copiate
+
+def _elimina(cursor, schema, user_id):
+    for tabella in reversed(TABELLE_UTENTE):
+        cursor.execute(f"DELETE FROM {schema}.{tabella} WHERE {_filtro(tabella, schema)}", (user_id,))
+
+def dividi(elimina=False):
+    """Crea uno shard per ogni utente del catalogo copiandovi i suoi dati.
+
+    Gli shard già esistenti vengono saltati. Con `elimina` i dati copiati sono
+    rimossi dal catalogo.
+    """
+    catalogo = get_catalog_db()
+    try:
+        cursor = catalogo.cursor()
+        cursor.execute("SELECT id FROM users ORDER BY id")
+        for (user_id,) in cursor.fetchall():
+            percorso = percorso_shard(user_id)
+            if os.path.exists(percorso):
+                print(f"Utente {user_id}: shard già presente ({percorso}), saltato")
+                continue
+
+            os.makedirs(os.path.dirname(percorso), exist_ok=True)
+            shard = get_sqlite_db(percorso)
+            try:
+                prepara_shard(shard, user_id)
+            finally:
+                shard.close()
+
+            cursor.execute("ATTACH DATABASE ? AS shard", (percorso,))
+            try:
+                copiate = _copia(cursor, 'main', 'shard', user_id)
+                if elimina:
+                    _elimina(cursor, 'main', user_id)
+                catalogo.commit()
+            except Exception:
+                catalogo.rollback()
+                raise
+            finally:
+                cursor.execute("DETACH DATABASE shard")
+            print(f"Utente {user_id}: {copiate['condominii']} condominii, "
+                  f"{copiate['spese']} spese -> {percorso}")
+    finally:
+        catalogo.close()
+
+def unisci():
+    """Riporta nel catalogo i dati di tutti gli shard, sostituendo quelli presenti"""
+    cartella = os.path.dirname(percorso_shard(0))
+    if not os.path.isdir(cartella):
+        print(f"Nessuno shard in {cartella}")
+        return
+
+    catalogo = get_catalog_db()
+    try:
+        cursor = catalogo.cursor()
+        for nome in sorted(os.listdir(cartella)):
+            trovato = re.fullmatch(r'utente_(\d+)\.db', nome)
+            if not trovato:
+                continue
+            user_id = int(trovato.group(1))
+            cursor.execute("ATTACH DATABASE ? AS shard", (os.path.join(cartella, nome),))
+            try:
+                _elimina(cursor, 'main', user_id)
+                copiate = _copia(cursor, 'shard', 'main', user_id)
+                catalogo.commit()
+            except Exception:
+                catalogo.rollback()
+                raise
+            finally:
+                cursor.execute("DETACH DATABASE shard")
+            print(f"Utente {user_id}: {copiate['condominii']} condominii, "
+                  f"{copiate['spese']} spese riportati nel catalogo")
+    finally:
+        catalogo.close()
+
+if __name__ == '__main__':
+    if IS_POSTGRES:
+        sys.exit("Gli shard sono disponibili solo con SQLite")
+
+    parser = argparse.ArgumentParser(description='Shard SQLite per utente')
+    comandi = parser.add_subparsers(dest='comando', required=True)
+    comando_dividi = comandi.add_parser('dividi', help='copia i dati di ogni utente nel suo shard')
+    comando_dividi.add_argument('--elimina', action='store_true', help='rimuove dal catalogo i dati copiati')
+    comandi.add_parser('unisci', help='riporta nel catalogo i dati degli shard')
+    argomenti = parser.parse_args()
+
+    from migrations import applica_migrazioni
+    applica_migrazioni(verbose=False)
+
+    if argomenti.comando == 'dividi':
+        dividi(elimina=argomenti.elimina)
+    else:
+        unisci()
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# I moduli del backend si importano per nome (come in app.py): la cartella backend va nel path
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND not in sys.path:
+    sys.path.insert(0, BACKEND)
+
+# Nessun test deve toccare il database di sviluppo
+os.environ.setdefault('CONDOMINIO_DB_PATH', os.path.join(tempfile.mkdtemp(), 'test.db'))
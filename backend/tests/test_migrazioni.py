@@ -0,0 +1,135 @@
+import sqlite3
+
+import pytest
+
+import migrations
+from migrations import applica_migrazioni, get_schema_version, SCHEMA_VERSION
+
+
+class ErroreSQL(Exception):
+    pass
+
+
+class CursorePostgresFinto:
+    def __init__(self, conn):
+        self.conn = conn
+        self.riga = None
+
+    def execute(self, sql, params=None):
+        sql = ' '.join(sql.split())
+        if self.conn.annullata:
+            raise ErroreSQL('current transaction is aborted')
+        self.conn.eseguite.append(sql)
+        if sql.startswith('SELECT pg_advisory_lock'):
+            self.conn.lock = True
+        elif sql.startswith('SELECT pg_advisory_unlock'):
+            self.conn.lock = False
+        elif sql.startswith('SELECT MAX(versione)'):
+            self.riga = {'versione': self.conn.versione}
+        elif sql.startswith('ERRORE'):
+            self.conn.annullata = True
+            raise ErroreSQL('syntax error')
+
+    def fetchone(self):
+        return self.riga
+
+
+class ConnessionePostgresFinta:
+    """Connessione con la semantica delle transazioni PostgreSQL: dopo un errore
+    ogni istruzione fallisce fino al rollback"""
+
+    def __init__(self):
+        self.versione = 0
+        self.annullata = False
+        self.lock = False
+        self.chiusa = False
+        self.eseguite = []
+
+    def cursor(self):
+        return CursorePostgresFinto(self)
+
+    def commit(self):
+        if self.annullata:
+            raise ErroreSQL('current transaction is aborted')
+
+    def rollback(self):
+        self.annullata = False
+
+    def close(self):
+        self.chiusa = True
+
+
+def test_database_nuovo_e_aggiornato():
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    assert applica_migrazioni(conn, verbose=False) == SCHEMA_VERSION
+    versioni = [row['versione'] for row in conn.execute("SELECT versione FROM schema_version ORDER BY versione")]
+    assert versioni == [numero for numero, _ in migrations.MIGRAZIONI]
+
+    # Schema aggiornato: nessuna migrazione rieseguita
+    eseguite = []
+    conn.set_trace_callback(eseguite.append)
+    assert applica_migrazioni(conn, verbose=False) == SCHEMA_VERSION
+    assert eseguite == ["SELECT MAX(versione) AS versione FROM schema_version"]
+
+
+def test_migrazione_fallita_non_registrata(monkeypatch):
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    applica_migrazioni(conn, verbose=False)
+
+    tentativi = []
+
+    def m_fallita(conn):
+        tentativi.append(1)
+        conn.execute("UPDATE condominii SET nome = 'parziale'")
+        raise ErroreSQL('migrazione fallita')
+
+    successiva = SCHEMA_VERSION + 1
+    monkeypatch.setattr(migrations, 'MIGRAZIONI', migrations.MIGRAZIONI + [(successiva, m_fallita)])
+    monkeypatch.setattr(migrations, 'SCHEMA_VERSION', successiva)
+    with pytest.raises(ErroreSQL, match='migrazione fallita'):
+        applica_migrazioni(conn, verbose=False)
+
+    assert get_schema_version(conn) == SCHEMA_VERSION
+    assert not conn.in_transaction
+
+    # Al prossimo avvio la migrazione viene ritentata
+    with pytest.raises(ErroreSQL):
+        applica_migrazioni(conn, verbose=False)
+    assert len(tentativi) == 2
+
+
+def test_postgres_errore_rilascia_il_lock(monkeypatch):
+    def m_fallita(conn):
+        conn.cursor().execute("ERRORE")
+
+    monkeypatch.setattr(migrations, 'MIGRAZIONI', [(1, m_fallita)])
+    monkeypatch.setattr(migrations, 'SCHEMA_VERSION', 1)
+    conn = ConnessionePostgresFinta()
+
+    # L'errore originale arriva al chiamante, non quello dell'unlock
+    with pytest.raises(ErroreSQL, match='syntax error'):
+        applica_migrazioni(conn, verbose=False)
+    assert not conn.lock
+    assert not conn.annullata
+    assert conn.eseguite[-1].startswith('SELECT pg_advisory_unlock')
+    assert not any('INSERT INTO schema_version' in sql for sql in conn.eseguite)
+
+
+def test_postgres_unlock_fallito_chiude_la_connessione(monkeypatch):
+    monkeypatch.setattr(migrations, 'MIGRAZIONI', [(1, lambda conn: None)])
+    monkeypatch.setattr(migrations, 'SCHEMA_VERSION', 1)
+    conn = ConnessionePostgresFinta()
+    conn.chiudi = lambda: setattr(conn, 'chiusa', True)
+    esegui = CursorePostgresFinto.execute
+
+    def execute(self, sql, params=None):
+        if sql.startswith('SELECT pg_advisory_unlock'):
+            raise ErroreSQL('connessione persa')
+        return esegui(self, sql, params)
+
+    monkeypatch.setattr(CursorePostgresFinto, 'execute', execute)
+    assert applica_migrazioni(conn, verbose=False) == 1
+    # Lock di sessione rilasciato chiudendo la sessione invece di restituirla al pool
+    assert conn.chiusa
@@ -0,0 +1,150 @@
+import random
+
+import pytest
+
+from money import alloca, ripartisci, to_cents
+from utils import ProfiloRuoli, ripartisci_spesa
+import ripartizione_parallela
+
+
+def persona(persona_id, unita_id, tipo_persona, millesimi):
+    return {'persona_id': persona_id, 'unita_id': unita_id, 'tipo_persona': tipo_persona, 'millesimi': millesimi}
+
+
+# ======================
+# alloca
+# ======================
+
+def test_alloca_somma_esatta():
+    casuale = random.Random(7)
+    for _ in range(500):
+        pesi = [casuale.randint(0, 1000) for _ in range(casuale.randint(1, 12))]
+        totale = casuale.randint(-100000, 100000)
+        quote = alloca(totale, pesi)
+        assert len(quote) == len(pesi)
+        if sum(pesi):
+            assert sum(quote) == totale
+        else:
+            assert quote == [0] * len(pesi)
+
+
+def test_alloca_resto_maggiore():
+    # 1000 * 3/7 = 428.57, 1000 * 4/7 = 571.43: il centesimo va al resto più alto
+    assert alloca(1000, [3, 4]) == [429, 571]
+    assert alloca(-1000, [3, 4]) == [-429, -571]
+
+
+def test_alloca_parita_alla_prima_quota():
+    assert alloca(100, [1, 1, 1]) == [34, 33, 33]
+    assert alloca(2, [1, 1, 1]) == [1, 1, 0]
+    assert alloca(1, [0, 5, 5]) == [0, 1, 0]
+    # L'ordine dei pesi decide la parità, non il loro valore
+    assert alloca(1, [5, 5, 0]) == [1, 0, 0]
+
+
+def test_alloca_pesi_nulli():
+    assert alloca(1234, [0, 0]) == [0, 0]
+    assert alloca(0, [1, 2]) == [0, 0]
+    assert alloca(1234, []) == []
+
+
+# ======================
+# ripartisci
+# ======================
+
+def test_ripartisci_mille_millesimi_somma_importo():
+    casuale = random.Random(11)
+    for _ in range(200):
+        n = casuale.randint(1, 20)
+        tagli = sorted(casuale.sample(range(1, 1000), n - 1))
+        millesimi = [b - a for a, b in zip([0] + tagli, tagli + [1000])]
+        importo = round(casuale.uniform(0.01, 50000), 2)
+        quote = ripartisci(importo, [(m, 100, 1) for m in millesimi])
+        assert sum(quote) == to_cents(importo)
+
+
+def test_ripartisci_millesimi_non_mille():
+    # Il totale ripartito segue i millesimi presenti, arrotondato al centesimo
+    assert ripartisci(100, [(500, 100, 1), (499, 100, 1)]) == [5000, 4990]
+    assert sum(ripartisci(100, [(600, 100, 1), (600, 100, 1)])) == 12000
+    # 333.333 * 3 = 999.999 millesimi: 99.9999 euro -> 100.00
+    assert sum(ripartisci(100, [(333.333, 100, 1)] * 3)) == 10000
+
+
+def test_ripartisci_divisore_e_percentuale():
+    # Due proprietari della stessa unità (divisore 2) al 70%: 70 euro in parti uguali
+    assert ripartisci(100, [(1000, 70, 2), (1000, 70, 2)]) == [3500, 3500]
+    # Quota dispari: il centesimo in più va alla prima
+    assert ripartisci(0.03, [(1000, 100, 2), (1000, 100, 2)]) == [2, 1]
+
+
+def test_ripartisci_deterministico():
+    quote = [(333.333, 100, 1), (333.333, 100, 1), (333.334, 100, 1)]
+    assert ripartisci(100, quote) == [3333, 3333, 3334]
+    assert ripartisci(100, quote) == ripartisci(100, list(quote))
+
+
+# ======================
+# ripartisci_spesa (logica P/I)
+# ======================
+
+PERSONE = [
+    persona(1, 10, 'proprietario', 400),
+    persona(2, 10, 'inquilino', 400),
+    persona(3, 20, 'proprietario', 300),
+    persona(4, 30, 'proprietario_inquilino', 300),
+]
+
+
+def test_cinquanta_cinquanta():
+    quote = ripartisci_spesa(1000, '50/50', 100, 0, PERSONE, ProfiloRuoli(PERSONE))
+    # Unità 10 con entrambi i ruoli: metà ciascuno; unità 20 e 30 pagano il 100%
+    assert quote == {1: 20000, 2: 20000, 3: 30000, 4: 30000}
+    assert sum(quote.values()) == 100000
+
+
+def test_personalizzato():
+    persone = PERSONE + [persona(5, 20, 'proprietario', 300)]
+    quote = ripartisci_spesa(1000, 'personalizzato', 70, 30, persone, ProfiloRuoli(persone))
+    # Unità 20: due proprietari dividono il 70%; unità 30: P/I paga 70% + 30%
+    assert quote == {1: 28000, 2: 12000, 3: 10500, 4: 30000, 5: 10500}
+
+
+def test_persone_senza_millesimi_escluse():
+    persone = PERSONE + [persona(6, 40, 'proprietario', 0)]
+    quote = ripartisci_spesa(1000, 'proprietario', 100, 0, persone, ProfiloRuoli(persone))
+    assert 6 not in quote
+    assert quote[2] == 0
+
+
+# ======================
+# Calcolo per tabella: parallelo == sequenziale
+# ======================
+
+@pytest.fixture
+def pool_tabelle(monkeypatch):
+    monkeypatch.setattr(ripartizione_parallela, 'RIPARTIZIONE_PARALLELA_SOGLIA', 0)
+    yield
+    if ripartizione_parallela._pool is not None:
+        ripartizione_parallela._scarta_pool(ripartizione_parallela._pool)
+
+
+def test_parallelo_uguale_a_sequenziale(pool_tabelle):
+    casuale = random.Random(3)
+    persone = [persona(i, 100 + i // 2, casuale.choice(['proprietario', 'inquilino', 'proprietario_inquilino']), 0)
+               for i in range(40)]
+    profilo = ProfiloRuoli(persone)
+    lavori = {}
+    for tabella in 'ABC':
+        con_millesimi = [dict(p, millesimi=casuale.randint(1, 60)) for p in persone]
+        spese = [ripartizione_parallela.dati_spesa((tabella, i), round(casuale.uniform(1, 999), 2),
+                                                   casuale.choice(['proprietario', 'inquilino', '50/50', 'personalizzato']),
+                                                   60, 40)
+                 for i in range(50)]
+        lavori[tabella] = (spese, con_millesimi)
+
+    sequenziale = ripartizione_parallela.ripartisci_per_tabella(lavori, profilo, processi=1)
+    parallelo = ripartizione_parallela.ripartisci_per_tabella(lavori, profilo, processi=2)
+    assert ripartizione_parallela._pool is not None
+    assert parallelo == sequenziale
+    assert list(parallelo) == list(sequenziale)
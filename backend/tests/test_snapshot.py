@@ -0,0 +1,53 @@
+import pytest
+
+import database_universal
+
+
+@pytest.fixture
+def client():
+    from app import app
+    client = app.test_client()
+    token = client.post('/api/login', json={'username': 'admin', 'password': 'admin123'}).get_json()['token']
+    client.environ_base['HTTP_AUTHORIZATION'] = f'Bearer {token}'
+    condominio = client.post('/api/condominii', json={'nome': 'Snapshot', 'indirizzo': 'Via Roma 1', 'num_unita': 2}).get_json()
+    client.condo_id = condominio.get('id') or condominio['condominio']['id']
+    return client
+
+
+def test_snapshot_legge_la_replica_solo_se_aggiornata(client, monkeypatch):
+    # La replica deve essere verificata sulla versione del condominio letta dal primario
+    richieste = []
+    get_read_db = database_universal.get_read_db
+
+    def get_read_db_registrato(*condominii):
+        richieste.append(condominii)
+        return get_read_db(*condominii)
+
+    monkeypatch.setattr(database_universal, 'get_read_db', get_read_db_registrato)
+    risposta = client.get(f'/api/condominii/{client.condo_id}/snapshot?sections=persone')
+    assert risposta.status_code == 200
+    assert [[c.id for c in condominii] for condominii in richieste] == [[client.condo_id]]
+
+
+def test_snapshot_dopo_scrittura_nuovo_etag(client):
+    url = f'/api/condominii/{client.condo_id}/snapshot?sections=persone'
+    prima = client.get(url)
+    assert client.get(url, headers={'If-None-Match': prima.headers['ETag']}).status_code == 304
+
+    unita = client.get(f'/api/condominii/{client.condo_id}/unita').get_json()
+    client.post(f'/api/condominii/{client.condo_id}/persone',
+                json={'unita_id': unita[0]['id'], 'nome': 'Mario', 'cognome': 'Rossi', 'tipo_persona': 'proprietario'})
+
+    dopo = client.get(url, headers={'If-None-Match': prima.headers['ETag']})
+    assert dopo.status_code == 200
+    assert dopo.headers['ETag'] != prima.headers['ETag']
+    assert [p['nome'] for p in dopo.get_json()['persone']] == ['Mario']
+
+
+def test_snapshot_non_autorizzato(client):
+    from app import app
+    altro = app.test_client()
+    altro.post('/api/register', json={'username': 'altro_utente', 'password': 'password123', 'email': 'altro@example.com'})
+    risposta = altro.post('/api/login', json={'username': 'altro_utente', 'password': 'password123'}).get_json()
+    altro.environ_base['HTTP_AUTHORIZATION'] = f"Bearer {risposta['token']}"
+    assert altro.get(f'/api/condominii/{client.condo_id}/snapshot').status_code == 403
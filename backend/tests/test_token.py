@@ -0,0 +1,56 @@
+import threading
+import time
+
+import utils
+from database_universal import get_catalog_db
+from models import TokenRevocato
+
+
+def _jti_registrati():
+    conn = get_catalog_db()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT jti FROM token_revocati")
+        return {row['jti'] for row in cursor.fetchall()}
+    finally:
+        conn.close()
+
+
+def test_revoca_elimina_le_revoche_scadute():
+    from app import app  # applica le migrazioni
+    adesso = int(time.time())
+    TokenRevocato.revoca('scaduto', 1, adesso - 10)
+    TokenRevocato.revoca('valido', 1, adesso + 3600)
+
+    assert 'scaduto' not in _jti_registrati()
+    assert TokenRevocato.get_attivi(adesso) >= {'valido'}
+
+
+def test_rilettura_fuori_dal_lock(monkeypatch):
+    # Durante la SELECT gli altri thread non attendono: ricevono l'elenco precedente
+    in_lettura = threading.Event()
+    sblocca = threading.Event()
+
+    def get_attivi_lento(adesso):
+        in_lettura.set()
+        sblocca.wait(5)
+        return {'dal-database'}
+
+    monkeypatch.setattr(utils.TokenRevocato, 'get_attivi', get_attivi_lento)
+    monkeypatch.setattr(utils, '_token_revocati', {'precedente'})
+    monkeypatch.setattr(utils, '_token_revocati_letti_il', 0.0)
+    utils._token_revocati_caricati.set()
+
+    lettore = threading.Thread(target=utils.get_token_revocati)
+    lettore.start()
+    assert in_lettura.wait(5)
+    try:
+        assert utils.get_token_revocati() == {'precedente'}
+        # Una revoca locale durante la rilettura non va persa
+        with utils._token_revocati_lock:
+            utils._token_revocati.add('locale')
+            utils._revoche_locali.add('locale')
+    finally:
+        sblocca.set()
+        lettore.join(5)
+    assert utils.get_token_revocati() == {'dal-database', 'locale'}
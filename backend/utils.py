@@ -1,16 +1,55 @@
 ﻿import os
+import re
 import jwt
+import time
+import uuid
 import hashlib
+import threading
+from array import array
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from functools import wraps
 from flask import request, jsonify, current_app
-from models import User
-from database_universal import exec_sql
+from models import User, TokenRevocato
+from database_universal import exec_sql, imposta_shard, ripristina_shard, nuova_richiesta_db, fine_richiesta_db
+from money import ripartisci, from_cents, to_cents, somma
+from json_provider import json_default
 import json
 
 # Chiave segreta per JWT (usa env in produzione)
 SECRET_KEY = os.getenv("SECRET_KEY", "change-me-in-prod")
 
+# Cache LRU dei token già verificati: sha256(token) -> payload
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', '1024'))
+# Intervallo (secondi) di rilettura dal database dei token revocati dagli altri worker
+TOKEN_REVOCHE_REFRESH = int(os.getenv('TOKEN_REVOCHE_REFRESH', '30'))
+
+_token_cache = OrderedDict()
+_token_cache_lock = threading.Lock()
+_token_revocati = set()
+_token_revocati_letti_il = 0.0
+_token_revocati_lock = threading.Lock()
+# Revoche di questo processo arrivate durante una rilettura (forse non incluse nel risultato)
+_revoche_locali = set()
+# Impostato al termine della prima lettura del processo
+_token_revocati_caricati = threading.Event()
+
+# Cache in-process dei dati di ripartizione (persone e millesimi) per la simulazione:
+# condominio_id -> (data_version, dati)
+SIMULAZIONE_CACHE_SIZE = int(os.getenv('SIMULAZIONE_CACHE_SIZE', '128'))
+
+_dati_ripartizione_cache = OrderedDict()
+_dati_ripartizione_lock = threading.Lock()
+
+# Cache in-process dei profili dei ruoli per unità: condominio_id -> (persone_version, ProfiloRuoli)
+PROFILI_RUOLI_CACHE_SIZE = int(os.getenv('PROFILI_RUOLI_CACHE_SIZE', '256'))
+
+_profili_ruoli_cache = OrderedDict()
+_profili_ruoli_lock = threading.Lock()
+
+# Analytics dalla tabella di rollup (ANALYTICS_ROLLUP=0 aggrega ogni volta direttamente le spese)
+ANALYTICS_ROLLUP = os.getenv('ANALYTICS_ROLLUP', '1') == '1'
+
 def hash_password(password):
     """Hash della password usando SHA-256"""
     return hashlib.sha256(password.encode()).hexdigest()
@@ -34,7 +73,8 @@ def generate_jwt_token(user_id, username):
         'user_id': user_id,
         'username': username,
         'exp': datetime.utcnow() + timedelta(hours=24),
-        'iat': datetime.utcnow()
+        'iat': datetime.utcnow(),
+        'jti': uuid.uuid4().hex  # identificativo per la revoca (logout)
     }
     return jwt.encode(payload, SECRET_KEY, algorithm='HS256')
 
@@ -48,33 +88,157 @@ def verify_jwt_token(token):
     except jwt.InvalidTokenError:
         return None
 
+def get_token_revocati():
+    """jti dei token revocati, riletti dal database ogni TOKEN_REVOCHE_REFRESH secondi.
+
+    Un solo thread per volta rilegge l'elenco (una SELECT, fuori dal lock);
+    gli altri continuano con l'elenco precedente invece di attendere il
+    database. Solo la prima lettura del processo viene attesa da tutti.
+    """
+    global _token_revocati, _token_revocati_letti_il
+    adesso = time.time()
+    if adesso - _token_revocati_letti_il >= TOKEN_REVOCHE_REFRESH:
+        with _token_revocati_lock:
+            rileggi = adesso - _token_revocati_letti_il >= TOKEN_REVOCHE_REFRESH
+            if rileggi:
+                _token_revocati_letti_il = adesso
+                _revoche_locali.clear()
+        if rileggi:
+            try:
+                revocati = TokenRevocato.get_attivi(int(adesso))
+                with _token_revocati_lock:
+                    _token_revocati = revocati | _revoche_locali
+            except Exception as e:
+                # Database non raggiungibile: si mantiene l'ultimo elenco noto
+                log_error(str(e), 'get_token_revocati')
+            finally:
+                _token_revocati_caricati.set()
+    _token_revocati_caricati.wait()
+    return _token_revocati
+
+def verify_jwt_token_cached(token):
+    """Come verify_jwt_token, ma con cache LRU dei token già verificati.
+
+    Un token in cache costa una sola lookup sull'hash; il payload viene
+    scartato alla scadenza (exp) e i token revocati sono sempre rifiutati.
+    """
+    chiave = hashlib.sha256(token.encode()).digest()
+    with _token_cache_lock:
+        payload = _token_cache.get(chiave)
+        if payload is not None:
+            if payload['exp'] > time.time():
+                _token_cache.move_to_end(chiave)
+            else:
+                del _token_cache[chiave]
+                return None
+
+    if payload is None:
+        payload = verify_jwt_token(token)
+        if not payload:
+            return None
+        # Senza exp non si può garantire la scadenza: il token non va in cache
+        if 'exp' in payload:
+            with _token_cache_lock:
+                _token_cache[chiave] = payload
+                while len(_token_cache) > TOKEN_CACHE_SIZE:
+                    _token_cache.popitem(last=False)
+
+    if payload.get('jti') in get_token_revocati():
+        return None
+    return payload
+
+def revoca_token(payload):
+    """Revoca un token (logout).
+
+    Il token è rifiutato subito in questo processo e dagli altri worker al
+    successivo aggiornamento dell'elenco revoche. I token senza jti (emessi
+    prima dell'introduzione della revoca) restano validi fino alla scadenza.
+    """
+    jti = payload.get('jti')
+    if not jti:
+        return False
+    TokenRevocato.revoca(jti, payload['user_id'], int(payload['exp']))
+    with _token_revocati_lock:
+        _token_revocati.add(jti)
+        _revoche_locali.add(jti)
+    return True
+
+def estrai_token():
+    """Token dall'header Authorization: ritorna (token, None) o (None, risposta 401)"""
+    token = None
+
+    # Estrai token dall'header Authorization
+    if 'Authorization' in request.headers:
+        auth_header = request.headers['Authorization']
+        try:
+            token = auth_header.split(" ")[1]  # Bearer <token>
+        except IndexError:
+            return None, (jsonify({'message': 'Formato token non valido'}), 401)
+
+    if not token:
+        return None, (jsonify({'message': 'Token mancante'}), 401)
+    return token, None
+
+def _utente_richiesta(payload):
+    # Aggiungi user info al request context
+    request.current_user_id = payload['user_id']
+    request.current_username = payload['username']
+    request.token_payload = payload
+
 def token_required(f):
     """Decorator per richiedere autenticazione JWT"""
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = None
+        token, errore = estrai_token()
+        if errore:
+            return errore
 
-        # Estrai token dall'header Authorization
-        if 'Authorization' in request.headers:
-            auth_header = request.headers['Authorization']
-            try:
-                token = auth_header.split(" ")[1]  # Bearer <token>
-            except IndexError:
-                return jsonify({'message': 'Formato token non valido'}), 401
+        # Verifica token (con cache dei token già verificati)
+        payload = verify_jwt_token_cached(token)
+        if not payload:
+            return jsonify({'message': 'Token non valido o scaduto'}), 401
 
-        if not token:
-            return jsonify({'message': 'Token mancante'}), 401
+        _utente_richiesta(payload)
 
-        # Verifica token
-        payload = verify_jwt_token(token)
+        # Con SQLITE_SHARDING le query della richiesta vanno al file dell'utente
+        shard = imposta_shard(payload['user_id'])
+        scritture = nuova_richiesta_db()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            fine_richiesta_db(scritture)
+            ripristina_shard(shard)
+
+    return decorated
+
+def token_required_async(f):
+    """Come token_required, per gli handler asincroni di asgi.py.
+
+    La verifica del token può leggere i token revocati dal database, quindi
+    gira nel pool di thread del percorso asincrono.
+    """
+    from database_async import db_async
+
+    @wraps(f)
+    async def decorated(*args, **kwargs):
+        token, errore = estrai_token()
+        if errore:
+            return errore
+
+        payload = await db_async.esegui(verify_jwt_token_cached, token)
         if not payload:
             return jsonify({'message': 'Token non valido o scaduto'}), 401
 
-        # Aggiungi user info al request context
-        request.current_user_id = payload['user_id']
-        request.current_username = payload['username']
+        _utente_richiesta(payload)
 
-        return f(*args, **kwargs)
+        # ContextVar: valgono per il task della richiesta e per i thread di db_async
+        shard = imposta_shard(payload['user_id'])
+        scritture = nuova_richiesta_db()
+        try:
+            return await f(*args, **kwargs)
+        finally:
+            fine_richiesta_db(scritture)
+            ripristina_shard(shard)
 
     return decorated
 
@@ -175,6 +339,37 @@ def validate_spesa_data(data):
 
     return errors
 
+def parole_ricerca(testo, massimo=10):
+    """Parole (minuscole, senza punteggiatura) di un testo di ricerca"""
+    return re.findall(r'\w+', (testo or '').lower())[:massimo]
+
+def validate_ricerca_params(args):
+    """Valida i parametri della ricerca spese (query string)"""
+    errors = []
+
+    if not parole_ricerca(args.get('q')):
+        errors.append('Testo di ricerca obbligatorio')
+
+    if args.get('tipo') and args.get('tipo') not in ['spese', 'preventivate', 'tutte']:
+        errors.append('Tipo non valido (spese, preventivate, tutte)')
+
+    if args.get('tabella') and args.get('tabella') not in ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'L']:
+        errors.append('Tabella millesimi non valida (A-L)')
+
+    for campo in ('data_da', 'data_a'):
+        if args.get(campo):
+            try:
+                datetime.strptime(args.get(campo), '%Y-%m-%d')
+            except ValueError:
+                errors.append(f'{campo} deve essere una data YYYY-MM-DD')
+
+    for campo in ('page', 'per_page'):
+        valore = args.get(campo)
+        if valore is not None and (not valore.isdigit() or int(valore) < 1):
+            errors.append(f'{campo} deve essere un intero positivo')
+
+    return errors
+
 def validate_millesimi_data(millesimi_list, num_unita):
     """Valida dati millesimi per una tabella"""
     errors = []
@@ -207,10 +402,296 @@ def validate_millesimi_data(millesimi_list, num_unita):
 
     return errors
 
+class ProfiloRuoli:
+    """Ruoli presenti in ogni unità: numero di proprietari, inquilini e
+    proprietari_inquilini, in array compatti indicizzati per posizione dell'unità.
+
+    Dipende solo dalle persone. Poiché i millesimi sono per unità, le persone
+    di un'unità hanno tutte millesimi o nessuna: il profilo completo vale per
+    ogni tabella.
+    """
+
+    __slots__ = ('indice', 'proprietari', 'inquilini', 'entrambi', 'quota_50')
+
+    def __init__(self, persone):
+        self.indice = {}
+        self.proprietari = array('I')
+        self.inquilini = array('I')
+        self.entrambi = array('I')
+        for p in persone:
+            posizione = self.indice.get(p['unita_id'])
+            if posizione is None:
+                posizione = self.indice[p['unita_id']] = len(self.proprietari)
+                self.proprietari.append(0)
+                self.inquilini.append(0)
+                self.entrambi.append(0)
+            if p['tipo_persona'] == 'proprietario':
+                self.proprietari[posizione] += 1
+            elif p['tipo_persona'] == 'inquilino':
+                self.inquilini[posizione] += 1
+            elif p['tipo_persona'] == 'proprietario_inquilino':
+                self.entrambi[posizione] += 1
+        # 1 se nell'unità sono coperti entrambi i ruoli (regola 50/50)
+        self.quota_50 = bytes(
+            1 if (self.proprietari[i] or self.entrambi[i]) and (self.inquilini[i] or self.entrambi[i]) else 0
+            for i in range(len(self.proprietari))
+        )
+
+    def entrambi_i_ruoli(self, unita_id):
+        posizione = self.indice.get(unita_id)
+        return posizione is not None and self.quota_50[posizione] == 1
+
+    def divisore(self, unita_id, tipo_persona):
+        """Persone tra cui dividere la quota di un ruolo nell'unità (almeno 1)"""
+        posizione = self.indice.get(unita_id)
+        if posizione is None:
+            return 1
+        if tipo_persona == 'proprietario':
+            return max(1, self.proprietari[posizione])
+        if tipo_persona == 'inquilino':
+            return max(1, self.inquilini[posizione])
+        return 1
+
+def get_profilo_ruoli(cursor, condominio_id):
+    """Profilo dei ruoli del condominio, dalla cache se le persone non sono cambiate.
+
+    Usa il cursore del chiamante (stessa transazione/snapshot dei suoi dati).
+    La cache è invalidata dalle scritture delle persone (persone_version).
+    """
+    exec_sql(cursor, "SELECT persone_version FROM condominii WHERE id = ?", (condominio_id,))
+    row = cursor.fetchone()
+    versione = row['persone_version'] if row else None
+
+    with _profili_ruoli_lock:
+        voce = _profili_ruoli_cache.get(condominio_id)
+        if voce and versione is not None and voce[0] == versione:
+            _profili_ruoli_cache.move_to_end(condominio_id)
+            return voce[1]
+
+    exec_sql(cursor, "SELECT unita_id, tipo_persona FROM persone WHERE condominio_id = ?", (condominio_id,))
+    profilo = ProfiloRuoli(cursor.fetchall())
+    if versione is not None:
+        with _profili_ruoli_lock:
+            _profili_ruoli_cache[condominio_id] = (versione, profilo)
+            _profili_ruoli_cache.move_to_end(condominio_id)
+            while len(_profili_ruoli_cache) > PROFILI_RUOLI_CACHE_SIZE:
+                _profili_ruoli_cache.popitem(last=False)
+    return profilo
+
+def ripartisci_spesa(importo, logica_pi, percentuale_proprietario, percentuale_inquilino,
+                     persone_con_millesimi, profilo):
+    """Quote in centesimi di una spesa per persona (solo persone con millesimi).
+
+    Applica la logica P/I e la divisione intra-ruolo (dal ProfiloRuoli del
+    condominio); le quote sono calcolate
+    in aritmetica intera e sommano esattamente al totale ripartito.
+    """
+    persone_ids = []
+    quote = []
+    for persona in persone_con_millesimi:
+        if not persona['millesimi']:
+            continue  # Salta persone senza millesimi per questa tabella
+
+        # Calcola percentuale in base alla logica P/I
+        if logica_pi == 'proprietario':
+            if persona['tipo_persona'] in ['proprietario', 'proprietario_inquilino']:
+                percentuale = 100
+            else:
+                percentuale = 0
+        elif logica_pi == 'inquilino':
+            if persona['tipo_persona'] in ['inquilino', 'proprietario_inquilino']:
+                percentuale = 100
+            else:
+                percentuale = 0
+        elif logica_pi == '50/50':
+            # Se è una persona che ricopre entrambi i ruoli, paga il 100%
+            if persona['tipo_persona'] == 'proprietario_inquilino':
+                percentuale = 100
+            else:
+                # Se nell'unità sono presenti entrambi i ruoli, paga il 50%
+                if profilo.entrambi_i_ruoli(persona['unita_id']):
+                    percentuale = 50
+                else:
+                    # Se manca il contro-ruolo, il presente copre il 100%
+                    percentuale = 100
+        else:  # personalizzato
+            if persona['tipo_persona'] == 'proprietario_inquilino':
+                # Per P/I, il proprietario/inquilino paga entrambe le quote
+                percentuale = percentuale_proprietario + percentuale_inquilino
+            elif persona['tipo_persona'] == 'proprietario':
+                percentuale = percentuale_proprietario
+            else:  # inquilino
+                percentuale = percentuale_inquilino
+
+        # Ripartizione intra-ruolo: se ci sono più persone dello stesso ruolo nella stessa unità,
+        # divide la quota tra loro in parti uguali (escluso il caso 'proprietario_inquilino' che già paga il 100%).
+        quota_divisore = profilo.divisore(persona['unita_id'], persona['tipo_persona'])
+
+        persone_ids.append(persona['persona_id'])
+        quote.append((persona['millesimi'], percentuale, quota_divisore))
+
+    return dict(zip(persone_ids, ripartisci(importo, quote)))
+
+def get_dati_ripartizione(condominio_id, data_version):
+    """Persone e millesimi del condominio per i calcoli in memoria.
+
+    Ritorna {'persone': [dict], 'unita_ids': frozenset,
+    'millesimi': {tabella: {unita_id: valore}}, 'profilo': ProfiloRuoli}.
+    Il risultato è condiviso tra le richieste (non va modificato) e resta valido
+    finché la versione dati del condominio non cambia.
+    """
+    from database_universal import get_db, begin_read_snapshot
+
+    with _dati_ripartizione_lock:
+        voce = _dati_ripartizione_cache.get(condominio_id)
+        if voce and voce[0] == data_version:
+            _dati_ripartizione_cache.move_to_end(condominio_id)
+            return voce[1]
+
+    conn = get_db()
+    try:
+        begin_read_snapshot(conn)
+        cursor = conn.cursor()
+        exec_sql(cursor, """
+            SELECT p.id as persona_id, p.nome, p.cognome, p.tipo_persona,
+                   ui.id as unita_id, ui.numero_unita
+            FROM persone p
+            JOIN unita_immobiliari ui ON p.unita_id = ui.id
+            WHERE p.condominio_id = ?
+            ORDER BY ui.numero_unita, p.id
+        """, (condominio_id,))
+        persone = [dict(row) for row in cursor.fetchall()]
+
+        exec_sql(cursor, "SELECT id FROM unita_immobiliari WHERE condominio_id = ?", (condominio_id,))
+        unita_ids = frozenset(row['id'] for row in cursor.fetchall())
+
+        exec_sql(cursor, """
+            SELECT tabella, unita_id, valore FROM millesimi
+            WHERE condominio_id = ?
+        """, (condominio_id,))
+        millesimi = {}
+        for row in cursor.fetchall():
+            millesimi.setdefault(row['tabella'], {})[row['unita_id']] = row['valore']
+    finally:
+        conn.close()
+
+    dati = {'persone': persone, 'unita_ids': unita_ids, 'millesimi': millesimi,
+            'profilo': ProfiloRuoli(persone)}
+    with _dati_ripartizione_lock:
+        _dati_ripartizione_cache[condominio_id] = (data_version, dati)
+        _dati_ripartizione_cache.move_to_end(condominio_id)
+        while len(_dati_ripartizione_cache) > SIMULAZIONE_CACHE_SIZE:
+            _dati_ripartizione_cache.popitem(last=False)
+    return dati
+
+def validate_simulazione_data(data, unita_ids):
+    """Valida bozza di spese preventivate e override millesimi per la simulazione"""
+    errors = []
+
+    spese = data.get('spese')
+    if not isinstance(spese, list) or not spese:
+        errors.append('Lista spese obbligatoria')
+    else:
+        for i, spesa in enumerate(spese, start=1):
+            if not isinstance(spesa, dict):
+                errors.append(f'Spesa {i}: formato non valido')
+                continue
+            errors.extend(f'Spesa {i}: {e}' for e in validate_spesa_data(spesa))
+
+    override = data.get('millesimi') or {}
+    if not isinstance(override, dict):
+        errors.append('Override millesimi non valido')
+        return errors
+    for tabella, valori in override.items():
+        if tabella not in ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'L']:
+            errors.append(f'Tabella millesimi non valida: {tabella}')
+            continue
+        if not isinstance(valori, dict):
+            errors.append(f'Tabella {tabella}: millesimi non validi')
+            continue
+        for unita_id, valore in valori.items():
+            if not str(unita_id).isdigit() or int(unita_id) not in unita_ids:
+                errors.append(f'Tabella {tabella}: unità {unita_id} non trovata')
+            elif isinstance(valore, bool) or not isinstance(valore, (int, float)) or valore < 0 or valore > 1000:
+                errors.append(f'Tabella {tabella}: millesimi unità {unita_id} devono essere tra 0 e 1000')
+
+    return errors
+
+def simula_ripartizione_preventivo(dati, spese, millesimi_override=None):
+    """Ripartizione di una bozza di spese preventivate calcolata solo in memoria.
+
+    `dati` è il risultato di get_dati_ripartizione, `spese` una lista di dict
+    (formato di validate_spesa_data), `millesimi_override` un dict
+    {tabella: {unita_id: valore}} che sostituisce i millesimi delle unità indicate.
+    Nessuna scrittura sul database.
+    """
+    persone = dati['persone']
+    millesimi = dict(dati['millesimi'])
+    for tabella, valori in (millesimi_override or {}).items():
+        millesimi[tabella] = {**millesimi.get(tabella, {}), **{int(uid): v for uid, v in valori.items()}}
+
+    per_persona = {p['persona_id']: {} for p in persone}
+    tabelle = {}
+    dettaglio_spese = []
+
+    # Persone con millesimi per tabella, calcolate una volta sola
+    per_tabella = {}
+    for spesa in spese:
+        tabella = spesa['tabella_millesimi']
+        if tabella not in per_tabella:
+            valori = millesimi.get(tabella, {})
+            per_tabella[tabella] = [dict(p, millesimi=valori.get(p['unita_id'])) for p in persone]
+        persone_con_millesimi = per_tabella[tabella]
+
+        quote = ripartisci_spesa(spesa['importo'], spesa['logica_pi'],
+                                 spesa.get('percentuale_proprietario', 100), spesa.get('percentuale_inquilino', 0),
+                                 persone_con_millesimi, dati['profilo'])
+        for persona_id, centesimi in quote.items():
+            per_persona[persona_id][tabella] = per_persona[persona_id].get(tabella, 0) + centesimi
+
+        ripartito = sum(quote.values())
+        voce = tabelle.setdefault(tabella, {'tabella': tabella, 'numero_spese': 0, 'previsto': 0, 'ripartito': 0})
+        voce['numero_spese'] += 1
+        voce['previsto'] += to_cents(spesa['importo'])
+        voce['ripartito'] += ripartito
+        dettaglio_spese.append({
+            'descrizione': spesa['descrizione'],
+            'tabella_millesimi': tabella,
+            'importo': from_cents(to_cents(spesa['importo'])),
+            'importo_ripartito': from_cents(ripartito)
+        })
+
+    ripartizione = []
+    for p in persone:
+        quote_tabelle = per_persona[p['persona_id']]
+        ripartizione.append({
+            'persona_id': p['persona_id'],
+            'nome': p['nome'],
+            'cognome': p['cognome'],
+            'tipo_persona': p['tipo_persona'],
+            'numero_unita': p['numero_unita'],
+            'importo_dovuto': from_cents(sum(quote_tabelle.values())),
+            'per_tabella': {t: from_cents(c) for t, c in sorted(quote_tabelle.items())}
+        })
+
+    riepilogo_tabelle = [
+        {**voce, 'previsto': from_cents(voce['previsto']), 'ripartito': from_cents(voce['ripartito'])}
+        for _, voce in sorted(tabelle.items())
+    ]
+
+    return {
+        'ripartizione': ripartizione,
+        'tabelle': riepilogo_tabelle,
+        'spese': dettaglio_spese,
+        'totale': from_cents(sum(to_cents(s['importo']) for s in spese)),
+        'totale_ripartito': from_cents(sum(v['ripartito'] for v in tabelle.values()))
+    }
+
 def calculate_ripartizione_completa(condominio_id):
     """Calcola la ripartizione completa per un condominio"""
     from models import Spesa, Persona
-    from database_universal import get_db
+    from database_universal import get_db, exec_many
+    from ripartizione_parallela import dati_spesa, dati_persona, ripartisci_per_tabella
 
     conn = get_db()
     cursor = conn.cursor()
@@ -226,185 +707,222 @@ def calculate_ripartizione_completa(condominio_id):
     spese = Spesa.get_by_condominio(condominio_id)
     persone = Persona.get_by_condominio(condominio_id)
 
-    # Calcola ripartizione per ogni spesa
+    # Calcola ripartizione per ogni spesa (in centesimi)
     ripartizione_totale = {persona.id: 0 for persona in persone}
+    anno_corrente = datetime.now().year
 
-    for spesa in spese:
-        # Calcola ripartizione per questa spesa
-        exec_sql(cursor, """
-            SELECT p.id as persona_id, p.nome, p.cognome, p.tipo_persona,
-                   ui.id as unita_id, ui.numero_unita, m.valore as millesimi
-            FROM persone p
-            JOIN unita_immobiliari ui ON p.unita_id = ui.id
-            LEFT JOIN millesimi m ON ui.id = m.unita_id AND m.tabella = ?
-            WHERE p.condominio_id = ?
-            ORDER BY ui.numero_unita
-        """, (spesa.tabella_millesimi, condominio_id))
-
-        persone_con_millesimi = cursor.fetchall()
+    # Ruoli per unità (per dividere correttamente tra più persone dello stesso ruolo)
+    profilo = get_profilo_ruoli(cursor, condominio_id)
 
-        # Precalcola presenza ruoli e conteggi per unitÃ  (per dividere correttamente tra piÃ¹ persone dello stesso ruolo)
-        unita_ruoli = {}
-        ruolo_counts = {}
-        for p in persone_con_millesimi:
-            if not p['millesimi']:
-                continue
-            uid = p['unita_id']
-            unita_ruoli.setdefault(uid, set())
-            ruolo_counts.setdefault(uid, {'proprietario': 0, 'inquilino': 0, 'both': 0})
-            if p['tipo_persona'] == 'proprietario_inquilino':
-                unita_ruoli[uid].update({'proprietario', 'inquilino'})
-                ruolo_counts[uid]['both'] += 1
-            elif p['tipo_persona'] in ('proprietario', 'inquilino'):
-                unita_ruoli[uid].add(p['tipo_persona'])
-                ruolo_counts[uid][p['tipo_persona']] += 1
-
-        for persona in persone_con_millesimi:
-            if not persona['millesimi']:
-                continue  # Salta persone senza millesimi per questa tabella
-
-            # Calcola percentuale in base alla logica P/I
-            if spesa.logica_pi == 'proprietario':
-                if persona['tipo_persona'] in ['proprietario', 'proprietario_inquilino']:
-                    percentuale = 100
-                else:
-                    percentuale = 0
-            elif spesa.logica_pi == 'inquilino':
-                if persona['tipo_persona'] in ['inquilino', 'proprietario_inquilino']:
-                    percentuale = 100
-                else:
-                    percentuale = 0
-            elif spesa.logica_pi == '50/50':
-                # Se Ã¨ una persona che ricopre entrambi i ruoli, paga il 100%
-                if persona['tipo_persona'] == 'proprietario_inquilino':
-                    percentuale = 100
-                else:
-                    # Se nell'unitÃ  sono presenti entrambi i ruoli, paga il 50%
-                    ruoli_presenti = unita_ruoli.get(persona['unita_id'], set())
-                    if 'proprietario' in ruoli_presenti and 'inquilino' in ruoli_presenti:
-                        percentuale = 50
-                    else:
-                        # Se manca il contro-ruolo, il presente copre il 100%
-                        percentuale = 100
-            else:  # personalizzato
-                if persona['tipo_persona'] == 'proprietario_inquilino':
-                    # Per P/I, il proprietario/inquilino paga entrambe le quote
-                    percentuale = spesa.percentuale_proprietario + spesa.percentuale_inquilino
-                elif persona['tipo_persona'] == 'proprietario':
-                    percentuale = spesa.percentuale_proprietario
-                else:  # inquilino
-                    percentuale = spesa.percentuale_inquilino
-
-            # Ripartizione intra-ruolo: se ci sono piÃ¹ persone dello stesso ruolo nella stessa unitÃ ,
-            # divide la quota tra loro in parti uguali (escluso il caso 'proprietario_inquilino' che giÃ  paga il 100%).
-            quota_divisore = 1
-            uid = persona['unita_id']
-            if persona['tipo_persona'] == 'proprietario':
-                quota_divisore = max(1, ruolo_counts.get(uid, {}).get('proprietario', 1))
-            elif persona['tipo_persona'] == 'inquilino':
-                quota_divisore = max(1, ruolo_counts.get(uid, {}).get('inquilino', 1))
-
-            # Calcola importo dovuto
-            importo_dovuto = (spesa.importo * persona['millesimi'] * (percentuale / 100)) / 1000
-            importo_dovuto = importo_dovuto / quota_divisore
-
-            # Salva in database
+    # Spese raggruppate per tabella, con persone e millesimi della tabella (una query per tabella)
+    lavori = {}
+    for spesa in spese:
+        if spesa.tabella_millesimi not in lavori:
             exec_sql(cursor, """
-                INSERT INTO ripartizione_spese
-                (condominio_id, persona_id, spesa_id, importo_dovuto, anno)
-                VALUES (?, ?, ?, ?, ?)
-            """, (condominio_id, persona['persona_id'], spesa.id, importo_dovuto, datetime.now().year))
+                SELECT p.id as persona_id, p.nome, p.cognome, p.tipo_persona,
+                       ui.id as unita_id, ui.numero_unita, m.valore as millesimi
+                FROM persone p
+                JOIN unita_immobiliari ui ON p.unita_id = ui.id
+                LEFT JOIN millesimi m ON ui.id = m.unita_id AND m.tabella = ?
+                WHERE p.condominio_id = ?
+                ORDER BY ui.numero_unita
+            """, (spesa.tabella_millesimi, condominio_id))
+            lavori[spesa.tabella_millesimi] = ([], [dati_persona(row) for row in cursor.fetchall()])
+        lavori[spesa.tabella_millesimi][0].append(dati_spesa(
+            spesa.id, spesa.importo, spesa.logica_pi, spesa.percentuale_proprietario, spesa.percentuale_inquilino))
 
-            # Aggiungi al totale
-            ripartizione_totale[persona['persona_id']] += importo_dovuto
+    # Quote di ogni spesa, calcolate per tabella (su più processi se il calcolo è grande)
+    quote_spese = ripartisci_per_tabella(lavori, profilo)
 
+    # Righe salvate nell'ordine delle spese, come nel calcolo spesa per spesa
+    righe = []
+    for spesa in spese:
+        for persona_id, centesimi in quote_spese[spesa.id].items():
+            righe.append((condominio_id, persona_id, spesa.id, from_cents(centesimi), anno_corrente))
+            ripartizione_totale[persona_id] += centesimi
+
+    exec_many(cursor, """
+        INSERT INTO ripartizione_spese
+        (condominio_id, persona_id, spesa_id, importo_dovuto, anno)
+        VALUES (?, ?, ?, ?, ?)
+    """, righe)
     conn.commit()
     conn.close()
 
-    return ripartizione_totale
+    return {persona_id: from_cents(c) for persona_id, c in ripartizione_totale.items()}
 
-def export_condominio_json(condominio_id):
-    """Esporta tutti i dati di un condominio in formato JSON"""
-    from models import Condominio, UnitaImmobiliare, Persona, Spesa, Millesemo, PreventivoAnnuale
+def ripartisci_spese_non_ripartite(condominio_id):
+    """Aggiunge a ripartizione_spese le quote delle spese che non ne hanno ancora.
 
-    # Ottieni condominio
-    condominio = Condominio.find_by_id(condominio_id)
-    if not condominio:
-        return None
+    Aggiornamento incrementale (es. dopo un import massivo): le spese già
+    ripartite non vengono ricalcolate. Ritorna il numero di spese elaborate.
+    """
+    from database_universal import get_db, exec_many
 
-    # Ottieni tutti i dati
-    unita = UnitaImmobiliare.get_by_condominio(condominio_id)
-    persone = Persona.get_by_condominio(condominio_id)
-    spese = Spesa.get_by_condominio(condominio_id)
-    preventivi = PreventivoAnnuale.get_by_condominio(condominio_id)
+    conn = get_db()
+    cursor = conn.cursor()
+    exec_sql(cursor, """
+        SELECT s.id, s.importo, s.tabella_millesimi, s.logica_pi,
+               s.percentuale_proprietario, s.percentuale_inquilino
+        FROM spese s
+        WHERE s.condominio_id = ?
+          AND NOT EXISTS (SELECT 1 FROM ripartizione_spese rs WHERE rs.spesa_id = s.id)
+        ORDER BY s.id
+    """, (condominio_id,))
+    spese = cursor.fetchall()
+    if not spese:
+        conn.close()
+        return 0
+
+    exec_sql(cursor, """
+        SELECT p.id as persona_id, p.tipo_persona, ui.id as unita_id
+        FROM persone p
+        JOIN unita_immobiliari ui ON p.unita_id = ui.id
+        WHERE p.condominio_id = ?
+        ORDER BY ui.numero_unita, p.id
+    """, (condominio_id,))
+    persone = [dict(row) for row in cursor.fetchall()]
+
+    exec_sql(cursor, """
+        SELECT tabella, unita_id, valore FROM millesimi
+        WHERE condominio_id = ?
+    """, (condominio_id,))
+    millesimi_map = {(row['tabella'], row['unita_id']): row['valore'] for row in cursor.fetchall()}
 
-    # Ottieni millesimi per tutte le tabelle
-    millesimi_completi = {}
-    for tabella in ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'L']:
-        millesimi_completi[tabella] = Millesemo.get_by_condominio_tabella(condominio_id, tabella)
+    anno_corrente = datetime.now().year
+    profilo = get_profilo_ruoli(cursor, condominio_id)
+    per_tabella = {}
+    righe = []
+    for spesa in spese:
+        tabella = spesa['tabella_millesimi']
+        if tabella not in per_tabella:
+            per_tabella[tabella] = [dict(p, millesimi=millesimi_map.get((tabella, p['unita_id']))) for p in persone]
+        persone_con_millesimi = per_tabella[tabella]
+
+        quote = ripartisci_spesa(spesa['importo'], spesa['logica_pi'], spesa['percentuale_proprietario'],
+                                 spesa['percentuale_inquilino'], persone_con_millesimi, profilo)
+        righe.extend((condominio_id, persona_id, spesa['id'], from_cents(centesimi), anno_corrente)
+                     for persona_id, centesimi in quote.items())
+
+    exec_many(cursor, """
+        INSERT INTO ripartizione_spese
+        (condominio_id, persona_id, spesa_id, importo_dovuto, anno)
+        VALUES (?, ?, ?, ?, ?)
+    """, righe)
+    conn.commit()
+    conn.close()
+    return len(spese)
+
+def _json_valore(valore, livello):
+    """Valore JSON indentato (indent=2) come se fosse annidato a `livello`"""
+    return json.dumps(valore, indent=2, ensure_ascii=False, default=json_default).replace('\n', '\n' + '  ' * livello)
+
+def _json_lista(elementi, livello):
+    """Genera una lista JSON un elemento alla volta (stesso formato di json.dumps)"""
+    yield '['
+    vuota = True
+    for elemento in elementi:
+        yield ('\n' if vuota else ',\n') + '  ' * (livello + 1) + _json_valore(elemento, livello + 1)
+        vuota = False
+    yield ']' if vuota else '\n' + '  ' * livello + ']'
+
+def genera_export_condominio_json(condominio_id):
+    """Esporta tutti i dati di un condominio in formato JSON, a pezzi.
+
+    Generatore di stringhe la cui concatenazione è il documento JSON. Le spese
+    sono lette con iter_rows e serializzate una alla volta, quindi la memoria
+    non cresce con il numero di spese. Tutte le letture avvengono nello stesso
+    snapshot. Non genera nulla se il condominio non esiste.
+    """
+    from models import Condominio, UnitaImmobiliare, Persona, Millesemo, PreventivoAnnuale
+    from database_universal import get_read_db, begin_read_snapshot, iter_rows
 
-    # Crea struttura JSON
-    export_data = {
-        'condominio': {
+    conn = get_read_db()
+    try:
+        begin_read_snapshot(conn)
+        condominio = Condominio.find_by_id(condominio_id, conn=conn)
+        if not condominio:
+            return
+
+        unita = UnitaImmobiliare.get_by_condominio(condominio_id, conn=conn)
+        persone = Persona.get_by_condominio(condominio_id, conn=conn)
+        millesimi_completi = Millesemo.get_by_condominio(condominio_id, conn=conn)
+        preventivi = PreventivoAnnuale.get_by_condominio(condominio_id, conn=conn)
+
+        spese = iter_rows(conn, """
+            SELECT id, descrizione, importo, tabella_millesimi, logica_pi,
+                   percentuale_proprietario, percentuale_inquilino, created_at
+            FROM spese
+            WHERE condominio_id = ?
+            ORDER BY data_spesa DESC, created_at DESC
+        """, (condominio_id,))
+
+        yield '{\n  "condominio": '
+        yield _json_valore({
             'id': condominio.id,
             'nome': condominio.nome,
             'indirizzo': condominio.indirizzo,
             'num_unita': condominio.num_unita,
             'created_at': condominio.created_at
-        },
-        'unita_immobiliari': [
-            {
-                'id': u.id,
-                'numero_unita': u.numero_unita
-            } for u in unita
-        ],
-        'persone': [
-            {
-                'id': p.id,
-                'nome': p.nome,
-                'cognome': p.cognome,
-                'email': p.email,
-                'tipo_persona': p.tipo_persona,
-                'unita_id': p.unita_id
-            } for p in persone
-        ],
-        'spese': [
-            {
-                'id': s.id,
-                'descrizione': s.descrizione,
-                'importo': s.importo,
-                'tabella_millesimi': s.tabella_millesimi,
-                'logica_pi': s.logica_pi,
-                'percentuale_proprietario': s.percentuale_proprietario,
-                'percentuale_inquilino': s.percentuale_inquilino,
-                'created_at': s.created_at
-            } for s in spese
-        ],
-        'millesimi': {
-            tabella: [
-                {
-                    'id': m.id,
-                    'unita_id': m.unita_id,
-                    'valore': m.valore
-                } for m in millesimi_list
-            ] for tabella, millesimi_list in millesimi_completi.items()
-        },
-        'preventivi_annuali': [
-            {
-                'id': p.id,
-                'anno': p.anno,
-                'importo_totale_preventivato': p.importo_totale_preventivato,
-                'importo_totale_speso': p.importo_totale_speso,
-                'note': p.note,
-                'created_at': p.created_at,
-                'updated_at': p.updated_at
-            } for p in preventivi
-        ],
-        'export_date': datetime.now().isoformat(),
-        'version': '1.0'
-    }
+        }, 1)
+
+        yield ',\n  "unita_immobiliari": '
+        yield from _json_lista(({
+            'id': u.id,
+            'numero_unita': u.numero_unita
+        } for u in unita), 1)
+
+        yield ',\n  "persone": '
+        yield from _json_lista(({
+            'id': p.id,
+            'nome': p.nome,
+            'cognome': p.cognome,
+            'email': p.email,
+            'tipo_persona': p.tipo_persona,
+            'unita_id': p.unita_id
+        } for p in persone), 1)
+
+        yield ',\n  "spese": '
+        yield from _json_lista(({
+            'id': s['id'],
+            'descrizione': s['descrizione'],
+            'importo': s['importo'],
+            'tabella_millesimi': s['tabella_millesimi'],
+            'logica_pi': s['logica_pi'],
+            'percentuale_proprietario': s['percentuale_proprietario'],
+            'percentuale_inquilino': s['percentuale_inquilino'],
+            'created_at': s['created_at']
+        } for s in spese), 1)
+
+        yield ',\n  "millesimi": {'
+        for i, tabella in enumerate(['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'L']):
+            yield (',' if i else '') + f'\n    "{tabella}": '
+            yield from _json_lista(({
+                'id': m.id,
+                'unita_id': m.unita_id,
+                'valore': m.valore
+            } for m in millesimi_completi.get(tabella, [])), 2)
+        yield '\n  }'
+
+        yield ',\n  "preventivi_annuali": '
+        yield from _json_lista(({
+            'id': p.id,
+            'anno': p.anno,
+            'importo_totale_preventivato': p.importo_totale_preventivato,
+            'importo_totale_speso': p.importo_totale_speso,
+            'note': p.note,
+            'created_at': p.created_at,
+            'updated_at': p.updated_at
+        } for p in preventivi), 1)
+
+        yield ',\n  "export_date": ' + json.dumps(datetime.now().isoformat())
+        yield ',\n  "version": "1.0"\n}'
+    finally:
+        conn.close()
 
-    return json.dumps(export_data, indent=2, ensure_ascii=False)
+def export_condominio_json(condominio_id):
+    """Esporta tutti i dati di un condominio in formato JSON"""
+    return ''.join(genera_export_condominio_json(condominio_id)) or None
 
 def format_currency(amount):
     """Formatta importo in Euro"""
@@ -412,17 +930,17 @@ def format_currency(amount):
 def generate_preventivo_anno(condominio_id, anno):
     """Genera preventivo per un anno basandosi sulle spese attuali"""
     from models import Spesa, Persona, PreventivoAnnuale
-    from database_universal import get_db
+    from database_universal import get_db, sql_anno
 
     try:
         conn = get_db()
         cursor = conn.cursor()
 
         # Ottieni tutte le spese dell'anno corrente
-        exec_sql(cursor, """
+        exec_sql(cursor, f"""
             SELECT * FROM spese
-            WHERE condominio_id = ? AND strftime('%Y', created_at) = ?
-        """, (condominio_id, str(datetime.now().year)))
+            WHERE condominio_id = ? AND {sql_anno('created_at')} = ?
+        """, (condominio_id, datetime.now().year))
 
         spese_anno_corrente = cursor.fetchall()
         totale_spese = sum(spesa['importo'] for spesa in spese_anno_corrente)
@@ -469,27 +987,25 @@ def generate_preventivo_anno(condominio_id, anno):
 
 def calculate_ripartizione_preventivo(condominio_id, anno, tabella_filter=None):
     """Calcola la ripartizione basata sulle spese preventivate per un anno"""
-    from models import SpesaPreventivata, Persona, PreventivoAnnuale, RipartizionePreventivo
+    from models import SpesaPreventivata, Persona, PreventivoAnnuale, RipartizionePreventivo, Condominio
     from database_universal import get_db
 
     try:
         conn = get_db()
         cursor = conn.cursor()
 
+        # Versione dati letta prima degli input: se cambiano durante il calcolo,
+        # la versione salvata resta vecchia e il calcolo successivo riscrive
+        condominio = Condominio.find_by_id(condominio_id)
+        data_version = condominio.data_version if condominio else None
+
         # Trova preventivo per l'anno
-        preventivi = PreventivoAnnuale.get_by_condominio(condominio_id)
-        preventivo = None
-        for p in preventivi:
-            if p.anno == anno:
-                preventivo = p
-                break
+        preventivo = PreventivoAnnuale.find_by_condominio_anno(condominio_id, anno, data_version)
 
         if not preventivo:
+            conn.close()
             return {'ripartizione': [], 'totale_previsto': 0}
 
-        # Pulisci ripartizioni preventivo esistenti
-        RipartizionePreventivo.delete_by_preventivo(preventivo.id)
-
         # Ottieni spese preventivate per il preventivo
         spese = SpesaPreventivata.get_by_preventivo(preventivo.id)
         if tabella_filter:
@@ -497,101 +1013,50 @@ def calculate_ripartizione_preventivo(condominio_id, anno, tabella_filter=None):
         persone = Persona.get_by_condominio(condominio_id)
 
         if not spese or not persone:
+            if not tabella_filter:
+                RipartizionePreventivo.replace_for_preventivo(condominio_id, preventivo.id, anno, {}, data_version)
             conn.close()
             return {'ripartizione': [], 'totale_previsto': 0}
 
-        # Calcola ripartizione per ogni spesa preventivata
+        # Calcola ripartizione per ogni spesa preventivata (in centesimi)
         ripartizione_totale = {persona.id: 0 for persona in persone}
 
-        for spesa in spese:
-            # Calcola ripartizione per questa spesa preventivata
-            exec_sql(cursor, """
-                SELECT p.id as persona_id, p.nome, p.cognome, p.tipo_persona,
-                       ui.id as unita_id, ui.numero_unita, m.valore as millesimi
-                FROM persone p
-                JOIN unita_immobiliari ui ON p.unita_id = ui.id
-                LEFT JOIN millesimi m ON ui.id = m.unita_id AND m.tabella = ?
-                WHERE p.condominio_id = ?
-                ORDER BY ui.numero_unita
-            """, (spesa.tabella_millesimi, condominio_id))
-
-            persone_con_millesimi = cursor.fetchall()
+        # Ruoli per unità (per suddividere correttamente quote intra-ruolo)
+        profilo = get_profilo_ruoli(cursor, condominio_id)
+        per_tabella = {}
 
-            # Precalcola presenza ruoli e conteggi per unitÃ  (per suddividere correttamente quote intra-ruolo)
-            unita_ruoli = {}
-            ruolo_counts = {}
-            for p in persone_con_millesimi:
-                if not p['millesimi']:
-                    continue
-                uid = p['unita_id']
-                unita_ruoli.setdefault(uid, set())
-                ruolo_counts.setdefault(uid, {'proprietario': 0, 'inquilino': 0, 'both': 0})
-                if p['tipo_persona'] == 'proprietario_inquilino':
-                    unita_ruoli[uid].update({'proprietario', 'inquilino'})
-                    ruolo_counts[uid]['both'] += 1
-                elif p['tipo_persona'] in ('proprietario', 'inquilino'):
-                    unita_ruoli[uid].add(p['tipo_persona'])
-                    ruolo_counts[uid][p['tipo_persona']] += 1
-
-            for persona in persone_con_millesimi:
-                if not persona['millesimi']:
-                    continue  # Salta persone senza millesimi per questa tabella
-
-                # Calcola percentuale in base alla logica P/I
-                if spesa.logica_pi == 'proprietario':
-                    if persona['tipo_persona'] in ['proprietario', 'proprietario_inquilino']:
-                        percentuale = 100
-                    else:
-                        percentuale = 0
-                elif spesa.logica_pi == 'inquilino':
-                    if persona['tipo_persona'] in ['inquilino', 'proprietario_inquilino']:
-                        percentuale = 100
-                    else:
-                        percentuale = 0
-                elif spesa.logica_pi == '50/50':
-                    if persona['tipo_persona'] == 'proprietario_inquilino':
-                        percentuale = 100
-                    else:
-                        ruoli_presenti = unita_ruoli.get(persona['unita_id'], set())
-                        if 'proprietario' in ruoli_presenti and 'inquilino' in ruoli_presenti:
-                            percentuale = 50
-                        else:
-                            percentuale = 100
-                else:  # personalizzato
-                    if persona['tipo_persona'] == 'proprietario_inquilino':
-                        # Per P/I, il proprietario/inquilino paga entrambe le quote
-                        percentuale = spesa.percentuale_proprietario + spesa.percentuale_inquilino
-                    elif persona['tipo_persona'] == 'proprietario':
-                        percentuale = spesa.percentuale_proprietario
-                    else:  # inquilino
-                        percentuale = spesa.percentuale_inquilino
-
-                # Divisione intra-ruolo tra piÃ¹ persone della stessa unitÃ 
-                quota_divisore = 1
-                uid = persona['unita_id']
-                if persona['tipo_persona'] == 'proprietario':
-                    quota_divisore = max(1, ruolo_counts.get(uid, {}).get('proprietario', 1))
-                elif persona['tipo_persona'] == 'inquilino':
-                    quota_divisore = max(1, ruolo_counts.get(uid, {}).get('inquilino', 1))
-
-                # Calcola importo dovuto
-                importo_dovuto = (spesa.importo_previsto * persona['millesimi'] * (percentuale / 100)) / 1000
-                importo_dovuto = importo_dovuto / quota_divisore
-
-                # Accumula sul totale per persona (persistiamo dopo aver sommato tutte le spese)
-                ripartizione_totale[persona['persona_id']] += importo_dovuto
-
-        # Persisti una sola riga per persona (vincolo UNIQUE sul pair preventivo_id/persona_id)
-        for persona in persone:
-            totale_persona = ripartizione_totale.get(persona.id, 0)
-            rip = RipartizionePreventivo(
-                condominio_id=condominio_id,
-                preventivo_id=preventivo.id,
-                persona_id=persona.id,
-                importo_previsto_dovuto=totale_persona,
-                anno=anno
+        for spesa in spese:
+            # Persone con i millesimi della tabella, lette una volta per tabella
+            if spesa.tabella_millesimi not in per_tabella:
+                exec_sql(cursor, """
+                    SELECT p.id as persona_id, p.nome, p.cognome, p.tipo_persona,
+                           ui.id as unita_id, ui.numero_unita, m.valore as millesimi
+                    FROM persone p
+                    JOIN unita_immobiliari ui ON p.unita_id = ui.id
+                    LEFT JOIN millesimi m ON ui.id = m.unita_id AND m.tabella = ?
+                    WHERE p.condominio_id = ?
+                    ORDER BY ui.numero_unita
+                """, (spesa.tabella_millesimi, condominio_id))
+                per_tabella[spesa.tabella_millesimi] = cursor.fetchall()
+            persone_con_millesimi = per_tabella[spesa.tabella_millesimi]
+
+            quote = ripartisci_spesa(spesa.importo_previsto, spesa.logica_pi, spesa.percentuale_proprietario,
+                                     spesa.percentuale_inquilino, persone_con_millesimi, profilo)
+
+            # Accumula sul totale per persona (persistiamo dopo aver sommato tutte le spese)
+            for persona_id, centesimi in quote.items():
+                ripartizione_totale[persona_id] += centesimi
+
+        ripartizione_totale = {persona_id: from_cents(c) for persona_id, c in ripartizione_totale.items()}
+
+        # Persisti una sola riga per persona (vincolo UNIQUE sul pair preventivo_id/persona_id),
+        # solo per il calcolo completo e solo se i dati sono cambiati dall'ultima scrittura
+        if not tabella_filter:
+            RipartizionePreventivo.replace_for_preventivo(
+                condominio_id, preventivo.id, anno,
+                {persona.id: ripartizione_totale.get(persona.id, 0) for persona in persone},
+                data_version
             )
-            rip.save()
 
         conn.close()
 
@@ -608,7 +1073,7 @@ def calculate_ripartizione_preventivo(condominio_id, anno, tabella_filter=None):
 
         return {
             'ripartizione': risultato,
-            'totale_previsto': sum(ripartizione_totale.values())
+            'totale_previsto': somma(ripartizione_totale.values())
         }
 
     except Exception as e:
@@ -621,6 +1086,172 @@ def calculate_ripartizione_preventivo(condominio_id, anno, tabella_filter=None):
             pass
         raise e
 
+def calcolo_analytics_spese(condominio_id, anno_da, anno_a, data_version=None):
+    """Andamento delle spese negli anni indicati e confronto con i preventivi.
+
+    Gli aggregati (anno x mese x tabella x logica P/I) sono calcolati nel
+    database; qui si compongono solo i riepiloghi per anno e i delta
+    preventivo/consuntivo.
+    """
+    from models import SpeseRollup, SpesaPreventivata
+
+    serie = SpeseRollup.get_aggregati(condominio_id, anno_da, anno_a,
+                                      data_version if ANALYTICS_ROLLUP else None)
+    previsti = SpesaPreventivata.get_totali_per_anno(condominio_id, anno_da, anno_a)
+
+    per_anno = {anno: {'anno': anno, 'numero_spese': 0, 'totale': 0, 'per_tabella': {}}
+                for anno in range(anno_da, anno_a + 1)}
+    speso = {}
+    for riga in serie:
+        riga['totale'] = from_cents(to_cents(riga['totale']))
+        voce = per_anno[riga['anno']]
+        voce['numero_spese'] += riga['numero_spese']
+        voce['totale'] += to_cents(riga['totale'])
+        tabella = riga['tabella_millesimi']
+        voce['per_tabella'][tabella] = voce['per_tabella'].get(tabella, 0) + to_cents(riga['totale'])
+        speso[(riga['anno'], tabella)] = speso.get((riga['anno'], tabella), 0) + to_cents(riga['totale'])
+
+    for voce in per_anno.values():
+        voce['totale'] = from_cents(voce['totale'])
+        voce['per_tabella'] = {t: from_cents(c) for t, c in sorted(voce['per_tabella'].items())}
+
+    # Preventivo vs consuntivo per anno e tabella (solo dove c'è almeno uno dei due)
+    previsto = {(riga['anno'], riga['tabella_millesimi']): to_cents(riga['totale']) for riga in previsti}
+    confronto = []
+    for anno, tabella in sorted(set(previsto) | set(speso)):
+        p = previsto.get((anno, tabella), 0)
+        e = speso.get((anno, tabella), 0)
+        confronto.append({
+            'anno': anno,
+            'tabella_millesimi': tabella,
+            'previsto': from_cents(p),
+            'speso': from_cents(e),
+            'delta': from_cents(e - p),
+            'delta_percentuale': round((e - p) * 100 / p, 2) if p else None
+        })
+
+    return {
+        'anno_da': anno_da,
+        'anno_a': anno_a,
+        'serie': serie,
+        'per_anno': list(per_anno.values()),
+        'preventivo_vs_consuntivo': confronto
+    }
+
+def calcolo_portfolio(user_id, condominii, anno_da, anno_a):
+    """Riepilogo di tutti i condominii di un utente con query raggruppate.
+
+    Per ogni condominio: spese per anno con confronto preventivo, stato dei
+    millesimi e numero di persone. Quattro query aggregate (su tutti i
+    condominii insieme) lette da una vista consistente del database.
+    """
+    from database_universal import get_read_db, begin_read_snapshot, sql_anno
+
+    conn = get_read_db(*condominii)
+    try:
+        begin_read_snapshot(conn)
+        cursor = conn.cursor()
+
+        exec_sql(cursor, f"""
+            SELECT s.condominio_id, {sql_anno('s.data_spesa')} AS anno,
+                   COUNT(*) AS numero_spese, SUM(s.importo) AS totale
+            FROM spese s
+            JOIN condominii c ON s.condominio_id = c.id
+            WHERE c.user_id = ? AND s.data_spesa >= ? AND s.data_spesa < ?
+            GROUP BY s.condominio_id, anno
+        """, (user_id, f'{anno_da}-01-01', f'{anno_a + 1}-01-01'))
+        spese = cursor.fetchall()
+
+        exec_sql(cursor, """
+            SELECT pa.condominio_id, pa.anno, SUM(sp.importo_previsto) AS totale
+            FROM preventivi_annuali pa
+            JOIN condominii c ON pa.condominio_id = c.id
+            JOIN spese_preventivate sp ON sp.preventivo_id = pa.id
+            WHERE c.user_id = ? AND pa.anno BETWEEN ? AND ?
+            GROUP BY pa.condominio_id, pa.anno
+        """, (user_id, anno_da, anno_a))
+        previsti = cursor.fetchall()
+
+        exec_sql(cursor, """
+            SELECT m.condominio_id, m.tabella, SUM(m.valore) AS totale
+            FROM millesimi m
+            JOIN condominii c ON m.condominio_id = c.id
+            WHERE c.user_id = ?
+            GROUP BY m.condominio_id, m.tabella
+        """, (user_id,))
+        millesimi = cursor.fetchall()
+
+        exec_sql(cursor, """
+            SELECT p.condominio_id, p.tipo_persona, COUNT(*) AS numero
+            FROM persone p
+            JOIN condominii c ON p.condominio_id = c.id
+            WHERE c.user_id = ?
+            GROUP BY p.condominio_id, p.tipo_persona
+        """, (user_id,))
+        persone = cursor.fetchall()
+    finally:
+        conn.close()
+
+    anni = range(anno_da, anno_a + 1)
+    riepiloghi = {}
+    for condo in condominii:
+        riepiloghi[condo.id] = {
+            'id': condo.id,
+            'nome': condo.nome,
+            'indirizzo': condo.indirizzo,
+            'num_unita': condo.num_unita,
+            'persone': {'totale': 0, 'proprietario': 0, 'inquilino': 0, 'proprietario_inquilino': 0},
+            'millesimi': {},
+            'millesimi_validi': False,
+            # Importi in centesimi durante l'accumulo
+            'per_anno': {anno: {'anno': anno, 'numero_spese': 0, 'speso': 0, 'previsto': 0} for anno in anni}
+        }
+
+    for row in spese:
+        voce = riepiloghi.get(row['condominio_id'])
+        anno = voce['per_anno'].get(row['anno']) if voce else None
+        if anno:
+            anno['numero_spese'] = row['numero_spese']
+            anno['speso'] = to_cents(row['totale'])
+    for row in previsti:
+        voce = riepiloghi.get(row['condominio_id'])
+        if voce:
+            voce['per_anno'][row['anno']]['previsto'] = to_cents(row['totale'])
+    for row in millesimi:
+        voce = riepiloghi.get(row['condominio_id'])
+        if voce:
+            voce['millesimi'][row['tabella']] = row['totale'] == 1000 if row['totale'] else False
+    for row in persone:
+        voce = riepiloghi.get(row['condominio_id'])
+        if voce:
+            voce['persone'][row['tipo_persona']] = row['numero']
+            voce['persone']['totale'] += row['numero']
+
+    totali = {anno: {'anno': anno, 'numero_spese': 0, 'speso': 0, 'previsto': 0} for anno in anni}
+    for voce in riepiloghi.values():
+        voce['millesimi_validi'] = bool(voce['millesimi']) and all(voce['millesimi'].values())
+        for anno, dati in voce['per_anno'].items():
+            for chiave in ('numero_spese', 'speso', 'previsto'):
+                totali[anno][chiave] += dati[chiave]
+        voce['per_anno'] = [_anno_portfolio(dati) for dati in voce['per_anno'].values()]
+
+    return {
+        'anno_da': anno_da,
+        'anno_a': anno_a,
+        'condominii': list(riepiloghi.values()),
+        'totali_per_anno': [_anno_portfolio(dati) for dati in totali.values()]
+    }
+
+def _anno_portfolio(dati):
+    """Voce annuale del portfolio: centesimi -> euro con delta speso - previsto"""
+    return {
+        'anno': dati['anno'],
+        'numero_spese': dati['numero_spese'],
+        'speso': from_cents(dati['speso']),
+        'previsto': from_cents(dati['previsto']),
+        'delta': from_cents(dati['speso'] - dati['previsto'])
+    }
+
 def log_error(error_message, context=None):
     """Log degli errori (in produzione potrebbe usare un sistema di logging piÃ¹ robusto)"""
     timestamp = datetime.now().isoformat()
@@ -637,8 +1268,8 @@ def log_error(error_message, context=None):
 
 def calcolo_analisi_anno_successivo(condominio_id, anno_riferimento=None):
     """Calcola analisi preventivi per l'anno successivo basandosi sui preventivi esistenti"""
-    from models import Persona, PreventivoAnnuale, SpesaPreventivata, UnitaImmobiliare
     from database_universal import get_db
+    from ripartizione_parallela import dati_spesa, ripartisci_per_tabella
 
     if anno_riferimento is None:
         anno_riferimento = datetime.now().year
@@ -649,16 +1280,25 @@ def calcolo_analisi_anno_successivo(condominio_id, anno_riferimento=None):
         conn = get_db()
         cursor = conn.cursor()
 
-        # 1. Ottieni persone del condominio con numero unitÃ 
-        persone = Persona.get_by_condominio(condominio_id)
-        unita_immobiliari = UnitaImmobiliare.get_by_condominio(condominio_id)
+        # 1. Persone del condominio con numero unità (una query) e indice per id
+        exec_sql(cursor, """
+            SELECT p.id as persona_id, p.nome, p.cognome, p.tipo_persona,
+                   ui.id as unita_id, ui.numero_unita
+            FROM persone p
+            JOIN unita_immobiliari ui ON p.unita_id = ui.id
+            WHERE p.condominio_id = ?
+            ORDER BY ui.numero_unita, p.id
+        """, (condominio_id,))
+        persone = [dict(row) for row in cursor.fetchall()]
+        persone_per_id = {p['persona_id']: p for p in persone}
+        profilo = get_profilo_ruoli(cursor, condominio_id)
 
-        # Mappa persona_id -> numero_unita
-        persona_unita_map = {}
-        for unita in unita_immobiliari:
-            for persona in persone:
-                if persona.unita_id == unita.id:
-                    persona_unita_map[persona.id] = unita.numero_unita
+        # Millesimi di tutte le tabelle in una sola query: (tabella, unita_id) -> valore
+        exec_sql(cursor, """
+            SELECT tabella, unita_id, valore FROM millesimi
+            WHERE condominio_id = ?
+        """, (condominio_id,))
+        millesimi_map = {(row['tabella'], row['unita_id']): row['valore'] for row in cursor.fetchall()}
 
         # 2. Ottieni spese preventivate per l'anno di riferimento (se esiste)
         exec_sql(cursor, """
@@ -673,19 +1313,12 @@ def calcolo_analisi_anno_successivo(condominio_id, anno_riferimento=None):
         # 3. Se non ci sono spese preventivate per l'anno di riferimento,
         # usa le spese effettive dell'anno corrente come base
         if not spese_preventivate_riferimento:
-            from database_universal import IS_POSTGRES
-            sql_spese = """
+            from database_universal import sql_anno
+            exec_sql(cursor, f"""
                 SELECT * FROM spese
-                WHERE condominio_id = ? AND strftime('%Y', data_spesa) = ?
+                WHERE condominio_id = ? AND {sql_anno('data_spesa')} = ?
                 ORDER BY tabella_millesimi, descrizione
-            """
-            if IS_POSTGRES:
-                sql_spese = """
-                    SELECT * FROM spese
-                    WHERE condominio_id = ? AND EXTRACT(YEAR FROM data_spesa) = ?
-                    ORDER BY tabella_millesimi, descrizione
-                """
-            exec_sql(cursor, sql_spese, (condominio_id, str(anno_riferimento)))
+            """, (condominio_id, anno_riferimento))
 
             spese_effettive = cursor.fetchall()
 
@@ -718,160 +1351,92 @@ def calcolo_analisi_anno_successivo(condominio_id, anno_riferimento=None):
                 'fonte_dati': 'nessun_dato', 'note': 'Nessuna spesa trovata per l\'anno di riferimento' }
 
         # 4. Calcola ripartizione per ogni persona usando le stesse logiche del preventivo
-        analisi_per_persona = []
         analisi_per_tabella = {}
-        totale_generale = 0
-        totale_proprietari = 0
-        totale_inquilini = 0
 
         # Raggruppa spese per tabella
         spese_per_tabella = {}
         for spesa in spese_base:
-            tabella = spesa['tabella_millesimi']
-            if tabella not in spese_per_tabella:
-                spese_per_tabella[tabella] = []
-            spese_per_tabella[tabella].append(spesa)
+            spese_per_tabella.setdefault(spesa['tabella_millesimi'], []).append(spesa)
+
+        # Totali per persona in centesimi, aggregati su tutte le tabelle
+        persona_totale_map = {}
+        totale_generale = 0
+        totale_proprietari = 0
+        totale_inquilini = 0
+
+        # Persone con i millesimi di ogni tabella (dal prefetch) e spese della tabella
+        lavori = {}
+        for tabella, spese_tabella in spese_per_tabella.items():
+            persone_con_millesimi = [
+                dict(p, millesimi=millesimi_map.get((tabella, p['unita_id']))) for p in persone
+            ]
+            lavori[tabella] = ([dati_spesa((tabella, indice), spesa['importo_previsto'], spesa['logica_pi'],
+                                           spesa['percentuale_proprietario'], spesa['percentuale_inquilino'])
+                                for indice, spesa in enumerate(spese_tabella)], persone_con_millesimi)
+
+        # Quote di ogni spesa in centesimi, calcolate per tabella (su più processi se il calcolo è grande)
+        quote_spese = ripartisci_per_tabella(lavori, profilo)
 
         # Calcola per ogni tabella
         for tabella, spese_tabella in spese_per_tabella.items():
-            totale_tabella = sum(spesa['importo_previsto'] for spesa in spese_tabella)
+            totale_tabella = somma(spesa['importo_previsto'] for spesa in spese_tabella)
             analisi_per_tabella[tabella] = {
                 'tabella': tabella,
                 'totale_tabella': totale_tabella,
                 'ripartizioni': []
             }
 
-            # Ottieni millesimi per questa tabella
-            exec_sql(cursor, """
-                SELECT p.id as persona_id, p.nome, p.cognome, p.tipo_persona,
-                       ui.id as unita_id, ui.numero_unita, m.valore as millesimi
-                FROM persone p
-                JOIN unita_immobiliari ui ON p.unita_id = ui.id
-                LEFT JOIN millesimi m ON ui.id = m.unita_id AND m.tabella = ?
-                WHERE p.condominio_id = ?
-                ORDER BY ui.numero_unita
-            """, (tabella, condominio_id))
+            persone_con_millesimi = lavori[tabella][1]
+            ripartizione_tabella = {p['persona_id']: 0 for p in persone_con_millesimi if p['millesimi']}
 
-            persone_con_millesimi = cursor.fetchall()
+            for indice in range(len(spese_tabella)):
+                for persona_id, centesimi in quote_spese[(tabella, indice)].items():
+                    ripartizione_tabella[persona_id] += centesimi
 
-            # Calcola ruoli presenti per unitÃ 
-            unita_ruoli = {}
-            ruolo_counts = {}
-            for p in persone_con_millesimi:
-                if not p['millesimi']:
+            # Aggiungi risultati della tabella e aggiorna i totali per persona
+            for persona_id, centesimi in ripartizione_tabella.items():
+                if centesimi <= 0:
                     continue
-                uid = p['unita_id']
-                unita_ruoli.setdefault(uid, set())
-                ruolo_counts.setdefault(uid, {'proprietario': 0, 'inquilino': 0, 'both': 0})
-                if p['tipo_persona'] == 'proprietario_inquilino':
-                    unita_ruoli[uid].update({'proprietario', 'inquilino'})
-                    ruolo_counts[uid]['both'] += 1
-                elif p['tipo_persona'] in ('proprietario', 'inquilino'):
-                    unita_ruoli[uid].add(p['tipo_persona'])
-                    ruolo_counts[uid][p['tipo_persona']] += 1
-
-            # Calcola ripartizione per ogni spesa della tabella
-            ripartizione_tabella = {p['persona_id']: 0 for p in persone_con_millesimi if p['millesimi']}
+                persona = persone_per_id[persona_id]
+                analisi_per_tabella[tabella]['ripartizioni'].append({
+                    'persona_id': persona_id,
+                    'nome': persona['nome'],
+                    'cognome': persona['cognome'],
+                    'tipo_persona': persona['tipo_persona'],
+                    'numero_unita': persona['numero_unita'],
+                    'importo_tabella': from_cents(centesimi)
+                })
 
-            for spesa in spese_tabella:
-                for persona in persone_con_millesimi:
-                    if not persona['millesimi']:
-                        continue
-
-                    # Calcola percentuale in base alla logica P/I
-                    if spesa['logica_pi'] == 'proprietario':
-                        if persona['tipo_persona'] in ['proprietario', 'proprietario_inquilino']:
-                            percentuale = 100
-                        else:
-                            percentuale = 0
-                    elif spesa['logica_pi'] == 'inquilino':
-                        if persona['tipo_persona'] in ['inquilino', 'proprietario_inquilino']:
-                            percentuale = 100
-                        else:
-                            percentuale = 0
-                    elif spesa['logica_pi'] == '50/50':
-                        if persona['tipo_persona'] == 'proprietario_inquilino':
-                            percentuale = 100
-                        else:
-                            ruoli_presenti = unita_ruoli.get(persona['unita_id'], set())
-                            if 'proprietario' in ruoli_presenti and 'inquilino' in ruoli_presenti:
-                                percentuale = 50
-                            else:
-                                percentuale = 100
-                    else:  # personalizzato
-                        if persona['tipo_persona'] == 'proprietario_inquilino':
-                            percentuale = spesa['percentuale_proprietario'] + spesa['percentuale_inquilino']
-                        elif persona['tipo_persona'] == 'proprietario':
-                            percentuale = spesa['percentuale_proprietario']
-                        else:  # inquilino
-                            percentuale = spesa['percentuale_inquilino']
-
-                    # Divisione intra-ruolo
-                    quota_divisore = 1
-                    uid = persona['unita_id']
-                    if persona['tipo_persona'] == 'proprietario':
-                        quota_divisore = max(1, ruolo_counts.get(uid, {}).get('proprietario', 1))
-                    elif persona['tipo_persona'] == 'inquilino':
-                        quota_divisore = max(1, ruolo_counts.get(uid, {}).get('inquilino', 1))
-
-                    # Calcola importo dovuto per questa spesa
-                    importo_dovuto = (spesa['importo_previsto'] * persona['millesimi'] * (percentuale / 100)) / 1000
-                    importo_dovuto = importo_dovuto / quota_divisore
-
-                    ripartizione_tabella[persona['persona_id']] += importo_dovuto
-
-            # Aggiungi risultati della tabella
-            for persona_id, importo_tabella in ripartizione_tabella.items():
-                if importo_tabella > 0:
-                    persona = next((p for p in persone_con_millesimi if p['persona_id'] == persona_id), None)
-                    if persona:
-                        analisi_per_tabella[tabella]['ripartizioni'].append({
-                            'persona_id': persona_id,
-                            'nome': persona['nome'],
-                            'cognome': persona['cognome'],
-                            'tipo_persona': persona['tipo_persona'],
-                            'numero_unita': persona['numero_unita'],
-                            'importo_tabella': round(importo_tabella, 2)
-                        })
-
-        # Calcola totali per persona aggregando tutte le tabelle
-        persona_totale_map = {}
-        for tabella_data in analisi_per_tabella.values():
-            for ripartizione in tabella_data['ripartizioni']:
-                persona_id = ripartizione['persona_id']
                 if persona_id not in persona_totale_map:
-                    persona_info = next((p for p in persone if p.id == persona_id), None)
-                    if persona_info:
-                        persona_totale_map[persona_id] = {
-                            'persona_id': persona_id,
-                            'nome': persona_info.nome,
-                            'cognome': persona_info.cognome,
-                            'tipo_persona': persona_info.tipo_persona,
-                            'numero_unita': persona_unita_map.get(persona_id, 0),
-                            'importo_totale': 0,
-                            'dettaglio_tabelle': []
-                        }
-
-                if persona_id in persona_totale_map:
-                    persona_totale_map[persona_id]['importo_totale'] += ripartizione['importo_tabella']
-                    persona_totale_map[persona_id]['dettaglio_tabelle'].append({
-                        'tabella': tabella_data['tabella'],
-                        'importo': ripartizione['importo_tabella']
-                    })
-
-                    # Aggiorna totali generali
-                    totale_generale += ripartizione['importo_tabella']
-                    if persona_totale_map[persona_id]['tipo_persona'] in ['proprietario', 'proprietario_inquilino']:
-                        totale_proprietari += ripartizione['importo_tabella']
-                    if persona_totale_map[persona_id]['tipo_persona'] in ['inquilino', 'proprietario_inquilino']:
-                        totale_inquilini += ripartizione['importo_tabella']
+                    persona_totale_map[persona_id] = {
+                        'persona_id': persona_id,
+                        'nome': persona['nome'],
+                        'cognome': persona['cognome'],
+                        'tipo_persona': persona['tipo_persona'],
+                        'numero_unita': persona['numero_unita'],
+                        'importo_totale': 0,
+                        'dettaglio_tabelle': []
+                    }
+                persona_totale_map[persona_id]['importo_totale'] += centesimi
+                persona_totale_map[persona_id]['dettaglio_tabelle'].append({
+                    'tabella': tabella,
+                    'importo': from_cents(centesimi)
+                })
+
+                # Aggiorna totali generali
+                totale_generale += centesimi
+                if persona['tipo_persona'] in ['proprietario', 'proprietario_inquilino']:
+                    totale_proprietari += centesimi
+                if persona['tipo_persona'] in ['inquilino', 'proprietario_inquilino']:
+                    totale_inquilini += centesimi
 
         # Prepara lista finale per persone
         analisi_per_persona = list(persona_totale_map.values())
         for persona in analisi_per_persona:
-            persona['importo_totale'] = round(persona['importo_totale'], 2)
-            for dettaglio in persona['dettaglio_tabelle']:
-                dettaglio['importo'] = round(dettaglio['importo'], 2)
+            persona['importo_totale'] = from_cents(persona['importo_totale'])
+        totale_generale = from_cents(totale_generale)
+        totale_proprietari = from_cents(totale_proprietari)
+        totale_inquilini = from_cents(totale_inquilini)
 
         # Calcola statistiche finali
         numero_proprietari = len([p for p in analisi_per_persona if p['tipo_persona'] in ['proprietario', 'proprietario_inquilino']])
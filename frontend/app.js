@@ -70,6 +70,17 @@ const api = {
         return response.json();
     },
 
+    // Riepilogo di tutti i condominii (spese per anno, preventivi, millesimi, persone)
+    getPortfolio: async (annoDa = null, annoA = null) => {
+        const params = new URLSearchParams();
+        if (annoDa) params.set('anno_da', annoDa);
+        if (annoA) params.set('anno_a', annoA);
+        const response = await fetch(`${API_BASE}/portfolio?${params}`, {
+            headers: { 'Authorization': `Bearer ${localStorage.getItem('token')}` }
+        });
+        return response.json();
+    },
+
     createCondominio: async (data) => {
         const response = await fetch(`${API_BASE}/condominii`, {
             method: 'POST',
@@ -82,6 +93,16 @@ const api = {
         return response.json();
     },
 
+    // Snapshot: tutte le sezioni del condominio in una sola richiesta.
+    // Il server risponde con ETag, quindi il browser la rivalida (304) senza riscaricarla.
+    getSnapshot: async (condoId, sections = null) => {
+        const url = sections ? `${API_BASE}/condominii/${condoId}/snapshot?sections=${sections.join(',')}` : `${API_BASE}/condominii/${condoId}/snapshot`;
+        const response = await fetch(url, {
+            headers: { 'Authorization': `Bearer ${localStorage.getItem('token')}` }
+        });
+        return response.json();
+    },
+
     deleteCondominio: async (id) => {
         const response = await fetch(`${API_BASE}/condominii/${id}`, {
             method: 'DELETE',
@@ -260,6 +281,40 @@ const api = {
         return response.json();
     },
 
+    // Import massivo spese da file CSV/XLSX
+    importSpese: async (condoId, file, dryRun = false) => {
+        const formData = new FormData();
+        formData.append('file', file);
+        const response = await fetch(`${API_BASE}/condominii/${condoId}/spese/import${dryRun ? '?dry_run=1' : ''}`, {
+            method: 'POST',
+            headers: { 'Authorization': `Bearer ${localStorage.getItem('token')}` },
+            body: formData
+        });
+        return response.json();
+    },
+
+    // Ricerca full-text su spese e spese preventivate
+    cercaSpese: async (condoId, testo, filtri = {}) => {
+        const params = new URLSearchParams({ q: testo, ...filtri });
+        const response = await fetch(`${API_BASE}/condominii/${condoId}/ricerca?${params}`, {
+            headers: { 'Authorization': `Bearer ${localStorage.getItem('token')}` }
+        });
+        return response.json();
+    },
+
+    // Simulazione preventivo (bozza di spese e override millesimi, nessuna scrittura)
+    simulaPreventivo: async (condoId, spese, millesimi = null) => {
+        const response = await fetch(`${API_BASE}/condominii/${condoId}/simulazione-preventivo`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'Authorization': `Bearer ${localStorage.getItem('token')}`
+            },
+            body: JSON.stringify(millesimi ? { spese, millesimi } : { spese })
+        });
+        return response.json();
+    },
+
     // Stampa Word
     stampaSpese: async (condoId, tabellaFilter = null) => {
         const url = tabellaFilter ? `${API_BASE}/condominii/${condoId}/stampa/spese?tabella=${tabellaFilter}` : `${API_BASE}/condominii/${condoId}/stampa/spese`;
@@ -951,6 +1006,8 @@ const App = () => {
   };
 
   const handleLogout = () => {
+    // Revoca il token lato server (errori ignorati: il logout locale avviene comunque)
+    api.logout().catch(err => console.error('Errore logout:', err));
     setUser(null);
     setSelectedCondominio(null);
     localStorage.removeItem('token');